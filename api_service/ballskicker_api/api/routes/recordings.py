@@ -1,5 +1,6 @@
 from datetime import UTC, datetime, timedelta
 from typing import Annotated
+from uuid import UUID
 
 import aioboto3
 from aiocache import cached
@@ -7,7 +8,7 @@ from botocore.signers import CloudFrontSigner
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 
 from ballskicker_api.api.auth.auth_context import AuthContext
 from ballskicker_api.api.dependencies.auth import get_auth_context
@@ -16,6 +17,7 @@ from ballskicker_api.api.models.common import PaginatedResponse
 from ballskicker_api.api.models.recordings import Analysis, Clip, ClipType, Insights, Player, Recording
 from ballskicker_api.common.utils import Measure
 from ballskicker_api.config.settings import AppSettings, get_settings
+from ballskicker_api.repositories.media_repository import MediaClip
 from ballskicker_api.services.media_service import MediaService
 
 recordings_router = APIRouter(prefix="/recordings", tags=["recording"])
@@ -69,6 +71,31 @@ async def get_cloudfront_signed_url(resource_path, key_id, expires, session, set
     return cloudfront_signer.generate_presigned_url(url, date_less_than=expiry_time)
 
 
+def _make_clip(clip_info: MediaClip, thumbnail_url: str | None) -> Clip:
+    return Clip(
+        id=clip_info.clip_id,
+        clip_type=ClipType(clip_info.clip_type),
+        start_frame=clip_info.start_frame,
+        end_frame=clip_info.end_frame,
+        start_sec=clip_info.start_sec,
+        end_sec=clip_info.end_sec,
+        thumbnail_url=thumbnail_url,
+        players={
+            p.player_id: Player(
+                player_id=p.player_id,
+                heatmap=p.heatmap,
+                analysis=Analysis(
+                    defence_share=p.analysis.defence_share,
+                    transition_share=p.analysis.transition_share,
+                    volley_share=p.analysis.volley_share,
+                ),
+                insights=Insights(positioning=p.insights.positioning),
+            )
+            for p in clip_info.players.values()
+        },
+    )
+
+
 @recordings_router.get("/")
 async def route_get_games_list(
     auth_context: Annotated[AuthContext, Depends(get_auth_context)],
@@ -122,28 +149,7 @@ async def route_get_games_list(
             clip_thumbnails = []
 
         clips = [
-            Clip(
-                id=clip_info.clip_id,
-                clip_type=ClipType(clip_info.clip_type),
-                start_frame=clip_info.start_frame,
-                end_frame=clip_info.end_frame,
-                start_sec=clip_info.start_sec,
-                end_sec=clip_info.end_sec,
-                thumbnail_url=clip_thumbnail_url,
-                players={
-                    p.player_id: Player(
-                        player_id=p.player_id,
-                        heatmap=p.heatmap,
-                        analysis=Analysis(
-                            defence_share=p.analysis.defence_share,
-                            transition_share=p.analysis.transition_share,
-                            volley_share=p.analysis.volley_share,
-                        ),
-                        insights=Insights(positioning=p.insights.positioning),
-                    )
-                    for p in clip_info.players.values()
-                },
-            )
+            _make_clip(clip_info, clip_thumbnail_url)
             for clip_info, clip_thumbnail_url in zip(media_clips, clip_thumbnails, strict=False) or []
         ]
 
@@ -162,3 +168,37 @@ async def route_get_games_list(
         )
 
     return PaginatedResponse[Recording](items=recordings)
+
+
+@recordings_router.get("/{media_id}/clips/{clip_id}")
+async def route_get_clip(
+    media_id: UUID,
+    clip_id: UUID,
+    auth_context: Annotated[AuthContext, Depends(get_auth_context)],
+    media_service: Annotated[MediaService, Depends(get_media_service)],
+    settings: Annotated[AppSettings, Depends(get_settings)],
+) -> Clip:
+    """
+    A clip with the heatmaps and insights of its players. The recordings list leaves them out for media that keep
+    them in S3, they are only fetched here.
+    """
+    media = await media_service.get_media_by_id(media_id)
+    if media is None or media.user_id != auth_context.user_id:
+        raise HTTPException(status_code=404, detail="Recording not found")
+
+    with Measure("Getting clip details"):
+        clip_info = await media_service.get_clip(media, clip_id, settings.MEDIA_BUCKET_NAME)
+    if clip_info is None:
+        raise HTTPException(status_code=404, detail="Clip not found")
+
+    thumbnail_url = None
+    if clip_info.thumbnail_key:
+        thumbnail_url = await get_cloudfront_signed_url(
+            clip_info.thumbnail_key,
+            KEY_ID,  # This should be the CloudFront public key ID
+            1200,  # Expiry time in seconds
+            aioboto3.Session(),
+            settings,
+        )
+
+    return _make_clip(clip_info, thumbnail_url)
@@ -0,0 +1,24 @@
+import base64
+import sys
+import zlib
+from array import array
+
+# Heatmaps are stored as the dense grid of the court cells (26 x 51, row-major), little-endian uint16 counts or
+# uint32 when a cell does not fit, zlib compressed and base64 encoded. The size of the grid tells the width.
+HEATMAP_WIDTH = 26
+HEATMAP_HEIGHT = 51
+
+
+def decode_heatmap(encoded: str) -> list[tuple[tuple[int, int], int]]:
+    """
+    ((x, y), count) of the visited cells, the most visited first.
+    """
+    raw = zlib.decompress(base64.b64decode(encoded))
+    counts = array("H" if len(raw) == 2 * HEATMAP_WIDTH * HEATMAP_HEIGHT else "I")
+    counts.frombytes(raw)
+    if sys.byteorder == "big":
+        counts.byteswap()
+
+    cells = [(divmod(cell, HEATMAP_HEIGHT), count) for cell, count in enumerate(counts) if count]
+    cells.sort(key=lambda cell: cell[1], reverse=True)
+    return cells
@@ -1,3 +1,5 @@
+import gzip
+import json
 import logging
 import uuid
 from datetime import UTC, datetime
@@ -6,12 +8,17 @@ from uuid import UUID
 
 from aioboto3 import Session
 from aiocache import cached
-from pydantic import BaseModel, Field
+from cachetools import TTLCache
+from pydantic import BaseModel, ConfigDict, Field
 
 from ballskicker_api.api.auth.auth_context import AuthContext
+from ballskicker_api.common.heatmap import decode_heatmap
 
 log = logging.getLogger("MediaRepository")
 
+# Parsed clip details by bucket and key, every analysis run writes its details under a new key
+clip_details_cache = TTLCache(maxsize=256, ttl=3600)
+
 
 class MediaClipType(StrEnum):
     FULL = "full"
@@ -29,11 +36,24 @@ class Insights(BaseModel):
 
 
 class Player(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     player_id: int
-    heatmap: list[tuple[tuple[int, int], int]]
+    # Media analysed before the compact heatmaps keep the list of cells, newer ones only the encoded grid
+    heatmap_cells: list[tuple[tuple[int, int], int]] | None = Field(default=None, alias="heatmap")
+    heatmap_grid: str | None = None
     analysis: Analysis = Field(default_factory=Analysis)
     insights: Insights = Field(default_factory=Insights)
 
+    @property
+    def heatmap(self) -> list[tuple[tuple[int, int], int]]:
+        """
+        Cells of the heatmap, the grid is decoded on first use.
+        """
+        if self.heatmap_cells is None:
+            self.heatmap_cells = decode_heatmap(self.heatmap_grid) if self.heatmap_grid else []
+        return self.heatmap_cells
+
 
 class MediaClip(BaseModel):
     clip_id: UUID
@@ -66,6 +86,8 @@ class MediaInfo(BaseModel):
     frames_count: int | None = None
     processed_media_s3_key: str | None = None
     thumbnail_s3_key: str | None = None
+    # Set when the heatmaps and insights of the clips' players are kept in S3 rather than in the item
+    clip_details_s3_key: str | None = None
 
 
 class MediaRepository:
@@ -77,8 +99,49 @@ class MediaRepository:
         async with self._session.resource("dynamodb") as dynamodb:
             return await dynamodb.Table("users-media")
 
-    async def get_media_by_id(self, media_id: UUID) -> MediaInfo:
-        pass
+    async def get_media_by_id(self, media_id: UUID) -> MediaInfo | None:
+        media_table = await self._get_table()
+        response = await media_table.get_item(Key={"media_id": str(media_id)})
+
+        item = response.get("Item")
+        return MediaInfo.model_validate(item) if item else None
+
+    async def _get_clip_details(self, bucket: str, key: str) -> dict[str, dict[str, dict]]:
+        cache_key = f"clip_details:{bucket}/{key}"
+        cached_details = clip_details_cache.get(cache_key)
+        if cached_details is not None:
+            return cached_details
+
+        async with self._session.client("s3") as s3_client:
+            response = await s3_client.get_object(Bucket=bucket, Key=key)
+            body = await response["Body"].read()
+
+        details = json.loads(gzip.decompress(body))
+        clip_details_cache[cache_key] = details
+        return details
+
+    async def get_clip(self, media: MediaInfo, clip_id: UUID, bucket: str) -> MediaClip | None:
+        """
+        The clip with the heatmaps and insights of its players, fetched from `bucket` when the media keeps them in S3.
+        """
+        clip = next((clip for clip in media.clips or [] if clip.clip_id == clip_id), None)
+        if clip is None or not media.clip_details_s3_key:
+            return clip
+
+        details = await self._get_clip_details(bucket, media.clip_details_s3_key)
+        clip_details = details.get(str(clip_id), {})
+
+        players = {}
+        for player_id, player in clip.players.items():
+            player_details = clip_details.get(str(player_id), {})
+            players[player_id] = player.model_copy(
+                update={
+                    "heatmap_cells": None,
+                    "heatmap_grid": player_details.get("heatmap_grid"),
+                    "insights": Insights.model_validate(player_details.get("insights", {})),
+                }
+            )
+        return clip.model_copy(update={"players": players})
 
     async def get_media_for_user(self, user_id: UUID) -> list[MediaInfo]:
         media_table = await self._get_table()
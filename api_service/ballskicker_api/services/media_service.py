@@ -1,7 +1,7 @@
 from uuid import UUID
 
 from ballskicker_api.api.auth.auth_context import AuthContext
-from ballskicker_api.repositories.media_repository import MediaInfo, MediaRepository
+from ballskicker_api.repositories.media_repository import MediaClip, MediaInfo, MediaRepository
 
 
 class MediaService:
@@ -11,5 +11,11 @@ class MediaService:
     async def get_media_for_user(self, user_id: UUID) -> list[MediaInfo]:
         return await self.__repository.get_media_for_user(user_id)
 
+    async def get_media_by_id(self, media_id: UUID) -> MediaInfo | None:
+        return await self.__repository.get_media_by_id(media_id)
+
+    async def get_clip(self, media: MediaInfo, clip_id: UUID, bucket: str) -> MediaClip | None:
+        return await self.__repository.get_clip(media, clip_id, bucket)
+
     async def create_media_entry(self, *, title: str, file_name: str, auth_context: AuthContext) -> MediaInfo:
         return await self.__repository.create_media_entry(title=title, file_name=file_name, auth_context=auth_context)
@@ -0,0 +1,550 @@
+import itertools
+import time
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import typer
+from lib.frame_pipeline import Frame, VideoInfo
+from lib.player_heatmap.track_store import TrackStore
+from lib.tracker.association import giou_batch, linear_assignment
+from lib.tracker.kalmanfilter import KalmanFilterNew
+from lib.tracker.ocsort import OCSort, box_filter_model, convert_bbox_to_z
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import pdist
+
+from video_analyser import (
+    HEATMAP_HEIGHT,
+    HEATMAP_WIDTH,
+    RALLY_DISTANCE_THRESHOLD,
+    BallPresenceDetector,
+    VideoAnalyser,
+    detect_rallies_clustering,
+    heatmap_cells,
+    heatmap_from_cells,
+)
+
+app = typer.Typer()
+
+
+def _synthetic_ball_detections(rng: np.random.Generator, n: int, fps: int = 30) -> pd.DataFrame:
+    """
+    Ball detections grouped into bursts separated by pauses, roughly what a match looks like.
+    """
+    gaps = np.where(rng.random(n) < 0.05, rng.exponential(8.0, n), rng.exponential(0.3, n))
+    timestamps = np.cumsum(gaps)
+    return pd.DataFrame({"frame": (timestamps * fps).astype(int), "timestamp_sec": timestamps})
+
+
+def _scipy_rally_segments(df_detections, min_detections=5, distance_threshold=RALLY_DISTANCE_THRESHOLD):
+    """
+    The original pdist/linkage implementation, kept as the reference for the sort-and-split segmenter.
+    """
+    if len(df_detections) < min_detections:
+        return []
+
+    detections_sorted = df_detections.sort_values("timestamp_sec").reset_index(drop=True)
+
+    X = detections_sorted[["timestamp_sec"]].values
+    Z = linkage(pdist(X, metric="euclidean"), method="single")
+    detections_sorted["cluster"] = fcluster(Z, t=distance_threshold, criterion="distance")
+
+    segments = []
+    for _, cluster_data in detections_sorted.groupby("cluster"):
+        if len(cluster_data) < min_detections:
+            continue
+
+        start_time = cluster_data["timestamp_sec"].min()
+        end_time = cluster_data["timestamp_sec"].max()
+        if end_time - start_time < 3.0:
+            continue
+
+        segments.append(
+            (
+                int(cluster_data["frame"].min()),
+                int(cluster_data["frame"].max()),
+                start_time,
+                end_time,
+                len(cluster_data),
+            )
+        )
+
+    return sorted(segments)
+
+
+def _synthetic_player_detections(
+    rng: np.random.Generator,
+    frames: int,
+    players: int = 4,
+    occlusion_rate: float = 0.01,
+    false_positive_rate: float = 0.05,
+    max_hidden: int = 60,
+) -> list[np.ndarray]:
+    """
+    Per frame [x1, y1, x2, y2, score] detections of players walking around a 1280x720 frame. Players get hidden
+    for up to `max_hidden` frames at a time (behind the net or the glass) and stray detections show up now and then.
+    """
+    position = rng.uniform([100, 200], [1180, 600], (players, 2))
+    velocity = np.zeros((players, 2))
+    size = rng.uniform([50, 120], [80, 180], (players, 2))
+    hidden_until = np.zeros(players, dtype=int)
+
+    detections = []
+    for frame in range(frames):
+        velocity = np.clip(0.9 * velocity + rng.normal(0, 1.0, (players, 2)), -12, 12)
+        position = np.clip(position + velocity, [50, 150], [1230, 700])
+
+        start_hiding = (hidden_until <= frame) & (rng.random(players) < occlusion_rate)
+        hidden_until[start_hiding] = frame + rng.integers(5, max_hidden, start_hiding.sum())
+        visible = hidden_until <= frame
+
+        centre = position[visible] + rng.normal(0, 2.0, (visible.sum(), 2))
+        half = size[visible] / 2
+        boxes = np.concatenate((centre - half, centre + half, rng.uniform(0.3, 1.0, (visible.sum(), 1))), axis=1)
+
+        if rng.random() < false_positive_rate:
+            x, y = rng.uniform([0, 0], [1200, 600])
+            boxes = np.concatenate((boxes, [[x, y, x + 40, y + 80, rng.uniform(0.2, 0.7)]]))
+
+        detections.append(boxes)
+
+    return detections
+
+
+def _run_tracker(tracker: OCSort, detections: list[np.ndarray]) -> tuple[list[np.ndarray], float]:
+    img_size = (720, 1280)
+    started = time.perf_counter()
+    tracks = [tracker.update(dets.copy(), img_info=img_size, img_size=img_size) for dets in detections]
+    return tracks, time.perf_counter() - started
+
+
+def _player_tracker(**kwargs) -> OCSort:
+    # The settings PlayerPositionCollector uses
+    return OCSort(
+        det_thresh=0.5,
+        max_age=60 * 30,
+        min_hits=3,
+        iou_threshold=0.3,
+        delta_t=3,
+        asso_func="giou",
+        inertia=0.2,
+        use_byte=True,
+        **kwargs,
+    )
+
+
+def _same_tracks(expected: list[np.ndarray], actual: list[np.ndarray]) -> bool:
+    return len(expected) == len(actual) and all(
+        e.shape == a.shape and np.array_equal(e[:, 4], a[:, 4]) and np.allclose(e, a, rtol=0, atol=1e-6)
+        for e, a in zip(expected, actual, strict=True)
+    )
+
+
+@app.command()
+def tracker(frames: int = 30 * 60 * 5, occlusion_rate: float = 0.01, seed: int = 0):
+    """
+    Checks the batched Kalman filter against the per-track filters and compares the tracker frame rates.
+    """
+    detections = _synthetic_player_detections(np.random.default_rng(seed), frames, occlusion_rate=occlusion_rate)
+
+    expected, per_track_time = _run_tracker(_player_tracker(batched=False), detections)
+    actual, batched_time = _run_tracker(_player_tracker(), detections)
+
+    if not _same_tracks(expected, actual):
+        raise AssertionError("The batched Kalman filter tracks differ from the per-track filters")
+
+    print(f"{frames} frames tracked the same with the batched filter")
+    print(f"   per-track filters: {frames / per_track_time:.0f} fps")
+    print(f"   batched filter:    {frames / batched_time:.0f} fps")
+
+
+def _recovery_time(gap: int, repeats: int = 200) -> float:
+    """
+    Time KalmanFilterNew takes for the update that finds a track again after `gap` missed frames.
+    """
+    total = 0.0
+    for _ in range(repeats):
+        kf = KalmanFilterNew(dim_x=7, dim_z=4)
+        kf.F, kf.H, kf.Q, kf.R, kf.P = box_filter_model()
+        kf.x[:4] = convert_bbox_to_z([100, 150, 160, 300])
+        for step in range(3):
+            kf.predict()
+            kf.update(convert_bbox_to_z([100 + step, 150, 160 + step, 300]))
+        for _ in range(gap):
+            kf.predict()
+            kf.update(None)
+
+        kf.predict()
+        started = time.perf_counter()
+        kf.update(convert_bbox_to_z([140, 170, 200, 320]))
+        total += time.perf_counter() - started
+
+    return total / repeats
+
+
+@app.command()
+def occlusions(frames: int = 30 * 60 * 2, max_hidden: int = 150, seed: int = 0):
+    """
+    Tracker frame rate as the players get hidden more often, every recovered track runs the re-update.
+    """
+    for occlusion_rate in (0.0, 0.01, 0.02, 0.05):
+        detections = _synthetic_player_detections(
+            np.random.default_rng(seed), frames, occlusion_rate=occlusion_rate, max_hidden=max_hidden
+        )
+        expected, per_track_time = _run_tracker(_player_tracker(batched=False), detections)
+        actual, batched_time = _run_tracker(_player_tracker(), detections)
+
+        if not _same_tracks(expected, actual):
+            raise AssertionError(f"The tracks differ between the filters at occlusion rate {occlusion_rate}")
+
+        print(
+            f"occlusion rate {occlusion_rate:.2f}: per-track filters {frames / per_track_time:.0f} fps, "
+            f"batched filter {frames / batched_time:.0f} fps"
+        )
+
+    for gap in (5, 30, max_hidden):
+        print(f"re-update after {gap} missed frames: {_recovery_time(gap) * 1000:.2f} ms")
+
+
+@app.command()
+def tracker_memory(frames: int = 30 * 60 * 5, checkpoints: int = 5, seed: int = 0):
+    """
+    Measures the memory held by the tracker as the video gets longer, it should level off per track.
+    """
+    detections = _synthetic_player_detections(np.random.default_rng(seed), frames, occlusion_rate=0.02)
+    img_size = (720, 1280)
+
+    # Imports and caches the tracker pulls in on the first frames are not what is measured
+    for batched in (False, True):
+        _run_tracker(_player_tracker(batched=batched), detections[:100])
+
+    for batched in (False, True):
+        print("batched filter:" if batched else "per-track filters:")
+        tracker = _player_tracker(batched=batched)
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for frame, dets in enumerate(detections, start=1):
+            tracker.update(dets.copy(), img_info=img_size, img_size=img_size)
+            if frame % (frames // checkpoints) == 0:
+                used = tracemalloc.get_traced_memory()[0] - baseline
+                tracks = len(tracker.trackers)
+                per_track = used / 1024 / tracks
+                print(f"   {frame:>7} frames: {used / 1024:8.1f} KiB, {tracks} tracks, {per_track:6.1f} KiB/track")
+        tracemalloc.stop()
+
+
+def _assignment_cost(rng: np.random.Generator, tracks: int, detections: int) -> np.ndarray:
+    """
+    Negative GIoU between predicted player boxes and the detections of a frame: the players moved a little,
+    the extra detections are false positives somewhere on the court.
+    """
+    corners = rng.uniform((0, 0), (1100, 500), (max(tracks, detections), 2))
+    boxes = np.hstack((corners, corners + rng.uniform((40, 120), (80, 220), (len(corners), 2))))
+    moved = boxes[:detections] + rng.normal(0, 8, (detections, 4))
+    return -giou_batch(moved, boxes[:tracks])
+
+
+def _greedy_assignment(cost_matrix: np.ndarray) -> np.ndarray | None:
+    """
+    Every row takes its cheapest column, optimal when no two rows want the same one, else None.
+    """
+    cols = cost_matrix.argmin(axis=1)
+    if len(set(cols.tolist())) < len(cols):
+        return None
+    return np.stack((np.arange(len(cols)), cols), axis=1)
+
+
+def _brute_force_assignment(cost_matrix: np.ndarray, assignments: np.ndarray) -> np.ndarray:
+    """
+    Tries all the `assignments` (every ordered choice of a column per row) and keeps the cheapest.
+    """
+    rows = np.arange(cost_matrix.shape[0])
+    best = assignments[cost_matrix[rows, assignments].sum(axis=1).argmin()]
+    return np.stack((rows, best), axis=1)
+
+
+def _previous_linear_assignment(cost_matrix: np.ndarray) -> np.ndarray:
+    """
+    linear_assignment as it was, trying to import lap on every call.
+    """
+    try:
+        import lap
+
+        _, x, y = lap.lapjv(cost_matrix, extend_cost=True)
+        return np.array([[y[i], i] for i in x if i >= 0])
+    except ImportError:
+        x, y = linear_sum_assignment(cost_matrix)
+        return np.array(list(zip(x, y, strict=False)))
+
+
+@app.command()
+def assignment(repeats: int = 2000, seed: int = 0):
+    """
+    Times the assignment solvers on the cost matrices of a padel match (detections x tracks), in microseconds.
+    """
+    try:
+        import lap
+    except ImportError:
+        lap = None
+        print("lap is not installed, skipping it")
+
+    rng = np.random.default_rng(seed)
+
+    def micros(solve) -> float:
+        return min(timeit.repeat(solve, number=repeats, repeat=5)) / repeats * 1e6
+
+    print(f"{'size':>7} {'assignment':>10} {'previous':>8} {'lap':>6} {'greedy':>6} {'brute force':>11}")
+    for detections, tracks in ((4, 4), (5, 4), (6, 4), (6, 5), (8, 6), (12, 12)):
+        cost = _assignment_cost(rng, tracks, detections)
+        expected = cost[tuple(linear_assignment(cost).T)].sum()
+
+        timings = [micros(lambda c=cost: linear_assignment(c)), micros(lambda c=cost: _previous_linear_assignment(c))]
+        if lap is not None:
+            timings.append(micros(lambda c=cost: lap.lapjv(c, extend_cost=True)))
+        else:
+            timings.append(float("nan"))
+
+        # Greedy and brute force pick a column per row, the tracks are the shorter side
+        transposed = cost.T
+        greedy = _greedy_assignment(transposed)
+        timings.append(micros(lambda c=transposed: _greedy_assignment(c)) if greedy is not None else float("nan"))
+        if greedy is not None and not np.isclose(transposed[tuple(greedy.T)].sum(), expected):
+            raise AssertionError("The greedy assignment is not the optimal one")
+
+        if tracks <= 5:
+            assignments = np.array(list(itertools.permutations(range(detections), tracks)))
+            best = _brute_force_assignment(transposed, assignments)
+            if not np.isclose(transposed[tuple(best.T)].sum(), expected):
+                raise AssertionError("The brute-force assignment is not the optimal one")
+            timings.append(micros(lambda c=transposed, a=assignments: _brute_force_assignment(c, a)))
+        else:
+            timings.append(float("nan"))
+
+        size = f"{detections}x{tracks}"
+        print(f"{size:>7} " + " ".join(f"{t:>{w}.1f}" for t, w in zip(timings, (10, 8, 6, 6, 11), strict=True)))
+
+
+@app.command()
+def track_store(frames: int = 160_000, players: int = 4, rallies: int = 300, seed: int = 0):
+    """
+    Memory and rally lookup time for the player positions of a full match, kept as a dict per frame turned into
+    a DataFrame (the way they used to be) and in the TrackStore.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.integers(0, 300, (frames, players, 2)).tolist()
+    starts = np.sort(rng.integers(0, frames - 600, rallies)).tolist()
+    bounds = [(start, start + int(rng.integers(150, 600))) for start in starts]
+
+    tracemalloc.start()
+    history = [
+        {"frame": frame, **{player + 1: tuple(xy) for player, xy in enumerate(positions[frame])}}
+        for frame in range(frames)
+    ]
+    df = pd.DataFrame(history).set_index("frame")
+    started = time.perf_counter()
+    dict_rows = sum(len(df[(df.index >= start) & (df.index <= end)]) for start, end in bounds)
+    dict_time = time.perf_counter() - started
+    dict_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del history, df
+
+    tracemalloc.start()
+    store = TrackStore(capacity=frames * players)
+    for frame in range(frames):
+        store.append([(frame, player + 1, x, y) for player, (x, y) in enumerate(positions[frame])])
+    started = time.perf_counter()
+    store_rows = sum(len(store.frame[store.between(start, end)]) for start, end in bounds) // players
+    store_time = time.perf_counter() - started
+    store_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if dict_rows != store_rows:
+        raise AssertionError(f"The rallies cover {store_rows} frames in the store and {dict_rows} in the DataFrame")
+
+    print(f"{frames} frames x {players} players, {rallies} rallies")
+    print(f"   dict per frame: {dict_peak / 2**20:7.1f} MiB peak, rally lookups {dict_time * 1000:7.1f} ms")
+    print(f"   track store:    {store_peak / 2**20:7.1f} MiB peak, rally lookups {store_time * 1000:7.1f} ms")
+
+
+def _pandas_heatmap(x: list[int], y: list[int]) -> tuple[list, tuple[float, float, float]]:
+    """
+    The original per-point binning and zone stats loop, kept as the reference for the vectorized heatmaps.
+    """
+    binned_coordinates = pd.Series(
+        [(np.clip(x // 10, 0, 25), np.clip(y // 10, 0, 50)) for x, y in zip(x, y, strict=True)]
+    ).value_counts()
+    heatmap = [(xy, count) for xy, count in binned_coordinates.items()]
+
+    total_value = volley_value = defence_value = transition_value = 0
+    for [[_, y], intensity] in heatmap:
+        norm = abs(y - 25) / 25
+        total_value += intensity
+        if norm < 0.4:
+            volley_value += intensity
+        elif norm > 0.7:
+            defence_value += intensity
+        else:
+            transition_value += intensity
+
+    if total_value == 0:
+        return heatmap, (0, 0, 0)
+    return heatmap, (volley_value / total_value, transition_value / total_value, defence_value / total_value)
+
+
+@app.command()
+def heatmaps(frames: int = 160_000, rallies: int = 300, seed: int = 0):
+    """
+    Checks the vectorized heatmaps and zone stats against the per-point ones and times both on a full match,
+    a full-match clip and the rally clips of a single player.
+    """
+    rng = np.random.default_rng(seed)
+    # Court units with a little spill over the edges of the grid
+    x = rng.normal(130, 70, frames).astype(np.int32)
+    y = rng.normal(260, 150, frames).astype(np.int32)
+    starts = np.sort(rng.integers(0, frames - 600, rallies))
+    clips = [(0, frames)] + [(int(start), int(start) + int(rng.integers(150, 600))) for start in starts]
+
+    started = time.perf_counter()
+    expected = [_pandas_heatmap(x[start:end].tolist(), y[start:end].tolist()) for start, end in clips]
+    pandas_time = time.perf_counter() - started
+
+    analyser = VideoAnalyser.__new__(VideoAnalyser)
+    started = time.perf_counter()
+    actual = []
+    for start, end in clips:
+        cells = heatmap_cells(x[start:end], y[start:end])
+        grid = np.bincount(cells, minlength=HEATMAP_WIDTH * HEATMAP_HEIGHT).reshape(HEATMAP_WIDTH, HEATMAP_HEIGHT)
+        stats = analyser._build_zone_stats(grid)
+        actual.append((heatmap_from_cells(cells), (stats.volley_share, stats.transition_share, stats.defence_share)))
+    vectorized_time = time.perf_counter() - started
+
+    if actual != expected:
+        raise AssertionError("The vectorized heatmaps differ from the per-point ones")
+
+    print(f"{len(clips)} clips over {frames} frames give the same heatmaps and zone stats")
+    print(f"   per point:  {pandas_time * 1000:8.1f} ms")
+    print(f"   vectorized: {vectorized_time * 1000:8.1f} ms")
+
+
+@app.command()
+def rallies(trials: int = 200, max_detections: int = 2000, large: int = 100_000, seed: int = 0):
+    """
+    Checks the rally segmenter against the scipy single-linkage clustering and times it on a full match.
+    """
+    rng = np.random.default_rng(seed)
+
+    for _ in range(trials):
+        df = _synthetic_ball_detections(rng, int(rng.integers(0, max_detections)))
+        expected = _scipy_rally_segments(df)
+        actual = [
+            (r.start_frame, r.end_frame, r.start_time, r.end_time, r.detection_count)
+            for r in detect_rallies_clustering(df)
+        ]
+        if [(s, e, int(st), int(np.ceil(et)), c) for s, e, st, et, c in expected] != actual:
+            raise AssertionError(f"Rally segments differ from the scipy clustering: {expected} != {actual}")
+
+    print(f"{trials} random inputs match the scipy clustering")
+
+    df = _synthetic_ball_detections(rng, large)
+    started = time.perf_counter()
+    found = detect_rallies_clustering(df)
+    print(f"{large} detections -> {len(found)} rallies in {time.perf_counter() - started:.3f}s")
+
+
+def _synthetic_ball_visibility(rng: np.random.Generator, frames: int, fps: int, miss_rate: float) -> np.ndarray:
+    """
+    Per-frame ball visibility: rallies of 4-30 s where the detector misses single frames at `miss_rate` and the ball
+    is hidden for up to a second at times, separated by 5-40 s pauses without a ball.
+    """
+    visible = np.zeros(frames, dtype=bool)
+    position = int(rng.integers(0, 10 * fps))
+    while position < frames:
+        end = min(frames, position + int(rng.uniform(4, 30) * fps))
+        visible[position:end] = rng.random(end - position) >= miss_rate
+        for _ in range(int(rng.integers(0, 4))):
+            hidden = int(rng.integers(position, end))
+            visible[hidden : hidden + int(rng.integers(1, fps))] = False
+        position = end + int(rng.uniform(5, 40) * fps)
+    return visible
+
+
+class _VisibilityModel:
+    """
+    Stands in for the ball model, the frames' images hold their frame number.
+    """
+
+    def __init__(self, visible: np.ndarray):
+        self.visible = visible
+
+    def predict(self, images, **kwargs):
+        ball = SimpleNamespace(cls=[0])
+        return [SimpleNamespace(boxes=[ball] if self.visible[int(image[0])] else []) for image in images]
+
+
+def _ball_rallies(visible: np.ndarray, fps: int, batch_size: int, **kwargs) -> tuple[list, int]:
+    detector = BallPresenceDetector(_VisibilityModel(visible), batch_size=batch_size, **kwargs)
+    detector.on_start(VideoInfo(width=1, height=1, fps=fps, total_frames=len(visible)))
+    for number in range(len(visible)):
+        detector.on_frame(Frame(number=number, timestamp_sec=number / fps, image=np.array([number])))
+    detector.on_finish()
+    return detect_rallies_clustering(pd.DataFrame(detector.detections)), detector.frames_inferred
+
+
+@app.command()
+def ball_sampling(
+    videos: int = 20,
+    minutes: float = 10.0,
+    fps: int = 30,
+    sampling_fps: float = 5.0,
+    boundary_tolerance: float = 0.1,
+    miss_rate: float = 0.15,
+    batch_size: int = 16,
+    seed: int = 0,
+):
+    """
+    Checks that sampled ball detection finds the same rallies as detection on every frame, with the rally
+    boundaries within the tolerance, and counts the frames the model looks at.
+    """
+    rng = np.random.default_rng(seed)
+    # A boundary is refined on every refine_step-th skipped frame, it is off by less than a step
+    max_offset = max(1, round(boundary_tolerance * fps)) - 1
+
+    dense_frames = sampled_frames = rally_count = 0
+    offsets = []
+    mismatched_videos = 0
+    for _ in range(videos):
+        visible = _synthetic_ball_visibility(rng, int(minutes * 60 * fps), fps, miss_rate)
+        dense, dense_inferred = _ball_rallies(visible, fps, batch_size)
+        sampled, sampled_inferred = _ball_rallies(
+            visible, fps, batch_size, sampling_fps=sampling_fps, boundary_tolerance=boundary_tolerance
+        )
+
+        dense_frames += dense_inferred
+        sampled_frames += sampled_inferred
+        rally_count += len(dense)
+        if len(dense) != len(sampled):
+            mismatched_videos += 1
+            continue
+        offsets.extend(
+            max(abs(expected.start_frame - actual.start_frame), abs(expected.end_frame - actual.end_frame))
+            for expected, actual in zip(dense, sampled, strict=True)
+        )
+
+    outside = sum(offset > max_offset for offset in offsets)
+    print(f"{videos} videos, {rally_count} rallies, sampled at {sampling_fps} fps with {miss_rate:.0%} missed frames")
+    print(f"   videos with a different number of rallies: {mismatched_videos}")
+    print(f"   boundaries more than {max_offset} frames off: {outside} of {len(offsets)} rallies")
+    print(f"   worst boundary offset: {max(offsets, default=0)} frames")
+    print(f"   frames inferred: {dense_frames} every frame, {sampled_frames} sampled")
+    print(f"   ({sampled_frames / max(dense_frames, 1):.1%} of the frames)")
+
+    if mismatched_videos or outside:
+        raise AssertionError("Sampled ball detection doesn't give the same rallies as detection on every frame")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,138 @@
+import logging
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from tqdm.auto import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+# Region of interest in image coordinates: x1, y1, x2, y2
+Roi = tuple[int, int, int, int]
+
+
+@dataclass
+class VideoInfo:
+    width: int
+    height: int
+    fps: int
+    total_frames: int
+
+
+@dataclass
+class Frame:
+    number: int
+    timestamp_sec: float
+    image: np.ndarray
+    # Set by MotionGate when nothing moved, the detection models skip these frames
+    static: bool = False
+
+
+def crop(image: np.ndarray, roi: Roi | None) -> np.ndarray:
+    if roi is None:
+        return image
+    x1, y1, x2, y2 = roi
+    return image[y1:y2, x1:x2]
+
+
+class FrameConsumer:
+    """
+    Base class for everything that needs to look at the decoded video frames.
+
+    Consumers are registered with a FramePipeline and receive every frame in decode order,
+    so the video is downloaded and decoded only once no matter how many analysis steps need it.
+    """
+
+    def on_start(self, info: VideoInfo) -> None:
+        pass
+
+    def on_frame(self, frame: Frame) -> None:
+        pass
+
+    def on_finish(self) -> None:
+        pass
+
+
+class BatchedFrameConsumer(FrameConsumer):
+    """
+    Collects frames into batches so a model can run one inference call for several frames.
+
+    Batches are delivered to `on_batch` in decode order, the last one may be shorter than `batch_size`.
+    """
+
+    def __init__(self, batch_size: int = 1):
+        self.batch_size = max(1, batch_size)
+        self._batch: list[Frame] = []
+
+    def on_frame(self, frame: Frame) -> None:
+        self._batch.append(frame)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def on_finish(self) -> None:
+        self._flush()
+
+    def on_batch(self, frames: list[Frame]) -> None:
+        pass
+
+    def _flush(self) -> None:
+        if self._batch:
+            frames, self._batch = self._batch, []
+            self.on_batch(frames)
+
+
+class FramePipeline:
+    def __init__(self, media_url: str):
+        self.media_url = media_url
+        self.consumers: list[FrameConsumer] = []
+
+    def register(self, consumer: FrameConsumer) -> FrameConsumer:
+        """
+        Consumers are called in registration order for every frame, so a consumer can rely
+        on the state of the ones registered before it.
+        """
+        self.consumers.append(consumer)
+        return consumer
+
+    def run(self) -> VideoInfo:
+        cap = cv2.VideoCapture(self.media_url)
+        if not cap.isOpened():
+            raise ValueError(f"Failed to open video stream from {self.media_url}")
+
+        try:
+            info = VideoInfo(
+                width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                fps=int(cap.get(cv2.CAP_PROP_FPS)),
+                total_frames=int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            )
+            logger.info(
+                f"Video dimensions: w={info.width}, h={info.height}, fps={info.fps}, frames={info.total_frames}"
+            )
+
+            for consumer in self.consumers:
+                consumer.on_start(info)
+
+            with tqdm(total=info.total_frames, desc="Decoding video") as progress_bar:
+                while cap.isOpened():
+                    frame_number = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                    timestamp_sec = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+                    ret, image = cap.read()
+                    if not ret:
+                        logger.info(f"Decoding finished at frame {frame_number} of {info.total_frames}")
+                        break
+
+                    frame = Frame(number=frame_number, timestamp_sec=timestamp_sec, image=image)
+                    for consumer in self.consumers:
+                        consumer.on_frame(frame)
+
+                    progress_bar.update(1)
+        finally:
+            cap.release()
+
+        for consumer in self.consumers:
+            consumer.on_finish()
+
+        return info
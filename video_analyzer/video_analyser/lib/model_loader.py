@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import shutil
+from enum import StrEnum
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import cv2
+import numpy as np
+import torch
+
+DEFAULT_CACHE_DIR = "./models/cache"
+
+
+class ExportFormat(StrEnum):
+    TORCH = "torch"  # no export, run the .pt weights with PyTorch
+    ONNX = "onnx"
+    OPENVINO = "openvino"
+
+
+def select_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def warmup(model, batch_size: int = 1, frame_shape: tuple[int, int, int] = (720, 1280, 3)) -> None:
+    """
+    Runs a throwaway prediction so graph compilation and allocations happen before the first real video.
+    """
+    frames = [np.zeros(frame_shape, dtype=np.uint8) for _ in range(batch_size)]
+    model.predict(frames, verbose=False)
+
+
+class ModelLoader:
+    """
+    Loads the ultralytics models on the best device available on the host.
+
+    On CPU-only hosts the .pt weights are exported once to `export_format` and the exported model is kept in
+    `cache_dir` under the hash of the weights, so the following starts reuse it instead of converting again.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | str = DEFAULT_CACHE_DIR,
+        export_format: ExportFormat = ExportFormat.OPENVINO,
+        device: str | None = None,
+        num_threads: int | None = None,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.export_format = ExportFormat(export_format)
+        self.device = device or select_device()
+        self.logger = logging.getLogger(__name__)
+
+        if num_threads:
+            # PyTorch runs the .pt models and the pre/post-processing, OpenCV does the decoding and resizing
+            torch.set_num_threads(num_threads)
+            cv2.setNumThreads(num_threads)
+
+        self.logger.info(f"Inference device: {self.device}, cpu export format: {self.export_format}")
+
+    def load(self, model_cls, weights_path: Path | str):
+        """
+        Args:
+            model_cls: ultralytics model class the weights belong to, e.g. YOLO or RTDETR
+            weights_path: path to the .pt weights
+        """
+        weights_path = Path(weights_path)
+
+        if self.device == "cpu" and self.export_format != ExportFormat.TORCH:
+            try:
+                return self._load_exported(model_cls, weights_path)
+            except Exception as e:
+                self.logger.error(f"Failed to use {self.export_format} export of {weights_path}, using PyTorch: {e}")
+
+        model = model_cls(str(weights_path))
+        model.to(self.device)
+        # predict() picks the device from the overrides, not from where the weights are
+        model.overrides["device"] = self.device
+        return model
+
+    def _load_exported(self, model_cls, weights_path: Path):
+        exported_path = self._exported_path(weights_path)
+
+        if not exported_path.exists():
+            self._export(model_cls, weights_path, exported_path)
+        else:
+            self.logger.info(f"Using cached {self.export_format} export of {weights_path}: {exported_path}")
+
+        return model_cls(str(exported_path))
+
+    def _exported_path(self, weights_path: Path) -> Path:
+        key = f"{weights_path.stem}-{_file_hash(weights_path)}"
+        if self.export_format == ExportFormat.ONNX:
+            return self.cache_dir / f"{key}.onnx"
+        return self.cache_dir / f"{key}_{self.export_format}_model"
+
+    def _export(self, model_cls, weights_path: Path, exported_path: Path) -> None:
+        self.logger.info(f"Exporting {weights_path} to {self.export_format}")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # ultralytics writes the export next to the weights, so export a private copy and move the result
+        # into the cache in one rename; workers starting at the same time never see a half written model
+        with TemporaryDirectory(dir=self.cache_dir) as temp_dir:
+            weights_copy = Path(temp_dir) / weights_path.name
+            shutil.copyfile(weights_path, weights_copy)
+
+            # dynamic axes, the frames are sent in batches of varying size
+            exported = Path(model_cls(str(weights_copy)).export(format=str(self.export_format), dynamic=True))
+
+            try:
+                exported.rename(exported_path)
+            except OSError:
+                if not exported_path.exists():
+                    raise
+                self.logger.info(f"{exported_path} was exported by another worker")
+
+        self.logger.info(f"Exported {weights_path} to {exported_path}")
@@ -0,0 +1,76 @@
+import logging
+from collections.abc import Callable
+
+import cv2
+import numpy as np
+from lib.frame_pipeline import Frame, FrameConsumer, Roi, VideoInfo, crop
+
+logger = logging.getLogger(__name__)
+
+# Frames are compared at this width, enough to see players moving and cheap to diff
+MOTION_FRAME_WIDTH = 160
+# Per pixel grey level change that counts as motion rather than compression noise
+PIXEL_CHANGE_THRESHOLD = 15
+
+
+class MotionGate(FrameConsumer):
+    """
+    Marks frames where nothing moves as static, so the detection models can skip them.
+
+    Every frame is compared with the previous one on a small greyscale copy, the motion energy is the share of
+    pixels that changed. Once it stays below `threshold` for `min_static_sec`, the following frames are marked
+    with `Frame.static` until motion comes back. Has to be registered before the consumers that look at the flag.
+    """
+
+    def __init__(self, threshold: float, min_static_sec: float = 1.0, roi: Callable[[], Roi | None] | None = None):
+        """
+        Args:
+            threshold: share of changed pixels (0..1) below which a frame counts as still
+            min_static_sec: how long the video has to stay still before frames are gated
+            roi: provides the region motion is measured in, e.g. the court
+        """
+        self.threshold = threshold
+        self.min_static_sec = min_static_sec
+        self.roi = roi
+
+        self.min_static_frames = 1
+        self.frames_seen = 0
+        self.frames_gated = 0
+
+        self._previous: np.ndarray | None = None
+        self._previous_roi: Roi | None = None
+        self._still_frames = 0
+
+    def on_start(self, info: VideoInfo) -> None:
+        self.min_static_frames = max(1, round(self.min_static_sec * info.fps))
+
+    def on_frame(self, frame: Frame) -> None:
+        self.frames_seen += 1
+
+        roi = self.roi() if self.roi else None
+        image = crop(frame.image, roi)
+        height, width = image.shape[:2]
+        small = cv2.resize(
+            image,
+            (MOTION_FRAME_WIDTH, max(1, round(height * MOTION_FRAME_WIDTH / width))),
+            interpolation=cv2.INTER_AREA,
+        )
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        # The very first frame and a moved region have nothing to compare with
+        if self._previous is not None and roi == self._previous_roi:
+            energy = np.count_nonzero(cv2.absdiff(small, self._previous) > PIXEL_CHANGE_THRESHOLD) / small.size
+            self._still_frames = self._still_frames + 1 if energy < self.threshold else 0
+        else:
+            self._still_frames = 0
+
+        self._previous = small
+        self._previous_roi = roi
+
+        if self._still_frames >= self.min_static_frames:
+            frame.static = True
+            self.frames_gated += 1
+
+    def on_finish(self) -> None:
+        self._previous = None
+        logger.info(f"Motion gate skipped {self.frames_gated} of {self.frames_seen} frames")
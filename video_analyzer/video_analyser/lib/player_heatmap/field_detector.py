@@ -1,12 +1,12 @@
 from pathlib import Path
 
-import cv2
 import numpy as np
 import torch
-from tqdm import tqdm
+from lib.frame_pipeline import Frame, FrameConsumer, FramePipeline, VideoInfo
+from lib.model_loader import ModelLoader
 from ultralytics import YOLO
 
-model_path = "./models/field_yolo_11s.pt"
+FIELD_MODEL_PATH = "./models/field_yolo_11s.pt"
 
 # Full mapping of feature names to the dataset ids
 feature_map = {
@@ -55,51 +55,51 @@ relevant_features = [
 relevant_feature_ids = [feature_map[x] for x in relevant_features]
 
 
-def detect_field(video_path: Path | str) -> tuple[np.array, tuple[int, int]]:
-    model = YOLO(model_path)
-    # model.to('mps')
+class FieldKeypointSampler(FrameConsumer):
+    """
+    Samples a handful of frames evenly spread over the video and detects the field keypoints on them.
+    """
 
-    cap = cv2.VideoCapture(str(video_path))
-    if not cap.isOpened():
-        raise RuntimeError("Error: Cannot open video file.")
+    def __init__(self, model, samples: int = 10):
+        self.model = model
+        self.samples = samples
+        self.sampling_rate = 1
+        self.video_dims: tuple[int, int] | None = None
+        self.keypoints = []
 
-    video_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    video_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    def on_start(self, info: VideoInfo) -> None:
+        self.video_dims = (info.width, info.height)
+        self.sampling_rate = max(1, info.total_frames // self.samples)  # Adjust this value as needed
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    sampling_rate = max(1, total_frames // 10)  # Adjust this value as needed
+    def on_frame(self, frame: Frame) -> None:
+        if frame.number % self.sampling_rate != 0:
+            return
 
-    keypoints = []
+        # results = model.predict(frame, imgsz=640, conf=0.5)
+        results = self.model.predict(frame.image, conf=0.5, verbose=False)
 
-    with tqdm(total=total_frames, desc="Processing video frames") as pbar:
-        # Read and display the video frame by frame
-        while cap.isOpened():
-            ret, frame_orig = cap.read()
-            if not ret:
-                print("End of video or cannot read frame.")
-                break
+        prediction = results[0]
 
-            frame_number = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
-            if frame_number % sampling_rate != 0:
-                continue
+        features = prediction.keypoints.xyn.squeeze(0)[relevant_feature_ids]
+        self.keypoints.append(features)
 
-            frame = frame_orig
-            # results = model.predict(frame, imgsz=640, conf=0.5)
-            results = model.predict(frame, conf=0.5, verbose=False)
+    def field_points(self) -> np.array:
+        keypoint_sets = [k for k in self.keypoints if len(k) > 0]
 
-            prediction = results[0]
+        if not keypoint_sets:
+            raise ValueError("Failed to detect field")
 
-            features = prediction.keypoints.xyn.squeeze(0)[relevant_feature_ids]
-            keypoints.append(features)
+        keypoints_tensor = torch.stack(keypoint_sets)
+        median_values, _ = torch.median(keypoints_tensor, dim=0)
 
-            pbar.update(sampling_rate)
+        return median_values.numpy()
 
-    keypoint_sets = [k for k in keypoints if len(k) > 0]
 
-    if not keypoint_sets:
-        raise ValueError("Failed to detect field")
+def detect_field(video_path: Path | str, model_loader: ModelLoader | None = None) -> tuple[np.array, tuple[int, int]]:
+    model = (model_loader or ModelLoader()).load(YOLO, FIELD_MODEL_PATH)
 
-    keypoints_tensor = torch.stack(keypoint_sets)
-    median_values, _ = torch.median(keypoints_tensor, dim=0)
+    pipeline = FramePipeline(str(video_path))
+    sampler = pipeline.register(FieldKeypointSampler(model))
+    pipeline.run()
 
-    return median_values.numpy(), (video_width, video_height)
+    return sampler.field_points(), sampler.video_dims
@@ -2,14 +2,24 @@ from pathlib import Path
 
 import cv2
 import numpy as np
+from lib.frame_pipeline import Roi
 
-from .field_detector import detect_field
+from .field_detector import FieldKeypointSampler, detect_field
 
 PADDING = 20
 WIDTH = 250
 HEIGHT = 500
 SL_MARGIN = 50
 
+# The court is 10m wide
+UNITS_PER_METER = WIDTH / 10
+
+# A court region covering less of the frame than this comes from a bad field detection, the full frame is used
+MIN_ROI_AREA = 0.1
+# Court regions of consecutive field samples overlapping at least this much (intersection over union) mean the
+# homography has settled, the frames are not cropped before that
+STABLE_ROI_IOU = 0.9
+
 EXPECTED_FIELD_POINTS = (
     np.array(
         [
@@ -66,10 +76,152 @@ def _find_homography(image_dimensions: tuple[int, int], field_points: np.array)
     return homography_matrix, absolute_points
 
 
-def find_homography(file_path: Path | str) -> tuple[np.array, np.array, tuple[int, int]]:
-    field_points_rel, video_dims = detect_field(file_path)
+def homography_from_field_points(
+    field_points_rel: np.array, video_dims: tuple[int, int]
+) -> tuple[np.array, np.array, tuple[int, int]]:
     processing_dimensions = _get_processing_dimensions(*video_dims)
 
     homography_matrix, absolute_points = _find_homography(processing_dimensions, field_points_rel)
 
     return homography_matrix, absolute_points, processing_dimensions
+
+
+def find_homography(file_path: Path | str) -> tuple[np.array, np.array, tuple[int, int]]:
+    field_points_rel, video_dims = detect_field(file_path)
+    return homography_from_field_points(field_points_rel, video_dims)
+
+
+def frame_homography(field_points_rel: np.array, video_dims: tuple[int, int]) -> np.ndarray | None:
+    """
+    Homography from frame pixels to the court plane, homography_from_field_points works in processing dimensions.
+    """
+    homography_matrix, _, processing_dims = homography_from_field_points(field_points_rel, video_dims)
+    if homography_matrix is None:
+        return None
+
+    to_processing = np.diag([processing_dims[0] / video_dims[0], processing_dims[1] / video_dims[1], 1.0])
+    return homography_matrix @ to_processing
+
+
+def court_roi(field_points_rel: np.array, video_dims: tuple[int, int], margin_meters: float) -> Roi | None:
+    """
+    Bounding rectangle of the court, extended by `margin_meters` on every side, in image coordinates.
+    None when the rectangle covers less than MIN_ROI_AREA of the frame.
+    """
+    homography_matrix = frame_homography(field_points_rel, video_dims)
+    if homography_matrix is None:
+        return None
+
+    margin = margin_meters * UNITS_PER_METER
+    court_corners = np.array(
+        [[-margin, -margin], [WIDTH + margin, -margin], [WIDTH + margin, HEIGHT + margin], [-margin, HEIGHT + margin]],
+        dtype=np.float32,
+    )
+    court_corners += PADDING
+
+    image_corners = cv2.perspectiveTransform(court_corners.reshape(-1, 1, 2), np.linalg.inv(homography_matrix))
+    image_corners = image_corners.reshape(-1, 2)
+
+    video_width, video_height = video_dims
+    x1, y1 = np.clip(np.floor(image_corners.min(axis=0)), 0, None).astype(int)
+    x2 = int(min(np.ceil(image_corners[:, 0].max()), video_width))
+    y2 = int(min(np.ceil(image_corners[:, 1].max()), video_height))
+
+    if x2 <= x1 or y2 <= y1 or (x2 - x1) * (y2 - y1) < MIN_ROI_AREA * video_width * video_height:
+        return None
+
+    return int(x1), int(y1), x2, y2
+
+
+def _roi_iou(a: Roi, b: Roi) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union
+
+
+class CourtRoi:
+    """
+    Follows the field sampler during the decode pass and provides the court region for cropping the frames
+    before inference. The region is recomputed on every field sample and only used once two consecutive samples
+    agree on it, until then (or whenever they disagree again) the frames are not cropped.
+
+    With `to_top` the region reaches the top of the frame, for the ball which flies above the court and its walls.
+    """
+
+    def __init__(self, field_sampler: FieldKeypointSampler, margin_meters: float, to_top: bool = False):
+        self.field_sampler = field_sampler
+        self.margin_meters = margin_meters
+        self.to_top = to_top
+        self._samples = 0
+        self._candidate: Roi | None = None
+        self._roi: Roi | None = None
+
+    def __call__(self) -> Roi | None:
+        if len(self.field_sampler.keypoints) != self._samples:
+            self._samples = len(self.field_sampler.keypoints)
+            try:
+                candidate = court_roi(
+                    self.field_sampler.field_points(), self.field_sampler.video_dims, self.margin_meters
+                )
+            except (ValueError, cv2.error, np.linalg.LinAlgError):
+                # Not enough of the field is visible yet
+                candidate = None
+
+            stable = (
+                candidate is not None
+                and self._candidate is not None
+                and _roi_iou(candidate, self._candidate) >= STABLE_ROI_IOU
+            )
+            self._roi = candidate if stable else None
+            self._candidate = candidate
+
+        if self._roi is not None and self.to_top:
+            x1, _, x2, y2 = self._roi
+            return x1, 0, x2, y2
+        return self._roi
+
+
+# Sides of the net, the near side is the one closest to the camera
+NEAR_SIDE = 0
+FAR_SIDE = 1
+
+
+class CourtSide:
+    """
+    Follows the field sampler during the decode pass and tells on which side of the net image points are.
+    It knows nothing (returns None) until enough of the field has been seen for a homography.
+    """
+
+    def __init__(self, field_sampler: FieldKeypointSampler):
+        self.field_sampler = field_sampler
+        self._samples = 0
+        self._homography: np.ndarray | None = None
+
+    def __call__(self, points: np.ndarray) -> np.ndarray | None:
+        """
+        Args:
+            points: N x 2 image points
+
+        Returns:
+            NEAR_SIDE or FAR_SIDE for every point
+        """
+        if len(self.field_sampler.keypoints) != self._samples:
+            self._samples = len(self.field_sampler.keypoints)
+            try:
+                self._homography = frame_homography(self.field_sampler.field_points(), self.field_sampler.video_dims)
+            except (ValueError, cv2.error):
+                # Not enough of the field is visible yet, keep the previous homography
+                pass
+
+        if self._homography is None:
+            return None
+
+        court_points = cv2.perspectiveTransform(
+            np.asarray(points, dtype=np.float32).reshape(-1, 1, 2), self._homography
+        ).reshape(-1, 2)
+        return np.where(court_points[:, 1] > PADDING + HEIGHT / 2, NEAR_SIDE, FAR_SIDE)
@@ -1,126 +1,168 @@
 import logging
-from collections import defaultdict
+from collections.abc import Callable
 
 import cv2
 import numpy as np
-from tqdm.auto import tqdm
-from ultralytics import RTDETR
+from lib.frame_pipeline import BatchedFrameConsumer, Frame, FramePipeline, Roi, VideoInfo, crop
+from lib.model_loader import ModelLoader
+from lib.motion_gate import MotionGate
+from ultralytics import RTDETR, YOLO
 
-from .find_homography import find_homography
+from .field_detector import FIELD_MODEL_PATH, FieldKeypointSampler
+from .find_homography import CourtSide, homography_from_field_points
 from .player_tracker import PlayerTracker
+from .track_store import TrackStore
 
 logger = logging.getLogger(__name__)
 
 PLAYER_MODEL_PATH = "./models/player_rtdetr.pt"
 
-
-def _filter_tracks(xs):
-    known_idx = {}
-    mappings = {}
-    filtered_dets = []
-
-    for entry in xs:
-        frame_n = entry["frame"]
-        dets = {mappings.get(x, x): y for x, y in entry.items() if x != "frame"}
-        dets = {k: v for k, v in dets.items() if k is not None}
-
-        new_dets = set(dets.keys()) - set(known_idx.keys())
-        if len(known_idx) + len(new_dets) == 4:
-            for d in new_dets:
-                known_idx[d] = d
-
-        elif len(new_dets) == 1:
-            current_key = next(iter(new_dets))
-
-            known_key_to_map = set(known_idx.keys()) - set(dets.keys())
-            if known_key_to_map:
-                known_key = next(iter(known_key_to_map))
-
-                mappings[current_key] = known_key
+# Padel is played two against two
+NUM_PLAYERS = 4
+
+
+def _to_full_frame(result, frame: Frame, roi: Roi) -> None:
+    """
+    Moves the boxes detected on a cropped frame back to the full frame coordinates.
+    """
+    x1, y1, _, _ = roi
+    boxes = result.boxes.data.clone()
+    boxes[:, [0, 2]] += x1
+    boxes[:, [1, 3]] += y1
+
+    result.orig_img = frame.image
+    result.orig_shape = frame.image.shape[:2]
+    result.update(boxes=boxes)
+
+
+class PlayerPositionCollector(BatchedFrameConsumer):
+    """
+    Detects and tracks the players on every frame, keeping their image-space foot positions.
+
+    The positions are projected onto the court only once the field homography is known,
+    which lets the tracking run in the same decode pass as the field detection.
+    """
+
+    def __init__(
+        self,
+        model,
+        batch_size: int = 1,
+        roi: Callable[[], Roi | None] | None = None,
+        court_side: Callable[[np.ndarray], np.ndarray | None] | None = None,
+    ):
+        """
+        Args:
+            model: player detection model
+            batch_size: number of frames per predict call
+            roi: provides the region the detection is restricted to, the frames are cropped to it
+            court_side: tells the side of the net of image points, helps to give a lost player their ID back
+        """
+        super().__init__(batch_size)
+        self.model = model
+        self.roi = roi
+        self.tracker = PlayerTracker(
+            det_thresh=0.5,
+            max_age=60 * 30,
+            min_hits=3,
+            iou_threshold=0.3,
+            delta_t=3,
+            asso_func="giou",
+            inertia=0.2,
+            use_byte=True,
+            num_players=NUM_PLAYERS,
+            court_side=court_side,
+        )
+        # Image-space foot positions until build_tracks projects them onto the court
+        self.positions = TrackStore()
+        self._last_players: list[tuple[int, int, int]] = []
+
+    def on_start(self, info: VideoInfo) -> None:
+        # Room for every player on every frame, so the store never has to grow
+        self.positions = TrackStore(capacity=max(1, info.total_frames) * NUM_PLAYERS)
+
+    def on_batch(self, frames: list[Frame]) -> None:
+        roi = self.roi() if self.roi else None
+        moving = [frame for frame in frames if not frame.static]
+        images = [crop(frame.image, roi) for frame in moving]
+        results = self.model.predict(images, conf=0.5, verbose=False, classes=[2]) if images else []
+        results = dict(zip([frame.number for frame in moving], results, strict=True))
+
+        rows = []
+        # Results come back in the order of the frames, so the tracker still sees them one by one in sequence
+        for frame in frames:
+            result = results.get(frame.number)
+            if result is None:
+                # Nothing moved, the players are where they were on the previous frame
+                self.tracker.update_empty()
             else:
-                mappings[current_key] = None
-
-            dets = {mappings.get(x, x): y for x, y in entry.items() if x != "frame"}
-            dets = {k: v for k, v in dets.items() if k is not None}
-
-        else:
-            print(f"{frame_n} -> {new_dets}")
-            assert False, "Not implemented"
-
-        dets["frame"] = frame_n
-        filtered_dets.append(dets)
-    return filtered_dets
-
-
-def get_heatmap(media_url: str):
+                if roi is not None:
+                    _to_full_frame(result, frame, roi)
+
+                self._last_players = [
+                    (
+                        track.id,
+                        int(track.x1 + (track.x2 - track.x1) / 2),
+                        int(track.y2 - (track.y2 - track.y1) * 0.1),
+                    )
+                    for track in self.tracker.update(result)
+                ]
+
+            rows.extend((frame.number, *player) for player in self._last_players)
+
+        self.positions.append(rows)
+
+    def build_tracks(self, homography_matrix: np.array) -> TrackStore:
+        """
+        Projects the collected positions onto the court in place, all of them in a single transform.
+        """
+        tracks = self.positions
+        if len(tracks) == 0:
+            return tracks
+
+        foot_points = np.stack((tracks.x, tracks.y), axis=1).astype(np.float32).reshape(-1, 1, 2)
+        court_points = cv2.perspectiveTransform(foot_points, homography_matrix).reshape(-1, 2)
+
+        # Points near the horizon of a degenerate homography project to huge values, or NaN and inf. The ones that
+        # have no position at all are dropped, the others are clipped to the integer columns and the heatmaps put
+        # them on the closest edge like any other position off the court.
+        projected = np.isfinite(court_points).all(axis=1)
+        if not projected.all():
+            logger.warning(f"Dropping {len(projected) - projected.sum()} positions without a finite court projection")
+            tracks.keep(projected)
+            court_points = court_points[projected]
+
+        limits = np.iinfo(tracks.x.dtype)
+        court_points = np.clip(court_points.astype(np.float64), limits.min, limits.max)
+        tracks.x[:] = court_points[:, 0]
+        tracks.y[:] = court_points[:, 1]
+
+        return tracks
+
+
+def get_heatmap(
+    media_url: str,
+    batch_size: int = 1,
+    model_loader: ModelLoader | None = None,
+    motion_threshold: float | None = None,
+):
     logger.info("Preparing media heatmap")
 
-    logger.info("Getting field homography")
-    homography_matrix, field_points, video_dims = find_homography(media_url)
-
-    logger.info("Processing player positions and building tracks")
-
-    model = RTDETR(PLAYER_MODEL_PATH)
-    _ = model.to("cuda")
-
-    tracker = PlayerTracker(
-        det_thresh=0.5,
-        max_age=60 * 30,
-        min_hits=3,
-        iou_threshold=0.3,
-        delta_t=3,
-        asso_func="giou",
-        inertia=0.2,
-        use_byte=True,
-    )
-
-    cap = cv2.VideoCapture(media_url)
-    if not cap.isOpened():
-        raise ValueError(f"Failed to open video stream from {media_url}")
-
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-
-    logger.info(f"Video dimensions: w={frame_width}, h={frame_height}, fps={fps}, frames={total_frames}")
-
-    track_history = defaultdict(list)
-
-    detection_history = []
-
-    with tqdm(total=total_frames, desc="Detecting player positions") as progress_bar:
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                print("End of video or cannot read frame.")
-                break
-
-            frame_number = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    model_loader = model_loader or ModelLoader()
+    model = model_loader.load(RTDETR, PLAYER_MODEL_PATH)
 
-            results = model.predict(frame, conf=0.5, verbose=False, classes=[2])  # Only getting players
-
-            result = results[0]
-            tracked_players = tracker.update(result)
-
-            detections = {"frame": frame_number}
-
-            for track in tracked_players:
-                estimated_player_coord = (
-                    int(track.x1 + (track.x2 - track.x1) / 2),
-                    int(track.y2 - (track.y2 - track.y1) * 0.1),
-                )
-                transformed_player_coord = cv2.perspectiveTransform(
-                    np.array([estimated_player_coord], dtype=np.float32).reshape(-1, 1, 2), homography_matrix
-                )
-                track_history[track.id].append(
-                    (int(transformed_player_coord[0, 0, 0]), int(transformed_player_coord[0, 0, 1]))
-                )
-
-                detections[track.id] = (int(transformed_player_coord[0, 0, 0]), int(transformed_player_coord[0, 0, 1]))
+    pipeline = FramePipeline(media_url)
+    if motion_threshold is not None:
+        pipeline.register(MotionGate(motion_threshold))
+    field_sampler = pipeline.register(FieldKeypointSampler(model_loader.load(YOLO, FIELD_MODEL_PATH)))
+    players = pipeline.register(
+        PlayerPositionCollector(model, batch_size=batch_size, court_side=CourtSide(field_sampler))
+    )
 
-            detection_history.append(detections)
+    logger.info("Processing field and player positions")
+    pipeline.run()
 
-            progress_bar.update(1)
+    logger.info("Getting field homography")
+    homography_matrix, _, _ = homography_from_field_points(field_sampler.field_points(), field_sampler.video_dims)
 
-    return _filter_tracks(detection_history)
+    logger.info("Building player tracks")
+    return players.build_tracks(homography_matrix)
@@ -1,7 +1,9 @@
 import time
+from collections.abc import Callable
 from dataclasses import dataclass
 
 import numpy as np
+from lib.tracker.association import linear_assignment
 from lib.tracker.ocsort import OCSort
 
 
@@ -32,6 +34,8 @@ class PlayerTracker:
         asso_func="giou",
         inertia=0.15,
         use_byte=True,
+        num_players: int | None = None,
+        court_side: Callable[[np.ndarray], np.ndarray | None] | None = None,
     ):
         """
         Args:
@@ -43,6 +47,9 @@ class PlayerTracker:
             asso_func: Association metric: "iou", "giou", or "ciou"
             inertia: Motion inertia coefficient (lower for more responsive tracking)
             use_byte: Use ByteTrack association strategy
+            num_players: Number of players on the court, when set the tracks are mapped onto that many
+                persistent player IDs (1..num_players) and no other ID is ever reported
+            court_side: Tells the side of the net of image points, players are expected to stay on their side
         """
         self.tracker = OCSort(
             det_thresh=det_thresh,
@@ -63,6 +70,12 @@ class PlayerTracker:
         self.prev_track_count = 0
         self.debug_mode = False
 
+        self.num_players = num_players
+        self.court_side = court_side
+        self._track_players: dict[int, int] = {}  # OCSort track id -> player id
+        self._player_tracks: dict[int, int] = {}  # player id -> OCSort track id
+        self._player_locations: dict[int, tuple[int, int]] = {}
+
     def _convert_detections(self, detections):
         """
         Convert different detection formats to OC-SORT compatible format.
@@ -168,6 +181,15 @@ class PlayerTracker:
 
         return dets
 
+    def update_empty(self) -> None:
+        """
+        Advance the tracker by a frame that was not sent to the model, the tracks keep their predictions.
+        """
+        self.frame_count += 1
+
+        img_size = self.frame_size if self.frame_size is not None else (1080, 1920)
+        self.tracker.update(np.zeros((0, 5)), img_info=img_size, img_size=img_size)
+
     def update(self, detections, frame=None) -> list[PlayerTrack]:
         """
         Update tracker with new detections.
@@ -255,4 +277,71 @@ class PlayerTracker:
                 )
             )
 
+        if self.num_players is not None:
+            tracked_players = self._assign_players(tracked_players)
+
         return tracked_players
+
+    def _assign_players(self, tracked_players: list[PlayerTrack]) -> list[PlayerTrack]:
+        """
+        Maps the tracks onto the fixed set of player IDs.
+
+        A track keeps the player it got. A new track (a player found again after the tracker lost them, or a
+        player seen for the first time) takes one of the players not seen on this frame: the closest one to
+        where they were last seen, preferably on the same side of the net, and a player ID not given out yet
+        only while that side still has room. Tracks left without a player are not reported.
+        """
+        new_tracks = [track for track in tracked_players if track.id not in self._track_players]
+        if new_tracks:
+            seen = {self._track_players[track.id] for track in tracked_players if track.id in self._track_players}
+            free_players = [p for p in range(1, self.num_players + 1) if p not in seen]
+            self._bind_tracks(new_tracks, free_players)
+
+        players = []
+        for track in tracked_players:
+            player_id = self._track_players.get(track.id)
+            if player_id is None:
+                continue
+            track.id = player_id
+            self._player_locations[player_id] = track.loc
+            players.append(track)
+
+        return players
+
+    def _bind_tracks(self, new_tracks: list[PlayerTrack], free_players: list[int]) -> None:
+        if not free_players:
+            return
+
+        known_players = list(self._player_locations)
+        locations = np.array([track.loc for track in new_tracks], dtype=float)
+        known_locations = np.array([self._player_locations[p] for p in known_players], dtype=float).reshape(-1, 2)
+
+        sides = self.court_side(np.vstack((locations, known_locations))) if self.court_side is not None else None
+        if sides is not None:
+            player_sides = dict(zip(known_players, sides[len(new_tracks) :].tolist(), strict=True))
+            sides = sides[: len(new_tracks)]
+            # A player not seen yet is only expected on a side that is not full
+            side_counts = np.bincount(np.array(list(player_sides.values()), dtype=int), minlength=2)
+            full_sides = side_counts >= self.num_players // 2
+
+        # Any distance on the frame is cheaper than changing sides
+        h, w = self.frame_size if self.frame_size is not None else (1080, 1920)
+        side_penalty = float(np.hypot(h, w))
+
+        cost = np.zeros((len(new_tracks), len(free_players)))
+        for j, player_id in enumerate(free_players):
+            if player_id in self._player_locations:
+                cost[:, j] = np.hypot(*(locations - self._player_locations[player_id]).T)
+                if sides is not None:
+                    cost[:, j] += np.where(sides != player_sides[player_id], side_penalty, 0.0)
+            elif sides is not None:
+                cost[:, j] = np.where(full_sides[sides], side_penalty, 0.0)
+
+        for row, col in linear_assignment(cost):
+            track_id, player_id = new_tracks[row].id, free_players[col]
+            previous_track = self._player_tracks.get(player_id)
+            if previous_track is not None:
+                del self._track_players[previous_track]
+
+            self._track_players[track_id] = player_id
+            self._player_tracks[player_id] = track_id
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class TrackStore:
+    """
+    Player positions of a whole video as columns of frame, player id, x and y.
+
+    Positions are appended in frame order, so the frame column stays sorted and the positions of a frame range
+    are found with a binary search. The columns are preallocated for `capacity` positions and double when full.
+    """
+
+    _COLUMNS = {"_frame": np.int32, "_player_id": np.int16, "_x": np.int32, "_y": np.int32}
+
+    def __init__(self, capacity: int = 4096):
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        for name, dtype in self._COLUMNS.items():
+            column = np.zeros(capacity, dtype=dtype)
+            if self.size:
+                column[: self.size] = getattr(self, name)[: self.size]
+            setattr(self, name, column)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def frame(self) -> np.ndarray:
+        return self._frame[: self.size]
+
+    @property
+    def player_id(self) -> np.ndarray:
+        return self._player_id[: self.size]
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._x[: self.size]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._y[: self.size]
+
+    def append(self, rows: list[tuple[int, int, int, int]]) -> None:
+        """
+        Args:
+            rows: (frame, player_id, x, y) positions, in frame order and not before the ones already stored
+        """
+        if not rows:
+            return
+
+        columns = np.array(rows, dtype=np.int64).T
+        frames = columns[0]
+        if (self.size and frames[0] < self._frame[self.size - 1]) or np.any(np.diff(frames) < 0):
+            raise ValueError("Positions have to be appended in frame order")
+
+        end = self.size + len(rows)
+        if end > len(self._frame):
+            self._allocate(max(end, 2 * len(self._frame)))
+
+        for name, column in zip(self._COLUMNS, columns, strict=True):
+            getattr(self, name)[self.size : end] = column
+        self.size = end
+
+    def keep(self, mask: np.ndarray) -> None:
+        """
+        Drops the positions where `mask` is False, the others keep their order.
+        """
+        kept = int(np.count_nonzero(mask))
+        for name in self._COLUMNS:
+            column = getattr(self, name)
+            column[:kept] = column[: self.size][mask]
+        self.size = kept
+
+    def between(self, start_frame: int, end_frame: int) -> slice:
+        """
+        Rows of the positions from `start_frame` to `end_frame`, both included.
+        """
+        frames = self.frame
+        # Searching with the column's own type, anything else makes numpy convert the whole column first
+        start = np.searchsorted(frames, frames.dtype.type(start_frame), side="left")
+        end = np.searchsorted(frames, frames.dtype.type(end_frame), side="right")
+        return slice(int(start), int(end))
+
+    def player_ids(self) -> np.ndarray:
+        return np.unique(self.player_id)
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 
 
 def iou_batch(bboxes1, bboxes2):
@@ -198,16 +199,60 @@ def speed_direction_batch(dets, tracks):
 
 
 def linear_assignment(cost_matrix):
-    try:
-        import lap
+    """
+    [row, col] pairs of the cheapest assignment, in row order.
+
+    scipy's solver is used as is: on the matrices of a padel match (a handful of tracks against a handful of
+    detections) it takes about a microsecond, less than lap or a greedy / brute-force pass in numpy would
+    (see `benchmarks.py assignment`).
+    """
+    return np.array(linear_sum_assignment(cost_matrix)).T
+
+
+def velocity_direction_cost(detections, velocities, previous_obs, vdc_weight):
+    """
+    Cost from the velocity direction consistency (num_det x num_track): how well the direction from a track's
+    previous observation to a detection agrees with the track's velocity, weighted by the detection score.
+    Tracks without a previous observation get no cost.
+    """
+    Y, X = speed_direction_batch(detections, previous_obs)
+    inertia_Y, inertia_X = velocities[:, 0, np.newaxis], velocities[:, 1, np.newaxis]
+    diff_angle_cos = inertia_X * X + inertia_Y * Y
+    diff_angle_cos = np.clip(diff_angle_cos, a_min=-1, a_max=1)
+    diff_angle = np.arccos(diff_angle_cos)
+    diff_angle = (np.pi / 2.0 - np.abs(diff_angle)) / np.pi
+
+    valid_mask = np.where(previous_obs[:, 4] < 0, 0.0, 1.0)[:, np.newaxis]
+
+    angle_diff_cost = (valid_mask * diff_angle) * vdc_weight
+    return angle_diff_cost.T * detections[:, -1, np.newaxis]
+
+
+def category_cost(det_cates, trk_cates):
+    """
+    With multiple categories, the cost (num_det x num_track) that keeps detections and tracks of different
+    categories apart: -1e6 where they differ, 0 otherwise.
+    """
+    return np.where(np.asarray(det_cates)[:, np.newaxis] != np.asarray(trk_cates)[np.newaxis, :], -1e6, 0.0)
+
+
+def split_matches(matched_indices, iou_matrix, iou_threshold):
+    """
+    Splits the assignment into matches, unmatched detections and unmatched trackers. Matches below the
+    IoU threshold are dropped, their detection and tracker are appended to the unmatched ones in match order.
+    """
+    matched_indices = np.asarray(matched_indices, dtype=int).reshape(-1, 2)
+    num_dets, num_trks = iou_matrix.shape
 
-        _, x, y = lap.lapjv(cost_matrix, extend_cost=True)
-        return np.array([[y[i], i] for i in x if i >= 0])  #
-    except ImportError:
-        from scipy.optimize import linear_sum_assignment
+    unmatched_detections = np.setdiff1d(np.arange(num_dets), matched_indices[:, 0])
+    unmatched_trackers = np.setdiff1d(np.arange(num_trks), matched_indices[:, 1])
+
+    # filter out matched with low IOU
+    low_iou = iou_matrix[matched_indices[:, 0], matched_indices[:, 1]] < iou_threshold
+    unmatched_detections = np.concatenate((unmatched_detections, matched_indices[low_iou, 0]))
+    unmatched_trackers = np.concatenate((unmatched_trackers, matched_indices[low_iou, 1]))
 
-        x, y = linear_sum_assignment(cost_matrix)
-        return np.array(list(zip(x, y, strict=False)))
+    return matched_indices[~low_iou], unmatched_detections, unmatched_trackers
 
 
 def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3):
@@ -229,55 +274,17 @@ def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3):
     else:
         matched_indices = np.empty(shape=(0, 2))
 
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if d not in matched_indices[:, 0]:
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if t not in matched_indices[:, 1]:
-            unmatched_trackers.append(t)
-
-    # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if iou_matrix[m[0], m[1]] < iou_threshold:
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if len(matches) == 0:
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
-
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+    return split_matches(matched_indices, iou_matrix, iou_threshold)
 
 
 def associate(detections, trackers, iou_threshold, velocities, previous_obs, vdc_weight):
     if len(trackers) == 0:
         return np.empty((0, 2), dtype=int), np.arange(len(detections)), np.empty((0, 5), dtype=int)
 
-    Y, X = speed_direction_batch(detections, previous_obs)
-    inertia_Y, inertia_X = velocities[:, 0], velocities[:, 1]
-    inertia_Y = np.repeat(inertia_Y[:, np.newaxis], Y.shape[1], axis=1)
-    inertia_X = np.repeat(inertia_X[:, np.newaxis], X.shape[1], axis=1)
-    diff_angle_cos = inertia_X * X + inertia_Y * Y
-    diff_angle_cos = np.clip(diff_angle_cos, a_min=-1, a_max=1)
-    diff_angle = np.arccos(diff_angle_cos)
-    diff_angle = (np.pi / 2.0 - np.abs(diff_angle)) / np.pi
-
-    valid_mask = np.ones(previous_obs.shape[0])
-    valid_mask[np.where(previous_obs[:, 4] < 0)] = 0
+    angle_diff_cost = velocity_direction_cost(detections, velocities, previous_obs, vdc_weight)
 
     iou_matrix = iou_batch(detections, trackers)
-    scores = np.repeat(detections[:, -1][:, np.newaxis], trackers.shape[0], axis=1)
     # iou_matrix = iou_matrix * scores # a trick sometiems works, we don't encourage this
-    valid_mask = np.repeat(valid_mask[:, np.newaxis], X.shape[1], axis=1)
-
-    angle_diff_cost = (valid_mask * diff_angle) * vdc_weight
-    angle_diff_cost = angle_diff_cost.T
-    angle_diff_cost = angle_diff_cost * scores
 
     if min(iou_matrix.shape) > 0:
         a = (iou_matrix > iou_threshold).astype(np.int32)
@@ -288,29 +295,7 @@ def associate(detections, trackers, iou_threshold, velocities, previous_obs, vdc
     else:
         matched_indices = np.empty(shape=(0, 2))
 
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if d not in matched_indices[:, 0]:
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if t not in matched_indices[:, 1]:
-            unmatched_trackers.append(t)
-
-    # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if iou_matrix[m[0], m[1]] < iou_threshold:
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if len(matches) == 0:
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
-
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+    return split_matches(matched_indices, iou_matrix, iou_threshold)
 
 
 def associate_kitti(detections, trackers, det_cates, iou_threshold, velocities, previous_obs, vdc_weight):
@@ -320,23 +305,7 @@ def associate_kitti(detections, trackers, det_cates, iou_threshold, velocities,
     """
         Cost from the velocity direction consistency
     """
-    Y, X = speed_direction_batch(detections, previous_obs)
-    inertia_Y, inertia_X = velocities[:, 0], velocities[:, 1]
-    inertia_Y = np.repeat(inertia_Y[:, np.newaxis], Y.shape[1], axis=1)
-    inertia_X = np.repeat(inertia_X[:, np.newaxis], X.shape[1], axis=1)
-    diff_angle_cos = inertia_X * X + inertia_Y * Y
-    diff_angle_cos = np.clip(diff_angle_cos, a_min=-1, a_max=1)
-    diff_angle = np.arccos(diff_angle_cos)
-    diff_angle = (np.pi / 2.0 - np.abs(diff_angle)) / np.pi
-
-    valid_mask = np.ones(previous_obs.shape[0])
-    valid_mask[np.where(previous_obs[:, 4] < 0)] = 0
-    valid_mask = np.repeat(valid_mask[:, np.newaxis], X.shape[1], axis=1)
-
-    scores = np.repeat(detections[:, -1][:, np.newaxis], trackers.shape[0], axis=1)
-    angle_diff_cost = (valid_mask * diff_angle) * vdc_weight
-    angle_diff_cost = angle_diff_cost.T
-    angle_diff_cost = angle_diff_cost * scores
+    angle_diff_cost = velocity_direction_cost(detections, velocities, previous_obs, vdc_weight)
 
     """
         Cost from IoU
@@ -346,13 +315,7 @@ def associate_kitti(detections, trackers, det_cates, iou_threshold, velocities,
     """
         With multiple categories, generate the cost for catgory mismatch
     """
-    num_dets = detections.shape[0]
-    num_trk = trackers.shape[0]
-    cate_matrix = np.zeros((num_dets, num_trk))
-    for i in range(num_dets):
-        for j in range(num_trk):
-            if det_cates[i] != trackers[j, 4]:
-                cate_matrix[i][j] = -1e6
+    cate_matrix = category_cost(det_cates, trackers[:, 4])
 
     cost_matrix = -iou_matrix - angle_diff_cost - cate_matrix
 
@@ -365,26 +328,4 @@ def associate_kitti(detections, trackers, det_cates, iou_threshold, velocities,
     else:
         matched_indices = np.empty(shape=(0, 2))
 
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if d not in matched_indices[:, 0]:
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if t not in matched_indices[:, 1]:
-            unmatched_trackers.append(t)
-
-    # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if iou_matrix[m[0], m[1]] < iou_threshold:
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if len(matches) == 0:
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
-
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+    return split_matches(matched_indices, iou_matrix, iou_threshold)
@@ -0,0 +1,209 @@
+"""
+Kalman filters of all the tracks stacked into contiguous arrays, so OCSort runs predict and update once per
+frame for every track instead of once per track. It follows KalmanFilterNew step by step, including the
+observation-centric re-update (ORU) of a track that was lost, so the tracks come out the same.
+"""
+
+import numpy as np
+
+from .kalmanfilter import virtual_trajectory
+
+# What a row got since the last apply_updates()
+_NO_UPDATE = 0
+_MISSED = 1  # update(None)
+_OBSERVED = 2
+
+
+class TrackFilter:
+    """
+    A single track's row of a BatchedKalmanFilter, takes the place of KalmanFilterNew in KalmanBoxTracker.
+
+    Updates are only queued, the batched filter applies them for every track at once.
+    """
+
+    def __init__(self, bank: "BatchedKalmanFilter", row: int):
+        self.bank = bank
+        self.row = row
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.bank.x[self.row]
+
+    @property
+    def P(self) -> np.ndarray:
+        return self.bank.P[self.row]
+
+    def update(self, z: np.ndarray | None) -> None:
+        self.bank.queue_update(self.row, z)
+
+
+class BatchedKalmanFilter:
+    """
+    Holds the state `x` (T x dim_x x 1) and covariance `P` (T x dim_x x dim_x) of T tracks sharing the same
+    model. The measurement function has to observe the first dim_z components of the state.
+    """
+
+    def __init__(self, F, H, Q, R, P0, capacity: int = 16):
+        self.dim_x = F.shape[0]
+        self.dim_z = H.shape[0]
+        if not np.array_equal(H, np.eye(self.dim_z, self.dim_x)):
+            raise ValueError("Only measurement functions observing the first dim_z state components are supported")
+
+        self.F = np.asarray(F, dtype=float)
+        self.H = np.asarray(H, dtype=float)
+        self.Q = np.asarray(Q, dtype=float)
+        self.R = np.asarray(R, dtype=float)
+        self.P0 = np.asarray(P0, dtype=float)
+        self._I = np.eye(self.dim_x)
+
+        self.size = 0
+        self.filters: list[TrackFilter] = []
+        self._allocate(capacity)
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._x[: self.size]
+
+    @property
+    def P(self) -> np.ndarray:
+        return self._P[: self.size]
+
+    def _allocate(self, capacity: int) -> None:
+        arrays = {
+            "_x": np.zeros((capacity, self.dim_x, 1)),
+            "_P": np.zeros((capacity, self.dim_x, self.dim_x)),
+            # x and P when the track lost its observation, the re-update starts from there
+            "_saved_x": np.zeros((capacity, self.dim_x, 1)),
+            "_saved_P": np.zeros((capacity, self.dim_x, self.dim_x)),
+            "_frozen": np.zeros(capacity, dtype=bool),
+            "_observed": np.zeros(capacity, dtype=bool),
+            # last observation and the number of updates since, the ends of the virtual trajectory
+            "_last_z": np.zeros((capacity, self.dim_z, 1)),
+            "_steps": np.zeros(capacity, dtype=int),
+            # queued updates
+            "_z": np.zeros((capacity, self.dim_z, 1)),
+            "_pending": np.zeros(capacity, dtype=np.int8),
+        }
+        for name, array in arrays.items():
+            if self.size:
+                array[: self.size] = getattr(self, name)[: self.size]
+            setattr(self, name, array)
+
+    def add(self, z: np.ndarray) -> TrackFilter:
+        """
+        Starts a new track at measurement `z`, its velocities are unknown.
+        """
+        if self.size == len(self._x):
+            self._allocate(2 * len(self._x))
+
+        row = self.size
+        self._x[row] = 0.0
+        self._x[row, : self.dim_z] = z
+        self._P[row] = self.P0
+        self._frozen[row] = False
+        self._observed[row] = False
+        self._steps[row] = 0
+        self._pending[row] = _NO_UPDATE
+        self.size += 1
+
+        track_filter = TrackFilter(self, row)
+        self.filters.append(track_filter)
+        return track_filter
+
+    def remove(self, track_filter: TrackFilter) -> None:
+        row = track_filter.row
+        for name in ("_x", "_P", "_saved_x", "_saved_P", "_frozen", "_observed", "_last_z", "_steps", "_z", "_pending"):
+            array = getattr(self, name)
+            array[row : self.size - 1] = array[row + 1 : self.size]
+
+        self.filters.pop(row)
+        for later in self.filters[row:]:
+            later.row -= 1
+        self.size -= 1
+
+    def predict(self) -> None:
+        self._predict(slice(0, self.size))
+
+    def queue_update(self, row: int, z: np.ndarray | None) -> None:
+        if z is None:
+            self._pending[row] = _MISSED
+        else:
+            self._z[row] = np.reshape(z, (self.dim_z, 1))
+            self._pending[row] = _OBSERVED
+
+    def apply_updates(self) -> None:
+        """
+        Applies the updates queued since the last call, tracks without one are left as they are.
+        """
+        pending = self._pending[: self.size]
+        missed = np.flatnonzero(pending == _MISSED)
+        observed = np.flatnonzero(pending == _OBSERVED)
+
+        # Got no observation, keep the state for the re-update once the track is found again
+        freeze = missed[self._observed[missed]]
+        self._saved_x[freeze] = self._x[freeze]
+        self._saved_P[freeze] = self._P[freeze]
+        self._frozen[freeze] = True
+        self._observed[missed] = False
+        self._steps[missed] += 1
+
+        last_z = self._z[observed]
+        recovered = np.flatnonzero(~self._observed[observed] & self._frozen[observed])
+        if len(recovered):
+            last_z[recovered] = self._reupdate(observed[recovered])
+
+        self._update(observed, self._z[observed])
+        self._observed[observed] = True
+        self._frozen[observed] = False
+        self._steps[observed] = 0
+        self._last_z[observed] = last_z
+
+        pending[:] = _NO_UPDATE
+
+    def _reupdate(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Observation-centric re-update: goes back to the state at the time the tracks were lost and updates them
+        along a linear trajectory between the last two observations. All the tracks found again in the same
+        frame step through their trajectories together. Returns the last box of every trajectory.
+        """
+        time_gaps = self._steps[rows] + 1
+        trajectories = np.zeros((len(rows), time_gaps.max(), self.dim_z, 1))
+        for idx, row in enumerate(rows):
+            trajectories[idx, : time_gaps[idx]] = virtual_trajectory(self._last_z[row], self._z[row], time_gaps[idx])
+
+        self._x[rows] = self._saved_x[rows]
+        self._P[rows] = self._saved_P[rows]
+
+        for i in range(time_gaps.max()):
+            active = time_gaps > i
+            self._update(rows[active], trajectories[active, i])
+            self._predict(rows[time_gaps > i + 1])
+
+        return trajectories[np.arange(len(rows)), time_gaps - 1]
+
+    def _predict(self, rows) -> None:
+        # x = Fx, P = FPF' + Q
+        self._x[rows] = self.F @ self._x[rows]
+        self._P[rows] = self.F @ self._P[rows] @ self.F.T + self.Q
+
+    def _update(self, rows, z: np.ndarray) -> None:
+        if len(z) == 0:
+            return
+
+        x = self._x[rows]
+        P = self._P[rows]
+
+        # H picks the first dim_z components, so Hx, PH' and HPH' are slices
+        y = z - x[:, : self.dim_z]
+        PHT = P[:, :, : self.dim_z]
+        S = PHT[:, : self.dim_z] + self.R
+        K = PHT @ np.linalg.inv(S)
+
+        x = x + K @ y
+
+        # P = (I-KH)P(I-KH)' + KRK', same as KalmanFilterNew
+        I_KH = self._I - K @ self.H
+        P = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ self.R @ K.transpose(0, 2, 1)
+
+        self._x[rows] = x
+        self._P[rows] = P
@@ -94,6 +94,7 @@ Copyright 2014-2018 Roger R Labbe Jr.
 """
 
 import sys
+from collections import deque
 from copy import deepcopy
 from math import exp, log, sqrt
 
@@ -104,6 +105,28 @@ from filterpy.stats import logpdf
 from numpy import dot, eye, isscalar, shape, zeros
 
 
+def virtual_trajectory(z1, z2, time_gap):
+    """
+    Virtual observations [x, y, s, r] of the observation-centric re-update: the box moves at constant speed
+    from observation z1 to z2 over time_gap steps. Returns the boxes after z1 up to z2 as (time_gap, 4, 1).
+    """
+    x1, y1, s1, r1 = np.ravel(z1)
+    w1 = np.sqrt(s1 * r1)
+    h1 = np.sqrt(s1 / r1)
+    x2, y2, s2, r2 = np.ravel(z2)
+    w2 = np.sqrt(s2 * r2)
+    h2 = np.sqrt(s2 / r2)
+    dx = (x2 - x1) / time_gap
+    dy = (y2 - y1) / time_gap
+    dw = (w2 - w1) / time_gap
+    dh = (h2 - h1) / time_gap
+
+    steps = np.arange(1, time_gap + 1)
+    w = w1 + steps * dw
+    h = h1 + steps * dh
+    return np.stack([x1 + steps * dx, y1 + steps * dy, w * h, w / h], axis=1)[:, :, np.newaxis]
+
+
 class KalmanFilterNew:
     """Implements a Kalman filter. You are responsible for setting the
     various state variables to reasonable values; the defaults  will
@@ -325,8 +348,10 @@ class KalmanFilterNew:
         self._likelihood = sys.float_info.min
         self._mahalanobis = None
 
-        # keep all observations
-        self.history_obs = []
+        # number of updates so far and the last two observations as (update index, z), all the
+        # observation-centric re-update needs to rebuild the trajectory over a gap
+        self.obs_count = 0
+        self.recent_obs = deque(maxlen=2)
 
         self.inv = np.linalg.inv
 
@@ -378,53 +403,53 @@ class KalmanFilterNew:
         """
         Save the parameters before non-observation forward
         """
-        self.attr_saved = deepcopy(self.__dict__)
+        # x and P are all the re-update starts from, the observations are kept for the trajectory
+        self.attr_saved = (self.x.copy(), self.P.copy(), tuple(self.recent_obs), self.obs_count)
 
     def unfreeze(self):
         if self.attr_saved is not None:
-            new_history = deepcopy(self.history_obs)
-            self.__dict__ = self.attr_saved
-            # self.history_obs = new_history
-            self.history_obs = self.history_obs[:-1]
-            occur = [int(d is None) for d in new_history]
-            indices = np.where(np.array(occur) == 0)[0]
-            index1 = indices[-2]
-            index2 = indices[-1]
-            box1 = new_history[index1]
-            x1, y1, s1, r1 = box1
-            w1 = np.sqrt(s1 * r1)
-            h1 = np.sqrt(s1 / r1)
-            box2 = new_history[index2]
-            x2, y2, s2, r2 = box2
-            w2 = np.sqrt(s2 * r2)
-            h2 = np.sqrt(s2 / r2)
-            time_gap = index2 - index1
-            dx = (x2 - x1) / time_gap
-            dy = (y2 - y1) / time_gap
-            dw = (w2 - w1) / time_gap
-            dh = (h2 - h1) / time_gap
-            for i in range(index2 - index1):
-                """
-                    The default virtual trajectory generation is by linear
-                    motion (constant speed hypothesis), you could modify this
-                    part to implement your own.
-                """
-                x = x1 + (i + 1) * dx
-                y = y1 + (i + 1) * dy
-                w = w1 + (i + 1) * dw
-                h = h1 + (i + 1) * dh
-                s = w * h
-                r = w / float(h)
-                new_box = np.array([x, y, s, r]).reshape((4, 1))
-                """
-                    I still use predict-update loop here to refresh the parameters,
-                    but this can be faster by directly modifying the internal parameters
-                    as suggested in the paper. I keep this naive but slow way for
-                    easy read and understanding
-                """
-                self.update(new_box)
-                if not i == (index2 - index1 - 1):
-                    self.predict()
+            (index1, box1), (index2, box2) = self.recent_obs
+            x, P, recent_obs, obs_count = self.attr_saved
+            self.attr_saved = None
+
+            self.x = x.copy()
+            self.P = P.copy()
+            self.recent_obs = deque(recent_obs, maxlen=2)
+            # the snapshot was taken after the missed update was counted
+            self.obs_count = obs_count - 1
+            self.observed = True
+
+            """
+                I still use predict-update steps here to refresh the parameters,
+                the virtual observations are generated at once and the steps skip
+                the bookkeeping of the full update and predict
+            """
+            boxes = virtual_trajectory(box1, box2, index2 - index1)
+            for i, new_box in enumerate(boxes):
+                self._reupdate_step(new_box)
+                if not i == len(boxes) - 1:
+                    self._reupdate_predict()
+
+    def _reupdate_step(self, z):
+        # same arithmetic as update() with the default R and H
+        self.recent_obs.append((self.obs_count, z))
+        self.obs_count += 1
+
+        H = self.H
+        R = self.R
+        self.y = z - dot(H, self.x)
+        PHT = dot(self.P, H.T)
+        self.S = dot(H, PHT) + R
+        self.SI = self.inv(self.S)
+        self.K = dot(PHT, self.SI)
+        self.x = self.x + dot(self.K, self.y)
+        I_KH = self._I - dot(self.K, H)
+        self.P = dot(dot(I_KH, self.P), I_KH.T) + dot(dot(self.K, R), self.K.T)
+
+    def _reupdate_predict(self):
+        # same arithmetic as predict() without control input
+        self.x = dot(self.F, self.x)
+        self.P = self._alpha_sq * dot(dot(self.F, self.P), self.F.T) + self.Q
 
     def update(self, z, R=None, H=None):
         """
@@ -452,7 +477,9 @@ class KalmanFilterNew:
         self._mahalanobis = None
 
         # append the observation
-        self.history_obs.append(z)
+        if z is not None:
+            self.recent_obs.append((self.obs_count, z))
+        self.obs_count += 1
 
         if z is None:
             if self.observed:
@@ -2,9 +2,13 @@
 This script is adopted from the SORT script by Alex Bewley alex@bewley.ai
 """
 
+from collections import deque
+
 import numpy as np
 
 from .association import *
+from .batched_kalmanfilter import BatchedKalmanFilter
+from .track_state import ObservationWindow, TrackStates
 
 
 def k_previous_obs(observations, cur_age, k):
@@ -33,6 +37,16 @@ def convert_bbox_to_z(bbox):
     return np.array([x, y, s, r]).reshape((4, 1))
 
 
+def convert_states_to_bboxes(xs):
+    """
+    Vectorized convert_x_to_bbox for states stacked as (N, 7, 1), returns the boxes as (N, 4)
+    """
+    x, y, s, r = xs[:, 0, 0], xs[:, 1, 0], xs[:, 2, 0], xs[:, 3, 0]
+    w = np.sqrt(s * r)
+    h = s / w
+    return np.stack([x - w / 2.0, y - h / 2.0, x + w / 2.0, y + h / 2.0], axis=1)
+
+
 def convert_x_to_bbox(x, score=None):
     """
     Takes a bounding box in the centre form [x,y,s,r] and returns it in the form
@@ -54,6 +68,35 @@ def speed_direction(bbox1, bbox2):
     return speed / norm
 
 
+def box_filter_model():
+    """
+    Constant velocity model of a box [x,y,s,r] with velocities [vx,vy,vs], returns F, H, Q, R and the initial P
+    """
+    F = np.array(
+        [
+            [1, 0, 0, 0, 1, 0, 0],
+            [0, 1, 0, 0, 0, 1, 0],
+            [0, 0, 1, 0, 0, 0, 1],
+            [0, 0, 0, 1, 0, 0, 0],
+            [0, 0, 0, 0, 1, 0, 0],
+            [0, 0, 0, 0, 0, 1, 0],
+            [0, 0, 0, 0, 0, 0, 1],
+        ]
+    )
+    H = np.array([[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]])
+
+    R = np.eye(4)
+    R[2:, 2:] *= 10.0
+    P = np.eye(7)
+    P[4:, 4:] *= 1000.0  # give high uncertainty to the unobservable initial velocities
+    P *= 10.0
+    Q = np.eye(7)
+    Q[-1, -1] *= 0.01
+    Q[4:, 4:] *= 0.01
+
+    return F, H, Q, R, P
+
+
 class KalmanBoxTracker:
     """
     This class represents the internal state of individual tracked objects observed as bbox.
@@ -61,60 +104,80 @@ class KalmanBoxTracker:
 
     count = 0
 
-    def __init__(self, bbox, delta_t=3, orig=False):
+    def __init__(self, bbox, delta_t=3, orig=False, filter_bank=None, max_history=None, track_states=None):
         """
         Initialises a tracker using initial bounding box.
 
+        With `filter_bank` the Kalman filter is a row of the shared BatchedKalmanFilter, which the owner
+        predicts and updates for all the tracks at once. Likewise the age, observations and velocity live
+        in a row of the owner's `track_states`, or of a private one.
+
+        Only the last `max_history` observations are kept (at least delta_t), enough for the owner's
+        k_previous_obs and head padding lookups.
         """
+        if track_states is None:
+            track_states = TrackStates(max(delta_t, max_history or 0), capacity=1)
+        if track_states.history_size < delta_t:
+            raise ValueError(f"The track states keep {track_states.history_size} observations, delta_t is {delta_t}")
+        self.max_history = track_states.history_size
+        self.row = track_states.add()
         # define constant velocity model
-        if not orig:
-            from .kalmanfilter import KalmanFilterNew as KalmanFilter
-
-            self.kf = KalmanFilter(dim_x=7, dim_z=4)
+        if filter_bank is not None:
+            self.kf = filter_bank.add(convert_bbox_to_z(bbox))
         else:
-            from filterpy.kalman import KalmanFilter
-
-            self.kf = KalmanFilter(dim_x=7, dim_z=4)
-        self.kf.F = np.array(
-            [
-                [1, 0, 0, 0, 1, 0, 0],
-                [0, 1, 0, 0, 0, 1, 0],
-                [0, 0, 1, 0, 0, 0, 1],
-                [0, 0, 0, 1, 0, 0, 0],
-                [0, 0, 0, 0, 1, 0, 0],
-                [0, 0, 0, 0, 0, 1, 0],
-                [0, 0, 0, 0, 0, 0, 1],
-            ]
-        )
-        self.kf.H = np.array(
-            [[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]]
-        )
+            if not orig:
+                from .kalmanfilter import KalmanFilterNew as KalmanFilter
 
-        self.kf.R[2:, 2:] *= 10.0
-        self.kf.P[4:, 4:] *= 1000.0  # give high uncertainty to the unobservable initial velocities
-        self.kf.P *= 10.0
-        self.kf.Q[-1, -1] *= 0.01
-        self.kf.Q[4:, 4:] *= 0.01
+                self.kf = KalmanFilter(dim_x=7, dim_z=4)
+            else:
+                from filterpy.kalman import KalmanFilter
 
-        self.kf.x[:4] = convert_bbox_to_z(bbox)
+                self.kf = KalmanFilter(dim_x=7, dim_z=4)
+            self.kf.F, self.kf.H, self.kf.Q, self.kf.R, self.kf.P = box_filter_model()
+            self.kf.x[:4] = convert_bbox_to_z(bbox)
         self.time_since_update = 0
         self.id = KalmanBoxTracker.count
         KalmanBoxTracker.count += 1
-        self.history = []
+        self.history = deque(maxlen=1)
         self.hits = 0
         self.hit_streak = 0
-        self.age = 0
         """
         NOTE: [-1,-1,-1,-1,-1] is a compromising placeholder for non-observation status, the same for the return of
         function k_previous_obs. It is ugly and I do not like it. But to support generate observation array in a
         fast and unified way, which you would see below k_observations = np.array([k_previous_obs(...]]), let's bear it for now.
+        Every row of the track states starts with it as the last observation.
         """
-        self.last_observation = np.array([-1, -1, -1, -1, -1])  # placeholder
-        self.observations = dict()
-        self.history_observations = []
-        self.velocity = None
+        self.observations = ObservationWindow(self.row)
+        self.history_observations = deque(maxlen=self.max_history)
         self.delta_t = delta_t
 
+    @property
+    def age(self):
+        return int(self.row.states.age[self.row.index])
+
+    @age.setter
+    def age(self, value):
+        self.row.states.age[self.row.index] = value
+
+    @property
+    def last_observation(self):
+        return self.row.states.last_observation[self.row.index]
+
+    @last_observation.setter
+    def last_observation(self, bbox):
+        self.row.states.last_observation[self.row.index] = bbox
+
+    @property
+    def velocity(self):
+        if not self.row.states.has_velocity[self.row.index]:
+            return None
+        return self.row.states.velocity[self.row.index]
+
+    @velocity.setter
+    def velocity(self, value):
+        self.row.states.velocity[self.row.index] = value
+        self.row.states.has_velocity[self.row.index] = True
+
     def update(self, bbox):
         """
         Updates the state vector with observed bbox.
@@ -144,7 +207,7 @@ class KalmanBoxTracker:
             self.history_observations.append(bbox)
 
             self.time_since_update = 0
-            self.history = []
+            self.history.clear()
             self.hits += 1
             self.hit_streak += 1
             self.kf.update(convert_bbox_to_z(bbox))
@@ -159,11 +222,17 @@ class KalmanBoxTracker:
             self.kf.x[6] *= 0.0
 
         self.kf.predict()
+        return self.advance(convert_x_to_bbox(self.kf.x))
+
+    def advance(self, bbox):
+        """
+        Bookkeeping of a prediction step, `bbox` is the predicted box.
+        """
         self.age += 1
         if self.time_since_update > 0:
             self.hit_streak = 0
         self.time_since_update += 1
-        self.history.append(convert_x_to_bbox(self.kf.x))
+        self.history.append(bbox)
         return self.history[-1]
 
     def get_state(self):
@@ -193,9 +262,13 @@ class OCSort:
         asso_func="iou",
         inertia=0.2,
         use_byte=False,
+        batched=True,
     ):
         """
         Sets key parameters for SORT
+
+        With `batched` the Kalman filters of all the tracks run as one BatchedKalmanFilter, otherwise every
+        track has its own KalmanFilterNew.
         """
         self.max_age = max_age
         self.min_hits = min_hits
@@ -207,8 +280,46 @@ class OCSort:
         self.asso_func = ASSO_FUNCS[asso_func]
         self.inertia = inertia
         self.use_byte = use_byte
+        self.kf_bank = BatchedKalmanFilter(*box_filter_model()) if batched else None
+        # k_previous_obs looks delta_t ages back, head padding min_hits observations and the trackers of
+        # update_public keep the default delta_t of 3
+        self.track_states = TrackStates(max(self.delta_t, self.min_hits, 3))
         KalmanBoxTracker.count = 0
 
+    def _new_tracker(self, bbox, **kwargs):
+        trk = KalmanBoxTracker(bbox, filter_bank=self.kf_bank, track_states=self.track_states, **kwargs)
+        self.trackers.append(trk)
+        return trk
+
+    def _remove_tracker(self, t):
+        trk = self.trackers.pop(t)
+        self.track_states.remove(trk.row)
+        if self.kf_bank is not None:
+            self.kf_bank.remove(trk.kf)
+
+    def _predict_trackers(self):
+        """
+        Advances all the trackers, drops the ones that diverged and returns the predicted boxes of the rest
+        """
+        if self.kf_bank is None:
+            boxes = np.array([trk.predict()[0] for trk in self.trackers]).reshape(-1, 4)
+        else:
+            x = self.kf_bank.x
+            x[(x[:, 6, 0] + x[:, 2, 0]) <= 0, 6] *= 0.0
+            self.kf_bank.predict()
+            boxes = convert_states_to_bboxes(self.kf_bank.x)
+            for trk, box in zip(self.trackers, boxes, strict=True):
+                trk.advance(box.reshape(1, 4))
+
+        to_del = np.flatnonzero(np.isnan(boxes).any(axis=1))
+        for t in reversed(to_del):
+            self._remove_tracker(t)
+        return np.delete(boxes, to_del, axis=0)
+
+    def _apply_updates(self):
+        if self.kf_bank is not None:
+            self.kf_bank.apply_updates()
+
     def update(self, output_results, img_info, img_size):
         """
         Params:
@@ -241,21 +352,13 @@ class OCSort:
         dets = dets[remain_inds]
 
         # get predicted locations from existing trackers.
-        trks = np.zeros((len(self.trackers), 5))
-        to_del = []
+        boxes = self._predict_trackers()
+        trks = np.concatenate((boxes, np.zeros((len(boxes), 1))), axis=1)
         ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict()[0]
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-            if np.any(np.isnan(pos)):
-                to_del.append(t)
-        trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-        for t in reversed(to_del):
-            self.trackers.pop(t)
 
-        velocities = np.array([trk.velocity if trk.velocity is not None else np.array((0, 0)) for trk in self.trackers])
-        last_boxes = np.array([trk.last_observation for trk in self.trackers])
-        k_observations = np.array([k_previous_obs(trk.observations, trk.age, self.delta_t) for trk in self.trackers])
+        velocities = self.track_states.velocity
+        last_boxes = self.track_states.last_observation.copy()
+        k_observations = self.track_states.k_previous_obs(self.delta_t)
 
         """
             First round of association
@@ -316,11 +419,11 @@ class OCSort:
 
         for m in unmatched_trks:
             self.trackers[m].update(None)
+        self._apply_updates()
 
         # create and initialise new trackers for unmatched detections
         for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :], delta_t=self.delta_t)
-            self.trackers.append(trk)
+            self._new_tracker(dets[i, :], delta_t=self.delta_t)
         i = len(self.trackers)
         for trk in reversed(self.trackers):
             if trk.last_observation.sum() < 0:
@@ -337,7 +440,7 @@ class OCSort:
             i -= 1
             # remove dead tracklet
             if trk.time_since_update > self.max_age:
-                self.trackers.pop(i)
+                self._remove_tracker(i)
         if len(ret) > 0:
             return np.concatenate(ret)
         return np.empty((0, 5))
@@ -353,22 +456,13 @@ class OCSort:
         cates = cates[remain_inds]
         dets = dets[remain_inds]
 
-        trks = np.zeros((len(self.trackers), 5))
-        to_del = []
+        boxes = self._predict_trackers()
+        trks = np.concatenate((boxes, np.array([[trk.cate] for trk in self.trackers]).reshape(-1, 1)), axis=1)
         ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict()[0]
-            cat = self.trackers[t].cate
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], cat]
-            if np.any(np.isnan(pos)):
-                to_del.append(t)
-        trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-        for t in reversed(to_del):
-            self.trackers.pop(t)
 
-        velocities = np.array([trk.velocity if trk.velocity is not None else np.array((0, 0)) for trk in self.trackers])
-        last_boxes = np.array([trk.last_observation for trk in self.trackers])
-        k_observations = np.array([k_previous_obs(trk.observations, trk.age, self.delta_t) for trk in self.trackers])
+        velocities = self.track_states.velocity
+        last_boxes = self.track_states.last_observation.copy()
+        k_observations = self.track_states.k_previous_obs(self.delta_t)
 
         matched, unmatched_dets, unmatched_trks = associate_kitti(
             dets, trks, cates, self.iou_threshold, velocities, k_observations, self.inertia
@@ -392,18 +486,11 @@ class OCSort:
             iou_left = np.array(iou_left)
             det_cates_left = cates[unmatched_dets]
             trk_cates_left = trks[unmatched_trks][:, 4]
-            num_dets = unmatched_dets.shape[0]
-            num_trks = unmatched_trks.shape[0]
-            cate_matrix = np.zeros((num_dets, num_trks))
-            for i in range(num_dets):
-                for j in range(num_trks):
-                    if det_cates_left[i] != trk_cates_left[j]:
-                        """
-                                For some datasets, such as KITTI, there are different categories,
-                                we have to avoid associate them together.
-                            """
-                        cate_matrix[i][j] = -1e6
-            iou_left = iou_left + cate_matrix
+            """
+                For some datasets, such as KITTI, there are different categories,
+                we have to avoid associate them together.
+            """
+            iou_left = iou_left + category_cost(det_cates_left, trk_cates_left)
             if iou_left.max() > self.iou_threshold - 0.1:
                 rematched_indices = linear_assignment(-iou_left)
                 to_remove_det_indices = []
@@ -418,10 +505,11 @@ class OCSort:
                 unmatched_dets = np.setdiff1d(unmatched_dets, np.array(to_remove_det_indices))
                 unmatched_trks = np.setdiff1d(unmatched_trks, np.array(to_remove_trk_indices))
 
+        self._apply_updates()
+
         for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :])
+            trk = self._new_tracker(dets[i, :])
             trk.cate = cates[i]
-            self.trackers.append(trk)
         i = len(self.trackers)
 
         for trk in reversed(self.trackers):
@@ -444,7 +532,7 @@ class OCSort:
                         )
             i -= 1
             if trk.time_since_update > self.max_age:
-                self.trackers.pop(i)
+                self._remove_tracker(i)
 
         if len(ret) > 0:
             return np.concatenate(ret)
@@ -0,0 +1,153 @@
+"""
+Association state of the tracks (age, last observation, velocity direction and the recent observations) kept in
+preallocated arrays with a row per track, so OCSort reads it for all the tracks at once instead of gathering it
+from every KalmanBoxTracker on every frame.
+"""
+
+import numpy as np
+
+# [x1, y1, x2, y2, score]
+OBSERVATION_SIZE = 5
+
+
+class TrackRow:
+    """
+    A single track's row of TrackStates, the row moves up when an earlier track is removed.
+    """
+
+    def __init__(self, states: "TrackStates", index: int):
+        self.states = states
+        self.index = index
+
+
+class ObservationWindow:
+    """
+    Observations of a track keyed by age, like a dict but only the last `size` ages are kept in a ring buffer.
+
+    Enough for the velocity and k_previous_obs lookups, which never look further back than delta_t ages,
+    and the memory of a track no longer grows with its lifetime.
+    """
+
+    def __init__(self, row: TrackRow):
+        self.row = row
+        self.size = row.states.history_size
+
+    def __len__(self):
+        return int(np.count_nonzero(self.row.states.observation_ages[self.row.index] >= 0))
+
+    def __contains__(self, age):
+        return age >= 0 and self.row.states.observation_ages[self.row.index, age % self.size] == age
+
+    def __getitem__(self, age):
+        if age not in self:
+            raise KeyError(age)
+        return self.row.states.observations[self.row.index, age % self.size]
+
+    def __setitem__(self, age, bbox):
+        self.row.states.observations[self.row.index, age % self.size] = bbox
+        self.row.states.observation_ages[self.row.index, age % self.size] = age
+
+    def keys(self):
+        ages = self.row.states.observation_ages[self.row.index]
+        return ages[ages >= 0].tolist()
+
+
+class TrackStates:
+    """
+    Rows follow the order the owner keeps its tracks in, every array is indexed by the track position.
+    The last `history_size` observations of every track are kept, keyed by the track age modulo the size.
+    """
+
+    _ARRAYS = ("_age", "_last_observation", "_velocity", "_has_velocity", "_observations", "_observation_ages")
+
+    def __init__(self, history_size: int, capacity: int = 16):
+        self.history_size = history_size
+        self.size = 0
+        self.rows: list[TrackRow] = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        arrays = {
+            "_age": np.zeros(capacity, dtype=int),
+            # [-1, -1, -1, -1, -1] is the placeholder of a track not observed yet
+            "_last_observation": np.full((capacity, OBSERVATION_SIZE), -1.0),
+            # speed direction (dy, dx) of the track, (0, 0) until it is known
+            "_velocity": np.zeros((capacity, 2)),
+            "_has_velocity": np.zeros(capacity, dtype=bool),
+            "_observations": np.zeros((capacity, self.history_size, OBSERVATION_SIZE)),
+            "_observation_ages": np.full((capacity, self.history_size), -1),
+        }
+        for name, array in arrays.items():
+            if self.size:
+                array[: self.size] = getattr(self, name)[: self.size]
+            setattr(self, name, array)
+
+    @property
+    def age(self) -> np.ndarray:
+        return self._age[: self.size]
+
+    @property
+    def last_observation(self) -> np.ndarray:
+        return self._last_observation[: self.size]
+
+    @property
+    def velocity(self) -> np.ndarray:
+        return self._velocity[: self.size]
+
+    @property
+    def has_velocity(self) -> np.ndarray:
+        return self._has_velocity[: self.size]
+
+    @property
+    def observations(self) -> np.ndarray:
+        return self._observations[: self.size]
+
+    @property
+    def observation_ages(self) -> np.ndarray:
+        return self._observation_ages[: self.size]
+
+    def add(self) -> TrackRow:
+        if self.size == len(self._age):
+            self._allocate(2 * len(self._age))
+
+        index = self.size
+        self._age[index] = 0
+        self._last_observation[index] = -1.0
+        self._velocity[index] = 0.0
+        self._has_velocity[index] = False
+        self._observation_ages[index] = -1
+        self.size += 1
+
+        row = TrackRow(self, index)
+        self.rows.append(row)
+        return row
+
+    def remove(self, row: TrackRow) -> None:
+        index = row.index
+        for name in self._ARRAYS:
+            array = getattr(self, name)
+            array[index : self.size - 1] = array[index + 1 : self.size]
+
+        self.rows.pop(index)
+        for later in self.rows[index:]:
+            later.index -= 1
+        self.size -= 1
+
+    def k_previous_obs(self, k: int) -> np.ndarray:
+        """
+        For every track the observation k ages back, or the closest one after it within the last k ages,
+        otherwise the last observation (the placeholder if there is none). Same as k_previous_obs per track.
+        """
+        if k > self.history_size:
+            raise ValueError(f"Only the last {self.history_size} observations are kept, can't look {k} back")
+
+        # ages to look at, oldest first
+        ages = self.age[:, np.newaxis] - np.arange(k, 0, -1)[np.newaxis, :]
+        slots = ages % self.history_size
+        found = (ages >= 0) & (np.take_along_axis(self.observation_ages, slots, axis=1) == ages)
+
+        previous = self.last_observation.copy()
+        tracks = np.flatnonzero(found.any(axis=1))
+        first_found = found[tracks].argmax(axis=1)
+        previous[tracks] = self.observations[tracks, slots[tracks, first_found]]
+        return previous
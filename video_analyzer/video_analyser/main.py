@@ -6,10 +6,21 @@ import uuid
 import boto3
 import typer
 from insights import analyze_stats
+from lib.model_loader import DEFAULT_CACHE_DIR, ExportFormat, ModelLoader
 from message_visibility_manager import MessageVisibilityManager
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from queue_models import QueueResponse
-from video_metadata_manager import Analysis, Clip, ClipType, Insights, Player, update_clips
+from video_metadata_manager import (
+    Analysis,
+    Clip,
+    ClipType,
+    Insights,
+    Player,
+    clip_details_key,
+    delete_clip_details,
+    update_clips,
+    upload_clip_details,
+)
 
 from video_analyser import VideoAnalyser
 
@@ -38,6 +49,33 @@ class Settings(BaseSettings):
 
     OPENAI_API_KEY: str
 
+    # Number of decoded frames sent to the detection models in a single predict call
+    INFERENCE_BATCH_SIZE: int = 8
+    # Auto-detected (cuda, mps or cpu) when not set
+    INFERENCE_DEVICE: str | None = None
+    # On CPU-only hosts the models are exported once to this format ("openvino", "onnx" or "torch" to skip)
+    INFERENCE_CPU_EXPORT_FORMAT: ExportFormat = ExportFormat.OPENVINO
+    INFERENCE_THREADS: int | None = None
+    MODEL_CACHE_DIR: str = DEFAULT_CACHE_DIR
+
+    # Ball detection runs at this rate and only goes frame by frame around rally boundaries, unset to run it
+    # on every frame. Rally start/end frames are accurate to BALL_BOUNDARY_TOLERANCE_SEC only while the detector
+    # doesn't miss the ball on the sampled frames, `benchmarks.py ball-sampling` compares it with every frame.
+    BALL_SAMPLING_FPS: float | None = None
+    BALL_BOUNDARY_TOLERANCE_SEC: float = 0.1
+
+    # Player and ball detection only look at the court and this many meters around it, the ball also at everything
+    # above it. Frames are cropped once the field samples agree on the region. Unset to use full frames.
+    COURT_ROI_MARGIN_METERS: float | None = None
+
+    # Share of pixels (0..1) that has to change between frames for the detection models to run, frames where
+    # nothing moves are skipped. Unset to run the models on every frame.
+    MOTION_GATE_THRESHOLD: float | None = None
+
+    # Heatmaps and insights of the clips go to an S3 object next to the processed video and the media item only
+    # keeps its key, so the item stays small however many rallies a match has
+    CLIP_DETAILS_IN_S3: bool = False
+
     model_config = SettingsConfigDict(
         env_file=(".env", ".env.local", ".env.dev"),
         env_prefix="VIDEO_ANALYSER_",
@@ -59,7 +97,22 @@ def main():
     sqs = boto3.client("sqs")
     s3 = boto3.client("s3")
 
-    video_analyser = VideoAnalyser(s3, settings.MEDIA_FILES_BUCKET)
+    model_loader = ModelLoader(
+        cache_dir=settings.MODEL_CACHE_DIR,
+        export_format=settings.INFERENCE_CPU_EXPORT_FORMAT,
+        device=settings.INFERENCE_DEVICE,
+        num_threads=settings.INFERENCE_THREADS,
+    )
+    video_analyser = VideoAnalyser(
+        s3,
+        settings.MEDIA_FILES_BUCKET,
+        batch_size=settings.INFERENCE_BATCH_SIZE,
+        model_loader=model_loader,
+        ball_sampling_fps=settings.BALL_SAMPLING_FPS,
+        ball_boundary_tolerance=settings.BALL_BOUNDARY_TOLERANCE_SEC,
+        court_roi_margin=settings.COURT_ROI_MARGIN_METERS,
+        motion_threshold=settings.MOTION_GATE_THRESHOLD,
+    )
 
     while True:
         try:
@@ -85,7 +138,9 @@ def main():
                         media_descriptor = message.body
                         logger.info(f"Handling media {media_descriptor}")
 
-                        rallies, thumbnails = video_analyser.analyse_video(media_descriptor.media_key)
+                        rallies, thumbnails = video_analyser.analyse_video(
+                            media_descriptor.media_key, analysis_media_key=media_descriptor.analysis_media_key
+                        )
 
                         clips = []
                         for rally, thumbnail in zip(rallies, thumbnails, strict=False):
@@ -124,10 +179,29 @@ def main():
                                 )
                             )
 
+                        details_key = None
+                        if settings.CLIP_DETAILS_IN_S3:
+                            details_key = clip_details_key(media_descriptor.media_key)
+                            logger.info(f"Uploading clip details to {details_key}")
+                            upload_clip_details(s3, settings.MEDIA_FILES_BUCKET, details_key, clips)
+
                         logger.info("Updating metadata")
-                        update_clips(media_descriptor.media_id, clips)
+                        try:
+                            previous_details_key = update_clips(media_descriptor.media_id, clips, details_key)
+                        except Exception:
+                            if details_key:
+                                delete_clip_details(s3, settings.MEDIA_FILES_BUCKET, details_key)
+                            raise
                         logger.info("Metadata update complete")
 
+                        # The item points at this run's clip details now, the previous run's are removed
+                        if previous_details_key and previous_details_key != details_key:
+                            logger.info(f"Removing previous clip details {previous_details_key}")
+                            try:
+                                delete_clip_details(s3, settings.MEDIA_FILES_BUCKET, previous_details_key)
+                            except Exception as e:
+                                logger.warning(f"Failed to remove previous clip details: {str(e)}")
+
                         logger.info("Removing message from the queue")
                         sqs.delete_message(QueueUrl=settings.SOURCE_SQS_QUEUE, ReceiptHandle=message.receipt_handle)
                         logger.info("Message is removed")
@@ -8,6 +8,8 @@ from pydantic_core import from_json
 class MediaDescriptor(BaseModel):
     media_id: UUID
     media_key: str
+    # Low resolution rendition of the same frames to analyse instead of the playback video, when there is one
+    analysis_media_key: str | None = None
 
 
 class ResponseMetadata(BaseModel):
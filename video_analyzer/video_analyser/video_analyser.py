@@ -1,4 +1,5 @@
 import logging
+from collections.abc import Callable
 from dataclasses import dataclass
 from io import BytesIO
 from math import ceil
@@ -7,11 +8,29 @@ from pathlib import Path
 import cv2
 import numpy as np
 import pandas as pd
-from lib.player_heatmap.player_heatmap import get_heatmap
-from scipy.cluster.hierarchy import fcluster, linkage
-from scipy.spatial.distance import pdist
-from tqdm.auto import tqdm
-from ultralytics import YOLO
+from lib.frame_pipeline import BatchedFrameConsumer, Frame, FrameConsumer, FramePipeline, Roi, VideoInfo, crop
+from lib.model_loader import ModelLoader, warmup
+from lib.motion_gate import MotionGate
+from lib.player_heatmap.field_detector import FIELD_MODEL_PATH, FieldKeypointSampler
+from lib.player_heatmap.find_homography import CourtRoi, CourtSide, homography_from_field_points
+from lib.player_heatmap.player_heatmap import PLAYER_MODEL_PATH, PlayerPositionCollector
+from lib.player_heatmap.track_store import TrackStore
+from ultralytics import RTDETR, YOLO
+
+BALL_MODEL_PATH = "./models/player_yolo_12s.pt"
+
+RALLY_DISTANCE_THRESHOLD = 2.0
+
+# Heatmaps count the player positions in cells of 10x10 court units, 26 x 51 cells cover the court
+HEATMAP_CELL_SIZE = 10
+HEATMAP_WIDTH = 26
+HEATMAP_HEIGHT = 51
+
+# Zones of the heatmap rows by their distance from the net (0 at the net, 1 at the back of the court)
+_NET_DISTANCE = np.abs(np.arange(HEATMAP_HEIGHT) - 25) / 25
+VOLLEY_ROWS = _NET_DISTANCE < 0.4
+DEFENCE_ROWS = _NET_DISTANCE > 0.7
+TRANSITION_ROWS = ~VOLLEY_ROWS & ~DEFENCE_ROWS
 
 
 @dataclass
@@ -41,29 +60,57 @@ class Detection:
     players: dict[int, Player]
 
 
-def detect_rallies_clustering(df_detections, min_detections=5, distance_threshold=2.0) -> list[Detection]:
-    if len(df_detections) < min_detections:
+def heatmap_cells(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Flat index of the heatmap cell of every court position, positions off the grid go to the closest cell.
+    """
+    column = np.clip(x // HEATMAP_CELL_SIZE, 0, HEATMAP_WIDTH - 1)
+    row = np.clip(y // HEATMAP_CELL_SIZE, 0, HEATMAP_HEIGHT - 1)
+    return column.astype(np.intp) * HEATMAP_HEIGHT + row
+
+
+def heatmap_from_cells(cells: np.ndarray) -> list[tuple[tuple[int, int], int]]:
+    """
+    ((x, y), count) of every visited cell, the most visited first and ties in the order they were first visited.
+    """
+    visited, first_visit, counts = np.unique(cells, return_index=True, return_counts=True)
+    order = np.lexsort((first_visit, -counts))
+    columns, rows = np.divmod(visited[order], HEATMAP_HEIGHT)
+    return list(zip(zip(columns.tolist(), rows.tolist(), strict=True), counts[order].tolist(), strict=True))
+
+
+def detect_rallies_clustering(
+    df_detections, min_detections=5, distance_threshold=RALLY_DISTANCE_THRESHOLD
+) -> list[Detection]:
+    if df_detections.empty:
         return []
 
-    detections_sorted = df_detections.sort_values("timestamp_sec").reset_index(drop=True)
+    detections_sorted = df_detections.sort_values("timestamp_sec", kind="stable").reset_index(drop=True)
+    timestamps = detections_sorted["timestamp_sec"].to_numpy()
+    frames = detections_sorted["frame"].to_numpy()
+    # Sampled detections stand for several frames each
+    if "weight" in detections_sorted.columns:
+        weights = detections_sorted["weight"].to_numpy()
+    else:
+        weights = np.ones(len(detections_sorted), dtype=int)
 
-    X = detections_sorted[["timestamp_sec"]].values
-    distances = pdist(X, metric="euclidean")
-    Z = linkage(distances, method="single")
-    cluster_labels = fcluster(Z, t=distance_threshold, criterion="distance")
+    if weights.sum() < min_detections:
+        return []
 
-    detections_sorted["cluster"] = cluster_labels
-    cluster_counts = detections_sorted["cluster"].value_counts()
-    valid_clusters = cluster_counts[cluster_counts >= min_detections].index.tolist()
+    # Single-linkage clustering of sorted 1D points with a distance cutoff splits them exactly
+    # at the gaps larger than the cutoff, so there is no need to build the pairwise distance matrix
+    segment_bounds = np.concatenate(([0], np.flatnonzero(np.diff(timestamps) > distance_threshold) + 1))
+    segment_ends = np.append(segment_bounds[1:], len(timestamps))
+    detection_counts = np.add.reduceat(weights, segment_bounds)
+    start_times = timestamps[segment_bounds]
+    end_times = timestamps[segment_ends - 1]
+    start_frames = np.minimum.reduceat(frames, segment_bounds)
+    end_frames = np.maximum.reduceat(frames, segment_bounds)
 
     rallies = []
-    for i, cluster_id in enumerate(valid_clusters):
-        cluster_data = detections_sorted[detections_sorted["cluster"] == cluster_id]
-
-        start_time = cluster_data["timestamp_sec"].min()
-        end_time = cluster_data["timestamp_sec"].max()
-        start_frame = cluster_data["frame"].min()
-        end_frame = cluster_data["frame"].max()
+    for cluster_idx in np.flatnonzero(detection_counts >= min_detections):
+        start_time = start_times[cluster_idx]
+        end_time = end_times[cluster_idx]
         duration = end_time - start_time
 
         if duration < 3.0:
@@ -72,14 +119,14 @@ def detect_rallies_clustering(df_detections, min_detections=5, distance_threshol
 
         rallies.append(
             Detection(
-                rally_id=i + 1,
-                start_frame=int(start_frame),
-                end_frame=int(end_frame),
+                rally_id=len(rallies) + 1,
+                start_frame=int(start_frames[cluster_idx]),
+                end_frame=int(end_frames[cluster_idx]),
                 start_time=int(start_time),
                 end_time=int(ceil(end_time)),
                 duration=int(ceil(end_time - start_time)),
-                detection_count=len(cluster_data),
-                cluster_id=cluster_id,
+                detection_count=int(detection_counts[cluster_idx]),
+                cluster_id=int(cluster_idx) + 1,
                 players={},
             )
         )
@@ -91,222 +138,386 @@ def detect_rallies_clustering(df_detections, min_detections=5, distance_threshol
     return rallies
 
 
-class VideoAnalyser:
-    def __init__(self, s3_client, bucket: str):
-        self.s3 = s3_client
-        self.bucket = bucket
-        self.logger = logging.getLogger(__name__)
+class BallPresenceDetector(BatchedFrameConsumer):
+    """
+    Runs the ball detector over the video and records the frames where the ball is visible.
+
+    With `sampling_fps` set, the detector only looks at frames at that rate and goes back to the frames
+    skipped since the previous sample whenever the ball appears or disappears, so the rally boundaries
+    are still found to within `boundary_tolerance` seconds. A ball missed on a sample hides the frames on
+    either side of it, boundaries next to such a sample can be off by more. Each detection carries a
+    `weight`, the number of frames it stands for, so detection counts stay comparable with running on
+    every frame.
+
+    Every detection that follows a gap longer than `distance_threshold` may start a rally, those frames
+    are reported to `on_segment_start` while they are still in memory (e.g. to grab a thumbnail).
+
+    With `roi` set, the detector only looks at that part of the frames.
+    """
+
+    def __init__(
+        self,
+        model,
+        distance_threshold: float = RALLY_DISTANCE_THRESHOLD,
+        on_segment_start: Callable[[Frame], None] | None = None,
+        batch_size: int = 1,
+        sampling_fps: float | None = None,
+        boundary_tolerance: float = 0.0,
+        roi: Callable[[], Roi | None] | None = None,
+    ):
+        super().__init__(batch_size)
+        self.model = model
+        self.distance_threshold = distance_threshold
+        self.on_segment_start = on_segment_start
+        self.sampling_fps = sampling_fps
+        self.boundary_tolerance = boundary_tolerance
+        self.roi = roi
+        self.detections = []
+        self.frames_inferred = 0
+
+        self.sampling_step = 1
+        self.refine_step = 1
+        self._skipped: list[Frame] = []  # frames since the last sample, kept to refine a boundary
+        self._last_sample_hit = False
+        self._last_inferred_frame = -1
+
+    def on_start(self, info: VideoInfo) -> None:
+        if self.sampling_fps:
+            self.sampling_step = max(1, round(info.fps / self.sampling_fps))
+            self.refine_step = max(1, round(self.boundary_tolerance * info.fps))
+
+    def on_batch(self, frames: list[Frame]) -> None:
+        if self.sampling_step == 1:
+            self._add_detections(frames, self._detect(frames))
+            return
+
+        samples = [frame for frame in frames if frame.number % self.sampling_step == 0]
+        sample_hits = dict(zip([frame.number for frame in samples], self._detect(samples), strict=True))
+
+        inferred = []
+        hits = []
+        refine = []
+        for frame in frames:
+            if frame.number not in sample_hits:
+                self._skipped.append(frame)
+                continue
+
+            hit = sample_hits[frame.number]
+            if hit != self._last_sample_hit:
+                # The ball appeared or disappeared since the last sample, look at the frames in between
+                refine.extend(self._skipped[:: self.refine_step])
+            self._skipped = []
+            self._last_sample_hit = hit
+
+            inferred.append(frame)
+            hits.append(hit)
+
+        if refine:
+            inferred.extend(refine)
+            hits.extend(self._detect(refine))
+
+        order = sorted(range(len(inferred)), key=lambda idx: inferred[idx].number)
+        self._add_detections([inferred[idx] for idx in order], [hits[idx] for idx in order])
+
+    def on_finish(self) -> None:
+        super().on_finish()
+
+        # The video may end while the ball is still visible, the last frames close the rally
+        if self._last_sample_hit and self._skipped:
+            refine = self._skipped[:: self.refine_step]
+            self._add_detections(refine, self._detect(refine))
+        self._skipped = []
+
+    def _detect(self, frames: list[Frame]) -> list[bool]:
+        # Nothing moves on the static frames, the ball is not in play
+        moving = [frame for frame in frames if not frame.static]
+        if not moving:
+            return [False] * len(frames)
+
+        self.frames_inferred += len(moving)
+        roi = self.roi() if self.roi else None
+        results = self.model.predict([crop(frame.image, roi) for frame in moving], conf=0.5, verbose=False)
+
+        ball_detected = {}
+        for frame, result in zip(moving, results, strict=True):
+            detected = False
+            for box in result.boxes:
+                class_id = int(box.cls[0])
+                if class_id == 0:  # ball
+                    detected = True
+            ball_detected[frame.number] = detected
+
+        return [ball_detected.get(frame.number, False) for frame in frames]
+
+    def _add_detections(self, frames: list[Frame], ball_detected: list[bool]) -> None:
+        for frame, detected in zip(frames, ball_detected, strict=True):
+            weight = frame.number - self._last_inferred_frame
+            self._last_inferred_frame = frame.number
+
+            if detected:
+                self._add_detection(frame, weight)
+
+    def _add_detection(self, frame: Frame, weight: int) -> None:
+        timestamp_sec = frame.timestamp_sec
+        segment_start = (
+            not self.detections or timestamp_sec - self.detections[-1]["timestamp_sec"] > self.distance_threshold
+        )
+
+        self.detections.append(
+            {
+                "frame": frame.number,
+                "timestamp_sec": timestamp_sec,
+                "timestamp": f"{int(timestamp_sec // 60):02d}:{timestamp_sec % 60:.3f}",
+                "weight": weight,
+            }
+        )
 
-        self.model = YOLO("./models/player_yolo_12s.pt")
-        self.model.to("mps")
+        if segment_start and self.on_segment_start is not None:
+            self.on_segment_start(frame)
 
-    def _get_presigned_url(self, bucket: str, key: str, expiry: int = 3600) -> str:
-        return self.s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expiry)
 
-    def generate_thumbnails(self, media_key: str, media_url: str, detections: list[Detection]) -> list[str]:
-        path = Path(media_key)
-        file_prefix = path.parent
+class ThumbnailCapture(FrameConsumer):
+    """
+    Keeps jpeg thumbnails of the frames clips may start at, so they don't have to be decoded again later.
+    The first frame is always captured as it starts the full clip.
+    """
 
-        self.logger.info("Generating clip thumbnails")
-        if not detections:
-            return []
+    def __init__(self, target_width: int = 270, target_height: int = 150):
+        self.target_width = target_width
+        self.target_height = target_height
+        self.thumbnails: dict[int, bytes] = {}
+
+    def on_frame(self, frame: Frame) -> None:
+        if frame.number == 0:
+            self.capture(frame)
 
-        cap = cv2.VideoCapture(media_url)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video stream from {media_url}")
+    def capture(self, frame: Frame) -> None:
+        if frame.number in self.thumbnails:
+            return
 
-        detections = sorted(detections, key=lambda x: x.start_frame)
-        frames = [x.start_frame for x in detections]
-        thumbnails = []
+        success, buffer = cv2.imencode(".jpg", self._make_thumbnail(frame.image))
+        if not success:
+            raise RuntimeError("Failed to encode thumbnail!")
 
-        try:
-            current_frame = 0
+        self.thumbnails[frame.number] = buffer.tobytes()
 
-            # Process until we've extracted all requested frames
-            for target_frame in frames:
-                # If we need to skip frames, set the position
-                if target_frame > current_frame:  # Configurable seeking behavior
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
-                    current_frame = target_frame
+    def _make_thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        # Resize while preserving aspect ratio and ensure 270x150 output
+        target_width, target_height = self.target_width, self.target_height
 
-                # Read the frame
-                ret, frame = cap.read()
+        # Get original dimensions
+        h, w = frame.shape[:2]
 
-                if not ret:
-                    raise RuntimeError("Failed to extract frame")
+        # Calculate target dimensions that preserve aspect ratio
+        if w / h > target_width / target_height:  # Original is wider
+            new_w = target_width
+            new_h = int(h * (target_width / w))
+        else:  # Original is taller
+            new_h = target_height
+            new_w = int(w * (target_height / h))
 
-                # Resize while preserving aspect ratio and ensure 270x150 output
-                target_width, target_height = 270, 150
+        # Resize the image preserving aspect ratio
+        resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+
+        # Create a black canvas of target size
+        canvas = np.zeros((target_height, target_width, 3), dtype=np.uint8)
+
+        # Calculate position to center the resized image
+        y_offset = (target_height - new_h) // 2
+        x_offset = (target_width - new_w) // 2
+
+        # Place the resized image on the canvas
+        canvas[y_offset : y_offset + new_h, x_offset : x_offset + new_w] = resized
+
+        return canvas
+
+
+@dataclass
+class DetectionModels:
+    """
+    The models used by the analysis, loaded and warmed up once per worker and shared by every video.
+    """
+
+    ball: YOLO
+    player: RTDETR
+    field: YOLO
+
+    @classmethod
+    def load(cls, model_loader: ModelLoader, batch_size: int = 1) -> "DetectionModels":
+        models = cls(
+            ball=model_loader.load(YOLO, BALL_MODEL_PATH),
+            player=model_loader.load(RTDETR, PLAYER_MODEL_PATH),
+            field=model_loader.load(YOLO, FIELD_MODEL_PATH),
+        )
 
-                # Get original dimensions
-                h, w = frame.shape[:2]
+        # The detectors see batches of frames, the field detector single sampled frames
+        warmup(models.ball, batch_size)
+        warmup(models.player, batch_size)
+        warmup(models.field)
 
-                # Calculate target dimensions that preserve aspect ratio
-                if w / h > target_width / target_height:  # Original is wider
-                    new_w = target_width
-                    new_h = int(h * (target_width / w))
-                else:  # Original is taller
-                    new_h = target_height
-                    new_w = int(w * (target_height / h))
+        return models
 
-                # Resize the image preserving aspect ratio
-                resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
 
-                # Create a black canvas of target size
-                canvas = np.zeros((target_height, target_width, 3), dtype=np.uint8)
+class VideoAnalyser:
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        batch_size: int = 1,
+        model_loader: ModelLoader | None = None,
+        ball_sampling_fps: float | None = None,
+        ball_boundary_tolerance: float = 0.0,
+        court_roi_margin: float | None = None,
+        motion_threshold: float | None = None,
+    ):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.ball_sampling_fps = ball_sampling_fps
+        self.ball_boundary_tolerance = ball_boundary_tolerance
+        self.court_roi_margin = court_roi_margin
+        self.motion_threshold = motion_threshold
+        self.logger = logging.getLogger(__name__)
 
-                # Calculate position to center the resized image
-                y_offset = (target_height - new_h) // 2
-                x_offset = (target_width - new_w) // 2
+        self.models = DetectionModels.load(model_loader or ModelLoader(), batch_size)
 
-                # Place the resized image on the canvas
-                canvas[y_offset : y_offset + new_h, x_offset : x_offset + new_w] = resized
+    def _get_presigned_url(self, bucket: str, key: str, expiry: int = 3600) -> str:
+        return self.s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expiry)
 
-                # Store the thumbnail
-                thumbnails.append(canvas)
+    def generate_thumbnails(
+        self, media_key: str, detections: list[Detection], thumbnails: dict[int, bytes]
+    ) -> list[str]:
+        path = Path(media_key)
+        file_prefix = path.parent
 
-        finally:
-            cap.release()
+        self.logger.info("Uploading clip thumbnails")
+        if not detections:
+            return []
 
         thumbnail_keys = []
-        for detection, thumbnail in zip(detections, thumbnails, strict=False):
+        for detection in detections:
+            thumbnail = thumbnails.get(detection.start_frame)
+            if thumbnail is None:
+                raise RuntimeError(f"No thumbnail captured for frame {detection.start_frame}")
+
             thumbnail_key = f"{file_prefix}/thumbnail_270_150_clip_{detection.rally_id}.jpg"
             thumbnail_keys.append(thumbnail_key)
 
-            success, buffer = cv2.imencode(".jpg", thumbnail)
-            if not success:
-                raise RuntimeError("Failed to encode thumbnail!")
-
-            thumbnail_bytes = BytesIO(buffer)
-
-            self.s3.upload_fileobj(thumbnail_bytes, self.bucket, thumbnail_key, ExtraArgs={"ContentType": "image/jpeg"})
+            self.s3.upload_fileobj(
+                BytesIO(thumbnail), self.bucket, thumbnail_key, ExtraArgs={"ContentType": "image/jpeg"}
+            )
 
         self.logger.info("   Thumbnails are uploaded")
 
         return thumbnail_keys
 
-    def _detect_rallies(self, media_url) -> list[Detection]:
-        # Open the video stream
-        cap = cv2.VideoCapture(media_url)
-        if not cap.isOpened():
-            raise ValueError("Failed to open video stream")
-
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        self.logger.info(f"Video dimensions: w={frame_width}, h={frame_height}, fps={fps}, frames={total_frames}")
-
+    def _detect_rallies(self, ball_detections: list[dict], info: VideoInfo) -> list[Detection]:
         full_clip_detection = Detection(
             rally_id=0,
             start_frame=0,
-            end_frame=total_frames,
+            end_frame=info.total_frames,
             start_time=0,
-            end_time=int(total_frames / fps),
-            duration=int(total_frames / fps),
+            end_time=int(info.total_frames / info.fps),
+            duration=int(info.total_frames / info.fps),
             detection_count=0,
             cluster_id=0,
             players={},
         )
 
-        detections = []
-        with tqdm(total=total_frames, desc="Detecting ball position") as progress_bar:
-            while cap.isOpened():
-                frame_number = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        self.logger.info(f"Feature extraction finished: detections={len(ball_detections)}")
 
-                timestamp_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
-                timestamp_sec = timestamp_ms / 1000.0
-
-                ret, frame_orig = cap.read()
-
-                if not ret:
-                    self.logger.info(f"Processing finished at frame {frame_number} of {total_frames}")
-                    break
-
-                frame = frame_orig
-
-                results = self.model.predict(frame, conf=0.5, verbose=False)
-
-                ball_detected = False
-                for result in results:
-                    for box in result.boxes:
-                        class_id = int(box.cls[0])
-                        if class_id == 0:  # ball
-                            ball_detected = True
-
-                if ball_detected:
-                    detections.append(
-                        {
-                            "frame": frame_number,
-                            "timestamp_sec": timestamp_sec,
-                            "timestamp": f"{int(timestamp_sec // 60):02d}:{timestamp_sec % 60:.3f}",
-                        }
-                    )
-
-                progress_bar.update(1)
-
-        self.logger.info(f"Feature extraction finished: detections={len(detections)}")
-
-        df_detections = pd.DataFrame(detections)
+        df_detections = pd.DataFrame(ball_detections)
 
         self.logger.info("Identify rallies")
         rallies = detect_rallies_clustering(df_detections)
         self.logger.info(f"   {len(rallies)} rallies identified")
         return [full_clip_detection] + rallies
 
-    def _build_zone_stats(self, coordinates) -> ZoneStats:
-        total_value = 0
-        volley_value = 0
-        defence_value = 0
-        transition_value = 0
-
-        for [[x, y], intensity] in coordinates:
-            norm = abs(y - 25) / 25
-
-            total_value += intensity
-            if norm < 0.4:
-                volley_value += intensity
-            elif norm > 0.7:
-                defence_value += intensity
-            else:
-                transition_value += intensity
+    def _build_zone_stats(self, heatmap_grid: np.ndarray) -> ZoneStats:
+        rows = heatmap_grid.sum(axis=0)
+        total_value = rows.sum()
 
         if total_value == 0:
             return ZoneStats(volley_share=0, transition_share=0, defence_share=0)
 
         return ZoneStats(
-            volley_share=volley_value / total_value,
-            transition_share=transition_value / total_value,
-            defence_share=defence_value / total_value,
+            volley_share=float(rows[VOLLEY_ROWS].sum() / total_value),
+            transition_share=float(rows[TRANSITION_ROWS].sum() / total_value),
+            defence_share=float(rows[DEFENCE_ROWS].sum() / total_value),
         )
 
-    def _populate_players(self, tracks, rallies: list[Detection]) -> None:
-        df = pd.DataFrame(tracks).set_index("frame")
+    def _populate_players(self, tracks: TrackStore, rallies: list[Detection]) -> None:
+        player_ids = tracks.player_ids().tolist()
         for rally in rallies:
-            rally_points = df[(df.index >= rally.start_frame) & (df.index <= rally.end_frame)]
-            for player_id, player_data in rally_points.items():
-                binned_coordinates = pd.Series(
-                    [(np.clip(x // 10, 0, 25), np.clip(y // 10, 0, 50)) for x, y in player_data.dropna()]
-                ).value_counts()
+            rows = tracks.between(rally.start_frame, rally.end_frame)
+            rally_players, rally_x, rally_y = tracks.player_id[rows], tracks.x[rows], tracks.y[rows]
+            for player_id in player_ids:
+                mask = rally_players == player_id
+                cells = heatmap_cells(rally_x[mask], rally_y[mask])
+                heatmap_grid = np.bincount(cells, minlength=HEATMAP_WIDTH * HEATMAP_HEIGHT)
 
                 rally.players[player_id] = Player(
                     id=player_id,
-                    heatmap=[(x, y) for x, y in binned_coordinates.items()],
-                    zone_stats=self._build_zone_stats([(x, y) for x, y in binned_coordinates.items()]),
+                    heatmap=heatmap_from_cells(cells),
+                    zone_stats=self._build_zone_stats(heatmap_grid.reshape(HEATMAP_WIDTH, HEATMAP_HEIGHT)),
                 )
 
-    def analyse_video(self, media_key, *, generate_thumbnails=True) -> tuple[list[Detection], list[str | None]]:
-        self.logger.info(f"Processing video: {media_key}")
-        media_url = self._get_presigned_url(self.bucket, media_key)
+    def analyse_video(
+        self, media_key, *, analysis_media_key: str | None = None, generate_thumbnails=True
+    ) -> tuple[list[Detection], list[str | None]]:
+        """
+        Args:
+            media_key: key of the playback video, the clip thumbnails are stored next to it
+            analysis_media_key: key of a low resolution rendition with the same frames, decoded instead of the
+                playback video when given
+        """
+        self.logger.info(f"Processing video: {analysis_media_key or media_key}")
+        media_url = self._get_presigned_url(self.bucket, analysis_media_key or media_key)
+
+        # Every analysis step shares a single decode of the video
+        pipeline = FramePipeline(media_url)
+        field_sampler = pipeline.register(FieldKeypointSampler(self.models.field))
+        # The field sampler is registered first, so the court region follows the field samples as they come in
+        roi = ball_roi = None
+        if self.court_roi_margin is not None:
+            roi = CourtRoi(field_sampler, self.court_roi_margin)
+            # Lobs go well above the far wall, the ball region keeps everything above the court
+            ball_roi = CourtRoi(field_sampler, self.court_roi_margin, to_top=True)
+        # Static frames are flagged before the detection models see them
+        if self.motion_threshold is not None:
+            pipeline.register(MotionGate(self.motion_threshold, roi=roi))
+        players = pipeline.register(
+            PlayerPositionCollector(
+                self.models.player, batch_size=self.batch_size, roi=roi, court_side=CourtSide(field_sampler)
+            )
+        )
+        thumbnails = ThumbnailCapture() if generate_thumbnails else None
+        balls = pipeline.register(
+            BallPresenceDetector(
+                self.models.ball,
+                on_segment_start=thumbnails.capture if thumbnails else None,
+                batch_size=self.batch_size,
+                sampling_fps=self.ball_sampling_fps,
+                boundary_tolerance=self.ball_boundary_tolerance,
+                roi=ball_roi,
+            )
+        )
+        if thumbnails:
+            pipeline.register(thumbnails)
+
+        video_info = pipeline.run()
 
-        tracks = get_heatmap(media_url)
+        self.logger.info("Getting field homography")
+        homography_matrix, _, _ = homography_from_field_points(field_sampler.field_points(), field_sampler.video_dims)
+        tracks = players.build_tracks(homography_matrix)
 
-        rallies = self._detect_rallies(media_url)
+        self.logger.info(f"Ball detection ran on {balls.frames_inferred} of {video_info.total_frames} frames")
+        rallies = self._detect_rallies(balls.detections, video_info)
 
         self._populate_players(tracks, rallies)
 
-        if generate_thumbnails:
-            thumbnail_keys = self.generate_thumbnails(media_key, media_url, rallies)
+        if thumbnails:
+            thumbnail_keys = self.generate_thumbnails(media_key, rallies, thumbnails.thumbnails)
         else:
             thumbnail_keys = [None] * len(rallies)
 
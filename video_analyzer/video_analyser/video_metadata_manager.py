@@ -1,10 +1,30 @@
+import base64
+import gzip
+import json
+import zlib
 from datetime import datetime
 from decimal import Decimal
 from enum import StrEnum, auto
-from uuid import UUID
+from functools import cache
+from pathlib import Path
+from uuid import UUID, uuid4
 
 import boto3
-from pydantic import BaseModel
+import numpy as np
+from botocore.exceptions import ClientError
+from pydantic import BaseModel, model_serializer, model_validator
+
+# Heatmaps are stored as the dense grid of the court cells (26 x 51, row-major), little-endian uint16 counts or
+# uint32 when a cell does not fit, zlib compressed and base64 encoded. The size of the grid tells the width.
+HEATMAP_SHAPE = (26, 51)
+
+MEDIA_TABLE = "users-media"
+
+# With the clip details kept in S3, the heatmaps and insights of the players go to one gzipped JSON object per
+# analysis run, next to the processed video: {clip_id: {player_id: {"heatmap_grid": ..., "insights": {...}}}}. The
+# media item keeps the clips with the players' analysis and the key of the object.
+CLIP_DETAILS_FILE = "clip_details_{run_id}.json.gz"
+CLIP_DETAILS_FIELDS = ("heatmap_grid", "insights")
 
 
 class ClipType(StrEnum):
@@ -22,12 +42,51 @@ class Insights(BaseModel):
     positioning: list[str]
 
 
+def encode_heatmap(heatmap: list[tuple[tuple[int, int], int]]) -> str:
+    grid = np.zeros(HEATMAP_SHAPE, dtype=np.uint32)
+    if heatmap:
+        cells, counts = zip(*heatmap, strict=True)
+        grid[tuple(np.array(cells).T)] = counts
+
+    dtype = "<u2" if grid.max() <= np.iinfo(np.uint16).max else "<u4"
+    return base64.b64encode(zlib.compress(grid.astype(dtype).tobytes())).decode("ascii")
+
+
+def decode_heatmap(encoded: str) -> list[tuple[tuple[int, int], int]]:
+    """
+    ((x, y), count) of the visited cells, the most visited first.
+    """
+    raw = zlib.decompress(base64.b64decode(encoded))
+    dtype = "<u2" if len(raw) == 2 * np.prod(HEATMAP_SHAPE) else "<u4"
+    grid = np.frombuffer(raw, dtype=dtype).reshape(HEATMAP_SHAPE)
+
+    xs, ys = np.nonzero(grid)
+    counts = grid[xs, ys]
+    order = np.argsort(-counts.astype(np.int64), kind="stable")
+    return list(zip(zip(xs[order].tolist(), ys[order].tolist(), strict=True), counts[order].tolist(), strict=True))
+
+
 class Player(BaseModel):
     player_id: int
     heatmap: list[tuple[tuple[int, int], int]]
     analysis: Analysis
     insights: Insights
 
+    @model_validator(mode="before")
+    @classmethod
+    def _decode_heatmap(cls, data):
+        if isinstance(data, dict) and "heatmap" not in data and "heatmap_grid" in data:
+            data = {**data, "heatmap": decode_heatmap(data["heatmap_grid"])}
+        return data
+
+    @model_serializer(mode="wrap")
+    def _encode_heatmap(self, handler):
+        # Stored as the compact grid, a list of cells gets close to the DynamoDB item size limit on long matches
+        data = handler(self)
+        del data["heatmap"]
+        data["heatmap_grid"] = encode_heatmap(self.heatmap)
+        return data
+
 
 class Clip(BaseModel):
     clip_id: UUID
@@ -63,6 +122,7 @@ class MediaInfo(BaseModel):
     frames_count: int | None = None
     duration_sec: int | None = None
     clips: list[Clip] | None = None
+    clip_details_s3_key: str | None = None
 
 
 def _convert_floats_to_decimal(data):
@@ -75,77 +135,121 @@ def _convert_floats_to_decimal(data):
     return data
 
 
-def update_video_status(media_id: UUID, s3_key: str, thumbnail_s3_key: str):
-    """
-    Update a video entry in DynamoDB after processing.
+@cache
+def _media_table():
+    # One DynamoDB resource per process, creating it is far slower than the update itself
+    return boto3.resource("dynamodb").Table(MEDIA_TABLE)
 
-    Args:
-        media_id: The primary key for the video entry
-        table_name: The name of the DynamoDB table
-        new_status: The new status to set for the video
-        **additional_updates: Any additional fields to update
 
-    Returns:
-        The updated VideoMetadata object
+def _update_media(media_id: UUID, values: dict, expected_states: tuple[MediaState, ...]) -> dict:
     """
-    # Initialize DynamoDB client
-
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table("users-media")
-
-    # Get the current item
-    response = table.get_item(Key={"media_id": str(media_id)})
+    Sets `values` on the media item in a single UpdateItem, only if the item exists and is in one of
+    `expected_states`, so the processor and the analyzer can't overwrite each other's progress.
 
-    if "Item" not in response:
-        raise ValueError(f"No video found with media_id: {media_id}")
-
-    # Convert DynamoDB item to Pydantic model
-    current_data = response["Item"]
-
-    # Parse the ISO format strings back to datetime objects
-    # if 'created_at' in current_data:
-    #     current_data['created_at'] = datetime.fromisoformat(current_data['created_at'])
-    # if 'updated_at' in current_data:
-    #     current_data['updated_at'] = datetime.fromisoformat(current_data['updated_at'])
-
-    # Create a Pydantic model from the DynamoDB item
-    video_metadata = MediaInfo.model_validate(current_data)
-
-    # Update the model with new values
-    video_metadata.state = MediaState.PROCESSED
-    video_metadata.updated_at = datetime.now()
-    video_metadata.processed_media_s3_key = s3_key
-    video_metadata.thumbnail_s3_key = thumbnail_s3_key
+    Returns:
+        The values the update replaced, attributes the item didn't have are left out
+    """
+    names = {"#state": "state"} | {f"#{field}": field for field in values}
+    expression_values = {f":{field}": value for field, value in values.items()}
+    expression_values |= {f":expected_{i}": str(state) for i, state in enumerate(expected_states)}
+    expected = ", ".join(f":expected_{i}" for i in range(len(expected_states)))
+
+    try:
+        response = _media_table().update_item(
+            Key={"media_id": str(media_id)},
+            UpdateExpression="SET " + ", ".join(f"#{field} = :{field}" for field in values),
+            ConditionExpression=f"attribute_exists(media_id) AND #state IN ({expected})",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=expression_values,
+            ReturnValues="UPDATED_OLD",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            raise ValueError(f"No video found with media_id {media_id} in state {', '.join(expected_states)}") from e
+        raise
+
+    return response.get("Attributes", {})
 
-    updated_item = video_metadata.model_dump(mode="json")
 
-    table.put_item(Item=updated_item)
+def update_video_status(media_id: UUID, s3_key: str, thumbnail_s3_key: str):
+    """
+    Marks a video as processed in DynamoDB.
 
-    return video_metadata
+    Args:
+        media_id: The primary key for the video entry
+        s3_key: Key of the processed video
+        thumbnail_s3_key: Key of the video thumbnail
 
+    Raises:
+        ValueError: The video doesn't exist or was already analysed
+    """
+    _update_media(
+        media_id,
+        {
+            "state": str(MediaState.PROCESSED),
+            "updated_at": datetime.now().isoformat(),
+            "processed_media_s3_key": s3_key,
+            "thumbnail_s3_key": thumbnail_s3_key,
+        },
+        expected_states=(MediaState.UPLOADING, MediaState.PROCESSING, MediaState.PROCESSED),
+    )
+
+
+def clip_details_key(media_key: str) -> str:
+    """
+    A new key on every call. Analysing the video again creates new clip ids, readers that cached the details by key
+    never mix them with an earlier run's.
+    """
+    return str(Path(media_key).parent / CLIP_DETAILS_FILE.format(run_id=uuid4().hex))
 
-def update_clips(media_id: UUID, clips: list[Clip]) -> None:
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table("users-media")
 
-    # Get the current item
-    response = table.get_item(Key={"media_id": str(media_id)})
+def upload_clip_details(s3, bucket: str, key: str, clips: list[Clip]) -> None:
+    """
+    Uploads the heatmaps and insights of the clips' players, the part of the clips update_clips leaves out of the
+    media item when given the key.
+    """
+    details = {
+        str(clip.clip_id): {
+            str(player_id): {field: data[field] for field in CLIP_DETAILS_FIELDS}
+            for player_id, data in clip.model_dump(mode="json")["players"].items()
+        }
+        for clip in clips
+    }
+    body = gzip.compress(json.dumps(details, separators=(",", ":")).encode("utf-8"))
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/gzip")
 
-    if "Item" not in response:
-        raise ValueError(f"No video found with media_id: {media_id}")
 
-    # Convert DynamoDB item to Pydantic model
-    current_data = response["Item"]
+def delete_clip_details(s3, bucket: str, key: str) -> None:
+    s3.delete_object(Bucket=bucket, Key=key)
 
-    # Create a Pydantic model from the DynamoDB item
-    video_metadata = MediaInfo.model_validate(current_data)
 
-    # Update the model with new values
-    video_metadata.state = MediaState.COMPLETE
-    video_metadata.updated_at = datetime.now()
-    video_metadata.clips = clips
+def update_clips(media_id: UUID, clips: list[Clip], clip_details_s3_key: str | None = None) -> str | None:
+    """
+    Stores the clips in the media item and marks it complete.
 
-    updated_item = video_metadata.model_dump(mode="json")
-    updated_item = _convert_floats_to_decimal(updated_item)
+    Args:
+        clip_details_s3_key: key of the object upload_clip_details put the heatmaps and insights in, the item then
+            only keeps the clip summaries and the key. Unset to store the clips whole.
 
-    table.put_item(Item=updated_item)
+    Returns:
+        Key of the clip details object of the previous analysis, nothing points at it anymore once this returns
+    """
+    clip_items = [clip.model_dump(mode="json") for clip in clips]
+    if clip_details_s3_key:
+        for clip in clip_items:
+            for player in clip["players"].values():
+                for field in CLIP_DETAILS_FIELDS:
+                    del player[field]
+
+    previous = _update_media(
+        media_id,
+        {
+            "state": str(MediaState.COMPLETE),
+            "updated_at": datetime.now().isoformat(),
+            "clips": _convert_floats_to_decimal(clip_items),
+            "clip_details_s3_key": clip_details_s3_key,
+        },
+        # Analysing the same video again replaces the clips
+        expected_states=(MediaState.PROCESSED, MediaState.ANALYZING, MediaState.COMPLETE),
+    )
+    return previous.get("clip_details_s3_key")
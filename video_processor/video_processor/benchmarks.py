@@ -0,0 +1,95 @@
+import re
+import subprocess
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import ffmpeg
+import typer
+
+from video_processor import EncodingMode, VideoPreprocessor
+
+app = typer.Typer()
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".mkv", ".avi"}
+
+
+def _sample_clips(paths: list[Path]) -> list[Path]:
+    clips = []
+    for path in paths:
+        if path.is_dir():
+            clips.extend(sorted(p for p in path.iterdir() if p.suffix.lower() in VIDEO_EXTENSIONS))
+        else:
+            clips.append(path)
+    return clips
+
+
+def _bitrate(path: Path) -> float:
+    """
+    Average bitrate of the whole file in kbit/s
+    """
+    duration = float(ffmpeg.probe(str(path))["format"]["duration"])
+    return path.stat().st_size * 8 / duration / 1000
+
+
+def _quality(encoded: Path, source: Path, target_height: int, fps: int) -> tuple[float, float]:
+    """
+    PSNR and SSIM of the encoded video against the source scaled and resampled the same way, so only the
+    encoder losses are measured
+    """
+    graph = (
+        f"[1:v]scale=-1:{target_height},fps=fps={fps}:round=down,split[ref1][ref2];"
+        "[0:v]split[enc1][enc2];[enc1][ref1]psnr;[enc2][ref2]ssim"
+    )
+    result = subprocess.run(
+        ["ffmpeg", "-nostats", "-i", str(encoded), "-i", str(source), "-lavfi", graph, "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    psnr = re.search(r"PSNR .*average:(\S+)", result.stderr)
+    ssim = re.search(r"SSIM .*All:(\S+)", result.stderr)
+    return float(psnr.group(1)) if psnr else float("nan"), float(ssim.group(1)) if ssim else float("nan")
+
+
+@app.command()
+def encoding(
+    clips: list[Path],
+    modes: list[EncodingMode] | None = None,
+    target_height: int = 720,
+    measure_quality: bool = True,
+):
+    """
+    Encode local sample clips in every encoding mode, comparing wall time, output bitrate and quality.
+
+    CLIPS are video files or directories of them, every mode is run unless some are given.
+    """
+    modes = modes or list(EncodingMode)
+    preprocessor = VideoPreprocessor(s3_client=None, target_bucket="", target_height=target_height)
+
+    print(f"{'clip':<32} {'MB':>7} {'mode':<11} {'wall s':>7} {'speed':>6} {'kbit/s':>7} {'PSNR':>6} {'SSIM':>6}")
+    for clip in _sample_clips(clips):
+        duration = float(ffmpeg.probe(str(clip))["format"]["duration"])
+        size_mb = clip.stat().st_size / 2**20
+
+        for mode in modes:
+            with TemporaryDirectory() as temp_dir:
+                output_path = Path(temp_dir) / "encoded.mp4"
+
+                started = time.perf_counter()
+                preprocessor.encode_file(str(clip), output_path, mode, Path(temp_dir) / "ffmpeg2pass")
+                wall_time = time.perf_counter() - started
+
+                psnr, ssim = (
+                    _quality(output_path, clip, target_height, preprocessor.TARGET_FPS)
+                    if measure_quality
+                    else (float("nan"), float("nan"))
+                )
+                print(
+                    f"{clip.name[:32]:<32} {size_mb:>7.1f} {mode:<11} {wall_time:>7.1f} "
+                    f"{duration / wall_time:>5.1f}x {_bitrate(output_path):>7.0f} {psnr:>6.2f} {ssim:>6.4f}"
+                )
+
+
+if __name__ == "__main__":
+    app()
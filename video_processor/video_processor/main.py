@@ -2,15 +2,17 @@ import json
 import logging
 import signal
 import time
+from typing import Annotated
 
 import boto3
 import psutil
 import typer
 from message_visibility_manager import MessageVisibilityManager
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from queue_models import QueueResponse
 
-from video_processor import VideoPreprocessor
+from video_processor import EncodingMode, VideoPreprocessor
 
 logging.basicConfig(
     level=logging.INFO,  # Set the logging level
@@ -35,6 +37,33 @@ class Settings(BaseSettings):
     DEBUG_MODE: bool = False
     LOG_LEVEL: str = "INFO"
 
+    # The source is downloaded once with parallel ranged GETs and encoded from the local copy, it is streamed
+    # from S3 for every FFmpeg run when disabled or when the disk has no room for it
+    SOURCE_CACHE_ENABLED: bool = True
+    SOURCE_DOWNLOAD_PART_SIZE_MB: int = 16
+    SOURCE_DOWNLOAD_WORKERS: int = 8
+
+    # The video is split at keyframes into this many segments, encoded in parallel and concatenated, 1 encodes
+    # it in a single FFmpeg run. Needs the source cache.
+    ENCODE_SEGMENTS: int = 1
+
+    # Rate control of the encoder, "two_pass" or "capped_crf" (a single CRF pass capped by maxrate/bufsize).
+    # Uploads of at least CAPPED_CRF_MIN_SOURCE_MB are encoded in capped CRF mode either way.
+    ENCODING_MODE: EncodingMode = EncodingMode.TWO_PASS
+    CAPPED_CRF_MIN_SOURCE_MB: int | None = None
+
+    # The processed video is uploaded in parts of at least this size, larger for long videos, with up to
+    # UPLOAD_WORKERS parts in flight while the encoder keeps writing
+    UPLOAD_PART_SIZE_MB: int = 8
+    UPLOAD_WORKERS: int = 4
+
+    # Height of a low resolution rendition encoded along the playback video for the analyser, which decodes it
+    # instead of the playback video. Keyframe every ANALYSIS_PROXY_GOP frames, 1 for all-intra. Unset to skip it.
+    # The analyser cuts the 270x150 clip thumbnails from the frames it decodes, so the proxy is at least 150 high
+    # and the thumbnails are never upscaled.
+    ANALYSIS_PROXY_HEIGHT: Annotated[int | None, Field(ge=150)] = None
+    ANALYSIS_PROXY_GOP: int = 15
+
     model_config = SettingsConfigDict(
         env_file=(".env", ".env.local", ".env.dev"),
         env_prefix="VIDEO_PROCESSOR_",
@@ -75,7 +104,22 @@ def main():
     sqs = boto3.client("sqs")
     s3 = boto3.client("s3")
 
-    video_processor = VideoPreprocessor(s3, settings.PROCESSED_FILES_BUCKET)
+    video_processor = VideoPreprocessor(
+        s3,
+        settings.PROCESSED_FILES_BUCKET,
+        cache_source=settings.SOURCE_CACHE_ENABLED,
+        download_part_size=settings.SOURCE_DOWNLOAD_PART_SIZE_MB * 1024 * 1024,
+        download_workers=settings.SOURCE_DOWNLOAD_WORKERS,
+        encode_segments=settings.ENCODE_SEGMENTS,
+        encoding_mode=settings.ENCODING_MODE,
+        capped_crf_min_size=(
+            settings.CAPPED_CRF_MIN_SOURCE_MB * 1024 * 1024 if settings.CAPPED_CRF_MIN_SOURCE_MB is not None else None
+        ),
+        upload_part_size=settings.UPLOAD_PART_SIZE_MB * 1024 * 1024,
+        upload_workers=settings.UPLOAD_WORKERS,
+        proxy_height=settings.ANALYSIS_PROXY_HEIGHT,
+        proxy_gop=settings.ANALYSIS_PROXY_GOP,
+    )
 
     while True:
         try:
@@ -99,14 +143,20 @@ def main():
                 ):
                     try:
                         for record in message.body.records:
-                            media_id, media_key = video_processor.process_video(record)
+                            media_id, media_key, analysis_media_key = video_processor.process_video(record)
 
                             logger.info("Enqueue message to the analysis queue")
 
                             # Send a message
                             sqs.send_message(
                                 QueueUrl=settings.OUTPUT_SQS_QUEUE,
-                                MessageBody=json.dumps({"media_id": str(media_id), "media_key": str(media_key)}),
+                                MessageBody=json.dumps(
+                                    {
+                                        "media_id": str(media_id),
+                                        "media_key": str(media_key),
+                                        "analysis_media_key": analysis_media_key,
+                                    }
+                                ),
                                 DelaySeconds=0,
                             )
 
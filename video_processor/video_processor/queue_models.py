@@ -12,6 +12,7 @@ class ResponseMetadata(BaseModel):
 class S3Record(BaseModel):
     bucket: Annotated[str, Field(alias=AliasPath("s3", "bucket", "name"))]
     key: Annotated[str, Field(alias=AliasPath("s3", "object", "key"))]
+    size: Annotated[int | None, Field(alias=AliasPath("s3", "object", "size"))] = None
 
 
 class MessageBody(BaseModel):
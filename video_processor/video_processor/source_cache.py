@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a response body and written to the file at a time
+CHUNK_SIZE = 1024 * 1024
+# Space left free next to the downloaded source for the pass logs and the thumbnail
+DISK_HEADROOM = 512 * 1024 * 1024
+
+_MD5_ETAG = re.compile(r"^[0-9a-f]{32}(-\d+)?$")
+
+
+class SourceVerificationError(Exception):
+    """The downloaded file doesn't match the S3 object"""
+
+    pass
+
+
+def download_source(
+    s3_client, bucket: str, key: str, target_dir: str | Path, part_size: int = 16 * 1024 * 1024, max_workers: int = 8
+) -> Path | None:
+    """
+    Download an S3 object once into a local directory with parallel ranged GETs
+
+    Every range is requested with the ETag of the object, so all of them come from the same version, and the file
+    is checked against the object's size and ETag once complete.
+
+    Args:
+        s3_client: Initialized S3 client
+        bucket: S3 bucket name
+        key: S3 object key
+        target_dir: Directory the file is written to
+        part_size: Size of the ranges, objects uploaded in parts are downloaded along their own parts
+        max_workers: Number of ranges downloaded at the same time
+
+    Returns:
+        Path of the downloaded file, None when the directory has no room for it or the download failed,
+        the object has to be streamed then
+    """
+    path = Path(target_dir) / f"source{Path(key).suffix}"
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        size = head["ContentLength"]
+        etag = head["ETag"].strip('"')
+
+        free = shutil.disk_usage(target_dir).free
+        if free < size + DISK_HEADROOM:
+            logger.warning(f"Not enough disk space to download {key} ({size} bytes, {free} free), streaming it instead")
+            return None
+
+        part_digests = _download(s3_client, bucket, key, head, path, part_size, max_workers)
+        _verify(path, etag, part_digests)
+    except (BotoCoreError, ClientError, OSError, SourceVerificationError) as e:
+        logger.warning(f"Failed to download {key}, streaming it instead: {e}")
+        path.unlink(missing_ok=True)
+        return None
+
+    logger.info(f"Downloaded {key} ({size} bytes) to {path}")
+    return path
+
+
+def _ranges(size: int, part_size: int) -> list[tuple[int, int]]:
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def _download(
+    s3_client, bucket: str, key: str, head: dict, path: Path, part_size: int, max_workers: int
+) -> list[bytes] | None:
+    """
+    Returns the MD5 digests of the parts when the object was uploaded in parts
+    """
+    size = head["ContentLength"]
+    etag = head["ETag"].strip('"')
+
+    # A multipart ETag is the MD5 of the parts' MD5s, downloading along the same parts checks it without
+    # reading the file again
+    multipart = "-" in etag
+    if multipart:
+        part_size = s3_client.head_object(Bucket=bucket, Key=key, PartNumber=1)["ContentLength"]
+
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+    def download_range(byte_range: tuple[int, int]) -> bytes:
+        start, end = byte_range
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=head["ETag"])
+        digest = hashlib.md5(usedforsecurity=False)
+        written = 0
+        with open(path, "r+b") as file:
+            file.seek(start)
+            for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+                file.write(chunk)
+                written += len(chunk)
+                if multipart:
+                    digest.update(chunk)
+
+        # The file is preallocated, a short read would leave zeros behind without changing its size
+        if written != end - start + 1:
+            raise SourceVerificationError(f"Got {written} bytes for range {start}-{end}")
+        return digest.digest()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = list(executor.map(download_range, _ranges(size, part_size)))
+
+    return digests if multipart else None
+
+
+def _verify(path: Path, etag: str, part_digests: list[bytes] | None) -> None:
+    if not _MD5_ETAG.match(etag):
+        # e.g. objects encrypted with KMS, their ETag is not an MD5
+        logger.info(f"ETag {etag} is not an MD5, only the sizes of the ranges are checked")
+        return
+
+    if part_digests is not None:
+        digest = f"{hashlib.md5(b''.join(part_digests), usedforsecurity=False).hexdigest()}-{len(part_digests)}"
+    else:
+        md5 = hashlib.md5(usedforsecurity=False)
+        with open(path, "rb") as file:
+            while chunk := file.read(CHUNK_SIZE * 8):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+
+    if digest != etag:
+        raise SourceVerificationError(f"Downloaded file has ETag {digest}, the object has {etag}")
@@ -1,10 +1,14 @@
 from datetime import datetime
 from enum import StrEnum, auto
+from functools import cache
 from uuid import UUID
 
 import boto3
+from botocore.exceptions import ClientError
 from pydantic import BaseModel
 
+MEDIA_TABLE = "users-media"
+
 
 class MediaState(StrEnum):
     UPLOADING = auto()
@@ -30,46 +34,60 @@ class MediaInfo(BaseModel):
     duration_sec: int | None = None
 
 
-def update_video_status(media_id: UUID, s3_key: str, thumbnail_s3_key: str, frames_count: int, duration_sec: int):
-    """
-    Update a video entry in DynamoDB after processing.
+@cache
+def _media_table():
+    # One DynamoDB resource per process, creating it is far slower than the update itself
+    return boto3.resource("dynamodb").Table(MEDIA_TABLE)
 
-    Args:
-        media_id: The primary key for the video entry
-        table_name: The name of the DynamoDB table
-        new_status: The new status to set for the video
-        **additional_updates: Any additional fields to update
 
-    Returns:
-        The updated VideoMetadata object
+def _update_media(media_id: UUID, values: dict, expected_states: tuple[MediaState, ...]) -> None:
     """
-    # Initialize DynamoDB client
-
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table("users-media")
-
-    # Get the current item
-    response = table.get_item(Key={"media_id": str(media_id)})
-
-    if "Item" not in response:
-        raise ValueError(f"No video found with media_id: {media_id}")
-
-    # Convert DynamoDB item to Pydantic model
-    current_data = response["Item"]
-
-    # Create a Pydantic model from the DynamoDB item
-    video_metadata = MediaInfo.model_validate(current_data)
+    Sets `values` on the media item in a single UpdateItem, only if the item exists and is in one of
+    `expected_states`, so the processor and the analyzer can't overwrite each other's progress.
+    """
+    names = {"#state": "state"} | {f"#{field}": field for field in values}
+    expression_values = {f":{field}": value for field, value in values.items()}
+    expression_values |= {f":expected_{i}": str(state) for i, state in enumerate(expected_states)}
+    expected = ", ".join(f":expected_{i}" for i in range(len(expected_states)))
+
+    try:
+        _media_table().update_item(
+            Key={"media_id": str(media_id)},
+            UpdateExpression="SET " + ", ".join(f"#{field} = :{field}" for field in values),
+            ConditionExpression=f"attribute_exists(media_id) AND #state IN ({expected})",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=expression_values,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            raise ValueError(f"No video found with media_id {media_id} in state {', '.join(expected_states)}") from e
+        raise
 
-    # Update the model with new values
-    video_metadata.state = MediaState.PROCESSED
-    video_metadata.updated_at = datetime.now()
-    video_metadata.processed_media_s3_key = s3_key
-    video_metadata.thumbnail_s3_key = thumbnail_s3_key
-    video_metadata.frames_count = frames_count
-    video_metadata.duration_sec = duration_sec
 
-    updated_item = video_metadata.model_dump(mode="json")
+def update_video_status(media_id: UUID, s3_key: str, thumbnail_s3_key: str, frames_count: int, duration_sec: int):
+    """
+    Marks a video as processed in DynamoDB.
 
-    table.put_item(Item=updated_item)
+    Args:
+        media_id: The primary key for the video entry
+        s3_key: Key of the processed video
+        thumbnail_s3_key: Key of the video thumbnail
+        frames_count: Number of frames of the processed video
+        duration_sec: Duration of the processed video
 
-    return video_metadata
+    Raises:
+        ValueError: The video doesn't exist or was already analysed
+    """
+    _update_media(
+        media_id,
+        {
+            "state": str(MediaState.PROCESSED),
+            "updated_at": datetime.now().isoformat(),
+            "processed_media_s3_key": s3_key,
+            "thumbnail_s3_key": thumbnail_s3_key,
+            "frames_count": frames_count,
+            "duration_sec": duration_sec,
+        },
+        # A redelivered message processes the video again, but never after the analyzer took it over
+        expected_states=(MediaState.UPLOADING, MediaState.PROCESSING, MediaState.PROCESSED),
+    )
@@ -1,3 +1,4 @@
+import bisect
 import logging
 import os
 import re
@@ -5,20 +6,20 @@ import select
 import subprocess
 import threading
 import time
-from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from dataclasses import dataclass
 from enum import StrEnum
-from io import BytesIO
 from pathlib import Path
 from queue import Queue
 from tempfile import TemporaryDirectory
-from typing import Any
+from typing import Any, BinaryIO
 from uuid import UUID
 
 import ffmpeg
-from botocore.exceptions import BotoCoreError
+from botocore.exceptions import BotoCoreError, ClientError
 from queue_models import S3Record
+from source_cache import download_source
 from thumbnail_creator import extract_thumbnail
 from video_metadata_manager import update_video_status
 
@@ -27,6 +28,17 @@ class VideoCodec(StrEnum):
     H264 = "libx264"
 
 
+class EncodingMode(StrEnum):
+    # Analysis pass then an average bitrate pass, the bitrate is met closely but the input is decoded twice
+    TWO_PASS = "two_pass"
+    # A single constant quality pass with the bitrate capped by maxrate/bufsize
+    CAPPED_CRF = "capped_crf"
+
+    @property
+    def passes(self) -> tuple[int, ...]:
+        return (1, 2) if self is EncodingMode.TWO_PASS else (0,)
+
+
 @dataclass
 class ProgressInfo:
     """Stores FFmpeg encoding progress information"""
@@ -38,6 +50,79 @@ class ProgressInfo:
     bitrate: str = ""
     speed: str = "0x"  # Changed to string to handle the 'x' suffix
     progress: str = ""
+    # Set for the passes of segment encoding, FFmpeg never reports these
+    segment: int | None = None
+    pass_number: int = 0
+
+
+@dataclass
+class Segment:
+    """A time range of the source encoded on its own"""
+
+    index: int
+    start: float
+    end: float | None  # None for the last segment, it runs to the end of the source
+
+    @property
+    def input_options(self) -> dict[str, Any]:
+        # Seeking before the input starts decoding at the keyframe the segment starts at
+        options: dict[str, Any] = {"ss": self.start}
+        if self.end is not None:
+            options["t"] = self.end - self.start
+        return options
+
+
+def plan_segments(keyframes: list[float], duration: float, count: int, min_duration: float) -> list[Segment]:
+    """
+    Split the source into up to `count` segments of about the same duration, each starting at a keyframe
+
+    Args:
+        keyframes: Sorted timestamps of the source keyframes
+        duration: Duration of the source in seconds
+        count: Number of segments wanted
+        min_duration: Shortest segment in seconds, boundaries closer than this are dropped
+
+    Returns:
+        The segments in order, a single one when the source has no keyframes to split at
+    """
+    starts = [0.0]
+    for i in range(1, count):
+        position = bisect.bisect_left(keyframes, duration * i / count)
+        if position == len(keyframes):
+            break
+
+        keyframe = keyframes[position]
+        if keyframe - starts[-1] >= min_duration and duration - keyframe >= min_duration:
+            starts.append(keyframe)
+
+    ends = [*starts[1:], None]
+    return [Segment(index, start, end) for index, (start, end) in enumerate(zip(starts, ends, strict=True))]
+
+
+def _read_into(stream: BinaryIO, buffer: memoryview) -> int:
+    """
+    Fill the buffer from the stream, pipes return what they have so a single readinto is often short
+
+    Returns:
+        Number of bytes read, less than the buffer size only at the end of the stream
+    """
+    filled = 0
+    while filled < len(buffer):
+        count = stream.readinto(buffer[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+def _parse_bitrate(bitrate: str) -> int:
+    """
+    Bits per second of an FFmpeg bitrate such as "2.5M"
+    """
+    multipliers = {"k": 1_000, "K": 1_000, "M": 1_000_000, "G": 1_000_000_000}
+    if bitrate[-1] in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+    return int(bitrate)
 
 
 class FFmpegError(Exception):
@@ -49,6 +134,18 @@ class FFmpegError(Exception):
 class VideoPreprocessor:
     # Minimum part size for multipart uploads (5MB)
     MIN_PART_SIZE = 5 * 1024 * 1024
+    # Most parts a multipart upload can have
+    MAX_PARTS = 10_000
+    # The upload part size doubles after this many parts
+    PART_SIZE_DOUBLING_PARTS = 1_000
+    # Shortest segment worth an encoder of its own
+    MIN_SEGMENT_SEC = 10.0
+    # Frame rate of the processed video
+    TARGET_FPS = 30
+    # Quality of the single pass mode, the bitrate stays under maxrate either way
+    CRF = 23
+    # Most encoder threads of the analysis proxy, it is a fraction of the playback video's pixels
+    PROXY_MAX_THREADS = 2
 
     def __init__(
         self,
@@ -57,6 +154,16 @@ class VideoPreprocessor:
         target_width: int = 1080,
         target_height: int = 720,
         progress_interval: int = 30,
+        cache_source: bool = True,
+        download_part_size: int = 16 * 1024 * 1024,
+        download_workers: int = 8,
+        encode_segments: int = 1,
+        encoding_mode: EncodingMode = EncodingMode.TWO_PASS,
+        capped_crf_min_size: int | None = None,
+        upload_part_size: int = 8 * 1024 * 1024,
+        upload_workers: int = 4,
+        proxy_height: int | None = None,
+        proxy_gop: int = 15,
     ):
         """
         Initialize video preprocessor
@@ -66,12 +173,36 @@ class VideoPreprocessor:
             target_bucket: Target S3 bucket for processed videos
             target_height: Target height in pixels (default: 1080 for Full HD)
             progress_interval: Interval in seconds for progress updates (default: 30)
+            cache_source: Download the source once and run FFmpeg on the local copy instead of streaming it
+                for every pass (default: True)
+            download_part_size: Size of the ranges the source is downloaded in (default: 16MB)
+            download_workers: Number of ranges downloaded in parallel (default: 8)
+            encode_segments: Number of segments the video is split into and encoded in parallel, 1 encodes
+                it in a single run (default: 1)
+            encoding_mode: Rate control of the encoder (default: two pass)
+            capped_crf_min_size: Sources of at least this many bytes are encoded in a single capped CRF pass
+                whatever the encoding mode (default: None)
+            upload_part_size: Smallest part size of the multipart upload, larger for long videos (default: 8MB)
+            upload_workers: Number of parts uploaded in parallel (default: 4)
+            proxy_height: Height of the analysis proxy encoded along the playback video, none when not set
+                (default: None)
+            proxy_gop: Keyframe interval of the analysis proxy, 1 for all-intra (default: 15)
         """
         self.s3 = s3_client
         self.target_bucket = target_bucket
         self.target_height = target_height
         self.target_width = target_width
         self.progress_interval = progress_interval
+        self.cache_source = cache_source
+        self.download_part_size = download_part_size
+        self.download_workers = download_workers
+        self.encode_segments = encode_segments
+        self.encoding_mode = encoding_mode
+        self.capped_crf_min_size = capped_crf_min_size
+        self.upload_part_size = upload_part_size
+        self.upload_workers = upload_workers
+        self.proxy_height = proxy_height
+        self.proxy_gop = proxy_gop
         self.logger = logging.getLogger(__name__)
 
     def _get_codec_settings(self, codec: VideoCodec, pass_number: int = 0) -> dict[str, Any]:
@@ -80,7 +211,7 @@ class VideoPreprocessor:
 
         Args:
             codec: Video codec to use
-            pass_number: 1 for first pass, 2 for second pass, 0 for single pass
+            pass_number: 1 for first pass, 2 for second pass, 0 for a single capped CRF pass
 
         Returns:
             Dictionary of FFmpeg settings
@@ -112,7 +243,31 @@ class VideoPreprocessor:
         elif pass_number == 2:
             return {**settings, "pass": 2, "format": "mp4"}
         else:
-            return {**settings, "crf": 23, "format": "mp4"}
+            # Constant quality instead of the average bitrate, maxrate and bufsize still cap it
+            settings.pop("b:v")
+            return {**settings, "crf": self.CRF, "format": "mp4"}
+
+    def _get_proxy_settings(self) -> dict[str, Any]:
+        """
+        Get FFmpeg settings of the analysis proxy, made to decode cheaply rather than to look good
+
+        Returns:
+            Dictionary of FFmpeg settings
+        """
+        return {
+            "acodec": "none",  # No audio
+            "vcodec": VideoCodec.H264.value,
+            "preset": "veryfast",
+            # No CABAC and no deblocking, the decoder has less to do
+            "tune": "fastdecode",
+            "pix_fmt": "yuv420p",
+            "crf": 28,
+            # 1 makes every frame a keyframe
+            "g": self.proxy_gop,
+            "bf": 0,
+            "movflags": "+faststart",
+            "format": "mp4",
+        }
 
     def _parse_progress_line(self, line: str, progress_info: ProgressInfo) -> None:
         """
@@ -245,7 +400,9 @@ class VideoPreprocessor:
             self.logger.error(f"Traceback: {traceback.format_exc()}")
             raise FFmpegError(f"Failed to get video information: {e}") from e
 
-    def _monitor_progress(self, progress_fd: int, progress_queue: Queue, pass_number: int) -> None:
+    def _monitor_progress(
+        self, progress_fd: int, progress_queue: Queue, pass_number: int, segment: int | None = None
+    ) -> None:
         """
         Monitor FFmpeg progress and send updates through queue
 
@@ -253,8 +410,10 @@ class VideoPreprocessor:
             progress_fd: File descriptor for progress pipe
             progress_queue: Queue for progress updates
             pass_number: Current pass number (1 or 2)
+            segment: Index of the segment being encoded, its updates are only logged once aggregated
         """
-        progress_info = ProgressInfo()
+        progress_info = ProgressInfo(segment=segment, pass_number=pass_number)
+        name = f"Pass {pass_number}" if segment is None else f"Segment {segment} pass {pass_number}"
 
         with os.fdopen(progress_fd, "r") as progress_file:
             last_log_time = time.time()
@@ -271,24 +430,60 @@ class VideoPreprocessor:
                 self._parse_progress_line(line, progress_info)
                 if progress_info.progress == "end":
                     progress_queue.put(("complete", progress_info))
-                    self.logger.info("Pass %d completed: %s", pass_number, progress_info)
+                    self.logger.info("%s completed: %s", name, progress_info)
                     break
 
                 current_time = time.time()
                 if current_time - last_log_time >= self.progress_interval:
                     progress_queue.put(("update", progress_info))
-                    self.logger.info("Pass %d progress: %s", pass_number, progress_info)
+                    if segment is None:
+                        self.logger.info("%s progress: %s", name, progress_info)
                     last_log_time = current_time
 
-    def _run_ffmpeg_pass(
-        self, stream: ffmpeg.Stream, passlogfile: str | None = None, progress_pipe: int | None = None
-    ) -> subprocess.Popen:
+    def _log_segments_progress(
+        self, progress_queue: Queue, segments: int, passes: tuple[int, ...], total_frames: int
+    ) -> None:
+        """
+        Aggregate the progress updates of all the segment passes until a "stop" message
+
+        Args:
+            progress_queue: Queue the segment monitors send their updates to
+            segments: Number of segments being encoded
+            passes: Pass numbers every segment goes through
+            total_frames: Number of frames of the whole processed video
+        """
+        latest: dict[tuple[int, int], ProgressInfo] = {}
+        completed = 0
+        last_log_time = time.time()
+
+        while True:
+            status, progress_info = progress_queue.get()
+            if status == "stop":
+                break
+
+            latest[(progress_info.segment, progress_info.pass_number)] = progress_info
+            if status == "complete":
+                completed += 1
+
+            current_time = time.time()
+            if current_time - last_log_time >= self.progress_interval:
+                frames = dict.fromkeys(passes, 0)
+                for (_, pass_number), info in latest.items():
+                    frames[pass_number] += info.frame
+                self.logger.info(
+                    "Segments progress: %s, %d of %d segment passes complete",
+                    ", ".join(f"pass {number} {count}/{total_frames} frames" for number, count in frames.items()),
+                    completed,
+                    len(passes) * segments,
+                )
+                last_log_time = current_time
+
+    def _run_ffmpeg_pass(self, stream: ffmpeg.Stream, progress_pipe: int | None = None) -> subprocess.Popen:
         """
         Run a single FFmpeg pass
 
         Args:
-            stream: Configured FFmpeg stream
-            passlogfile: Path to passlog file for 2-pass encoding
+            stream: Configured FFmpeg stream, including its outputs' options
             progress_pipe: File descriptor for progress pipe
 
         Returns:
@@ -298,9 +493,6 @@ class VideoPreprocessor:
             FFmpegError: If FFmpeg process fails
         """
         cmd = stream.compile()
-        if passlogfile:
-            cmd.extend(["-passlogfile", str(passlogfile)])
-
         cmd.extend(
             [
                 "-loglevel",
@@ -322,57 +514,380 @@ class VideoPreprocessor:
 
         return process
 
+    def _get_keyframe_times(self, input_path: str) -> list[float]:
+        """
+        Get the timestamps of the video keyframes, read from the packet flags without decoding
+
+        Args:
+            input_path: Path to the input video
+
+        Returns:
+            Sorted keyframe timestamps in seconds
+        """
+        try:
+            probe = ffmpeg.probe(input_path, v="error", select_streams="v:0", show_entries="packet=pts_time,flags")
+        except ffmpeg.Error as e:
+            error_message = e.stderr.decode() if hasattr(e, "stderr") else str(e)
+            raise FFmpegError(f"Failed to get keyframes: {error_message}") from e
+
+        return sorted(
+            float(packet["pts_time"])
+            for packet in probe.get("packets", [])
+            if "K" in packet.get("flags", "") and packet.get("pts_time", "N/A") != "N/A"
+        )
+
+    def _split_threads(self, threads: int | None, with_proxy: bool) -> tuple[int | None, int | None]:
+        """
+        Split the threads of an FFmpeg run between the playback and the proxy encoder
+
+        Args:
+            threads: Threads of the whole run, chosen by FFmpeg when not set
+            with_proxy: Whether the run also encodes the proxy
+
+        Returns:
+            Threads of the playback encoder (None lets FFmpeg choose) and of the proxy encoder (None without proxy)
+        """
+        if not with_proxy:
+            return threads, None
+        if threads is None:
+            return None, self.PROXY_MAX_THREADS
+
+        proxy_threads = min(self.PROXY_MAX_THREADS, max(1, threads // 4))
+        return max(1, threads - proxy_threads), proxy_threads
+
+    def _start_encoding(
+        self,
+        input_path: str,
+        output: str,
+        mode: EncodingMode,
+        passlogfile: Path,
+        progress_queue: Queue,
+        segment: Segment | None = None,
+        threads: int | None = None,
+        proxy_output: str | None = None,
+    ) -> tuple[subprocess.Popen, threading.Thread]:
+        """
+        Run the passes of the encoding mode before the last one and start the last one
+
+        Args:
+            input_path: URL or path to the input video
+            output: Where the last pass writes the video, "pipe:" for its stdout
+            mode: Encoding mode
+            passlogfile: Path of the pass log of two pass encoding
+            progress_queue: Queue for progress updates
+            segment: Only encode this segment of the input
+            threads: Number of threads of the encoder, chosen by FFmpeg when not set. Shared with the proxy
+                encoder in the last pass when it writes the proxy.
+            proxy_output: Where the last pass also writes the analysis proxy, from the same decoded frames
+
+        Returns:
+            The running FFmpeg process of the last pass and the thread monitoring its progress
+
+        Raises:
+            FFmpegError: If a pass before the last one fails
+        """
+        input_options = segment.input_options if segment else {}
+        name = "Encoding" if segment is None else f"Segment {segment.index} encoding"
+
+        *first_passes, last_pass = mode.passes
+        for pass_number in [*first_passes, last_pass]:
+            self.logger.info("%s pass %d starting", name, pass_number)
+            progress_r, progress_w = os.pipe()
+            os.set_inheritable(progress_w, True)
+
+            progress_thread = threading.Thread(
+                target=self._monitor_progress,
+                args=(progress_r, progress_queue, pass_number, segment.index if segment else None),
+                daemon=True,
+            )
+            progress_thread.start()
+
+            with_proxy = pass_number == last_pass and proxy_output is not None
+            playback_threads, proxy_threads = self._split_threads(threads, with_proxy)
+
+            output_settings = self._get_codec_settings(VideoCodec.H264, pass_number=pass_number)
+            if pass_number:
+                # An output option, FFmpeg ignores options after the last output
+                output_settings["passlogfile"] = str(passlogfile)
+            if playback_threads:
+                output_settings["threads"] = playback_threads
+
+            video = (
+                ffmpeg.input(input_path, protocol_whitelist="https,tls,tcp,file", **input_options)
+                .filter("scale", -1, self.target_height)
+                .filter("fps", fps=self.TARGET_FPS, round="down")
+            )
+
+            if with_proxy:
+                # Split after the fps filter, so the proxy has the same frames as the playback video
+                branches = video.filter_multi_output("split")
+                proxy_settings = self._get_proxy_settings()
+                proxy_settings["threads"] = proxy_threads
+                stream = ffmpeg.merge_outputs(
+                    branches.stream(0).output(output, **output_settings),
+                    branches.stream(1).filter("scale", -2, self.proxy_height).output(proxy_output, **proxy_settings),
+                )
+            else:
+                stream = video.output(output if pass_number == last_pass else "pipe:", **output_settings)
+
+            process = self._run_ffmpeg_pass(stream, progress_w)
+
+            # Close write end in parent
+            os.close(progress_w)
+
+            if pass_number == last_pass:
+                return process, progress_thread
+
+            _, stderr_output = process.communicate()
+            progress_thread.join()
+
+            if process.returncode != 0:
+                raise FFmpegError(
+                    f"{name} pass {pass_number} failed with code {process.returncode}: {stderr_output.decode()}"
+                )
+
+            self.logger.info("%s pass %d completed successfully", name, pass_number)
+
+    def encode_file(
+        self,
+        input_path: str,
+        output_path: Path,
+        mode: EncodingMode,
+        passlogfile: Path,
+        progress_queue: Queue | None = None,
+        segment: Segment | None = None,
+        threads: int | None = None,
+        proxy_path: Path | None = None,
+    ) -> Path:
+        """
+        Encode a video, or a segment of it, into a local file
+
+        Args:
+            input_path: URL or path to the input video
+            output_path: Path of the encoded video
+            mode: Encoding mode
+            passlogfile: Path of the pass log of two pass encoding
+            progress_queue: Queue for progress updates
+            segment: Only encode this segment of the input
+            threads: Number of threads of the encoder, chosen by FFmpeg when not set. Shared with the proxy
+                encoder when it runs.
+            proxy_path: Path of the analysis proxy encoded along, none when not set
+
+        Returns:
+            Path of the encoded video
+
+        Raises:
+            FFmpegError: If any pass fails
+        """
+        process, progress_thread = self._start_encoding(
+            input_path,
+            str(output_path),
+            mode,
+            passlogfile,
+            progress_queue or Queue(),
+            segment,
+            threads,
+            str(proxy_path) if proxy_path else None,
+        )
+
+        _, stderr_output = process.communicate()
+        progress_thread.join()
+
+        if process.returncode != 0:
+            raise FFmpegError(f"Encoding failed with code {process.returncode}: {stderr_output.decode()}")
+
+        return output_path
+
+    def _encode_segments(
+        self,
+        input_path: str,
+        temp_dir: Path,
+        mode: EncodingMode,
+        progress_queue: Queue,
+        video_info: dict,
+        proxy_path: Path | None = None,
+    ) -> subprocess.Popen:
+        """
+        Split the video at keyframes, encode the segments in parallel and concatenate them without re-encoding
+
+        Args:
+            input_path: Path to the input video
+            temp_dir: Directory for the pass logs and the encoded segments
+            mode: Encoding mode of the segments
+            progress_queue: Queue for progress updates
+            video_info: Information of the input video from _get_video_info
+            proxy_path: Path of the analysis proxy, its segments are encoded along and concatenated there
+
+        Returns:
+            subprocess.Popen: The running FFmpeg process writing the concatenated MP4 to stdout
+
+        Raises:
+            FFmpegError: If encoding a segment or concatenating the proxy fails
+        """
+        keyframes = self._get_keyframe_times(input_path)
+        segments = plan_segments(keyframes, video_info["duration_seconds"], self.encode_segments, self.MIN_SEGMENT_SEC)
+
+        cpus = os.cpu_count() or 1
+        workers = min(len(segments), cpus)
+        # Every FFmpeg run gets its share of the cores, libx264 otherwise starts a thread pool per core in each.
+        # The proxy encoder of a run takes its threads from that share.
+        threads = max(1, cpus // workers)
+        self.logger.info(
+            "Encoding %d segments with %d encoders of %d threads (%d keyframes)",
+            len(segments),
+            workers,
+            threads,
+            len(keyframes),
+        )
+
+        progress_thread = threading.Thread(
+            target=self._log_segments_progress,
+            args=(progress_queue, len(segments), mode.passes, video_info["duration_seconds"] * self.TARGET_FPS),
+            daemon=True,
+        )
+        progress_thread.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                outputs = list(
+                    executor.map(
+                        lambda segment: self.encode_file(
+                            input_path,
+                            temp_dir / f"segment_{segment.index:04d}.mp4",
+                            mode,
+                            temp_dir / "passes" / f"segment_{segment.index:04d}",
+                            progress_queue,
+                            segment,
+                            threads,
+                            temp_dir / f"proxy_segment_{segment.index:04d}.mp4" if proxy_path else None,
+                        ),
+                        segments,
+                    )
+                )
+        finally:
+            progress_queue.put(("stop", None))
+            progress_thread.join()
+
+        self.logger.info("All segments encoded, concatenating")
+
+        if proxy_path:
+            proxy_segments = [temp_dir / f"proxy_segment_{segment.index:04d}.mp4" for segment in segments]
+            process = self._run_ffmpeg_pass(
+                self._concat(proxy_segments, temp_dir / "proxy_segments.txt", str(proxy_path), movflags="+faststart")
+            )
+            _, stderr_output = process.communicate()
+            if process.returncode != 0:
+                raise FFmpegError(
+                    f"Proxy concatenation failed with code {process.returncode}: {stderr_output.decode()}"
+                )
+
+        stream = self._concat(
+            outputs, temp_dir / "segments.txt", "pipe:", movflags="frag_keyframe+empty_moov+faststart"
+        )
+        return self._run_ffmpeg_pass(stream)
+
+    def _concat(self, paths: list[Path], list_path: Path, output: str, **output_settings) -> ffmpeg.Stream:
+        """
+        Concatenate MP4 files encoded with the same settings without re-encoding them
+
+        Args:
+            paths: Files to concatenate, in order
+            list_path: Where the list of files for the concat demuxer is written
+            output: Where the concatenated MP4 is written, "pipe:" for stdout
+            **output_settings: Additional output options
+
+        Returns:
+            Configured FFmpeg stream
+        """
+        list_path.write_text("".join(f"file '{path}'\n" for path in paths))
+        return ffmpeg.input(str(list_path), f="concat", safe=0).output(
+            output, c="copy", format="mp4", **output_settings
+        )
+
+    def _part_size(self, expected_size: int | None) -> int:
+        """
+        Size of the first upload parts, big enough for an output of `expected_size` bytes to take at most half
+        of the parts an upload can have
+        """
+        part_size = max(self.MIN_PART_SIZE, self.upload_part_size)
+        if expected_size:
+            part_size = max(part_size, -(-2 * expected_size // self.MAX_PARTS))
+        # Rounded up to whole MB
+        return -(-part_size // 2**20) * 2**20
+
     def _create_upload_parts(
-        self, process: subprocess.Popen, upload_id: str, key: str
-    ) -> Generator[dict[str, Any], None, None]:
+        self, stream: BinaryIO, upload_id: str, key: str, expected_size: int | None = None
+    ) -> list[dict[str, Any]]:
         """
         Create and upload parts for multipart upload
 
+        The calling thread reads the stream into preallocated part buffers while a pool of workers uploads the
+        filled ones. Reading waits for a free buffer, so at most `upload_workers` parts are in flight and a slow
+        upload only holds the encoder back once every buffer is taken. The part size doubles every
+        PART_SIZE_DOUBLING_PARTS parts, an output larger than expected still fits in MAX_PARTS parts.
+
         Args:
-            process: FFmpeg subprocess with stdout pipe
+            stream: FFmpeg stdout pipe
             upload_id: S3 multipart upload ID
             key: S3 object key
+            expected_size: Expected size of the output in bytes, to pick the part size
 
-        Yields:
-            Dict containing PartNumber and ETag for each uploaded part
-        """
-        buffer = BytesIO()
-        part_number = 1
+        Returns:
+            Dicts containing PartNumber and ETag for each uploaded part, in part order
 
-        while True:
-            chunk = process.stdout.read(8192)  # 8KB chunks
-            if not chunk:
-                break
+        Raises:
+            BotoCoreError, ClientError: If uploading a part fails
+        """
+        part_size = self._part_size(expected_size)
+        free_buffers: Queue[bytearray] = Queue()
+        for _ in range(self.upload_workers + 1):
+            free_buffers.put(bytearray(part_size))
 
-            buffer.write(chunk)
+        etags: dict[int, str] = {}
+        failed = threading.Event()
 
-            if buffer.tell() >= self.MIN_PART_SIZE:
-                buffer.seek(0)
+        def upload_part(part_number: int, buffer: bytearray, size: int) -> None:
+            try:
                 part = self.s3.upload_part(
                     Bucket=self.target_bucket,
                     Key=key,
                     PartNumber=part_number,
                     UploadId=upload_id,
-                    Body=buffer.getvalue(),
+                    # A full buffer is sent as it is, only the last part is copied
+                    Body=buffer if size == len(buffer) else bytes(memoryview(buffer)[:size]),
                 )
+                etags[part_number] = part["ETag"]
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                free_buffers.put(buffer)
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            futures = []
+            part_number = 1
+            while not failed.is_set():
+                buffer = free_buffers.get()
+                if len(buffer) != part_size:
+                    buffer = bytearray(part_size)
+
+                size = _read_into(stream, memoryview(buffer))
+                if size == 0:
+                    break
 
-                yield {"PartNumber": part_number, "ETag": part["ETag"]}
+                futures.append(executor.submit(upload_part, part_number, buffer, size))
+                if size < part_size:
+                    break
 
+                if part_number % self.PART_SIZE_DOUBLING_PARTS == 0:
+                    part_size *= 2
                 part_number += 1
-                buffer = BytesIO()
-
-        # Upload final part if there's any data left
-        if buffer.tell() > 0:
-            buffer.seek(0)
-            part = self.s3.upload_part(
-                Bucket=self.target_bucket,
-                Key=key,
-                PartNumber=part_number,
-                UploadId=upload_id,
-                Body=buffer.getvalue(),
-            )
 
-            yield {"PartNumber": part_number, "ETag": part["ETag"]}
+            # Raises the first upload error
+            for future in futures:
+                future.result()
+
+        return [{"PartNumber": number, "ETag": etags[number]} for number in sorted(etags)]
 
     def _get_presigned_url(self, bucket: str, key: str, expiry: int = 3600) -> str:
         """
@@ -388,11 +903,19 @@ class VideoPreprocessor:
         """
         return self.s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expiry)
 
+    def _select_encoding_mode(self, source_size: int | None) -> EncodingMode:
+        """
+        Large uploads skip the analysis pass, decoding them twice costs more than the bitrate precision is worth
+        """
+        if self.capped_crf_min_size is not None and source_size is not None and source_size >= self.capped_crf_min_size:
+            return EncodingMode.CAPPED_CRF
+        return self.encoding_mode
+
     def _get_media_info_from_key(self, input_descriptor: S3Record) -> tuple[UUID, UUID]:
         data = input_descriptor.key.split("/")
         return UUID(data[2]), UUID(data[4])
 
-    def process_video(self, input_descriptor: S3Record) -> tuple[UUID, str]:
+    def process_video(self, input_descriptor: S3Record) -> tuple[UUID, str, str | None]:
         """
         Process video from S3 using streaming
 
@@ -400,7 +923,7 @@ class VideoPreprocessor:
             input_descriptor: S3 record containing input video information
 
         Returns:
-            bool: True if processing was successful
+            Media ID, key of the processed video and key of the analysis proxy (None when not made)
 
         Raises:
             FFmpegError: If video processing fails
@@ -426,11 +949,27 @@ class VideoPreprocessor:
             passlogfile_dir.mkdir(exist_ok=True)
             passlogfile = passlogfile_dir / "ffmpeg2pass"
 
+            # Every FFmpeg run below reads the whole source, fetch it from S3 once rather than once per run
+            source_path = None
+            if self.cache_source:
+                self.logger.info("Downloading the source video")
+                source_path = download_source(
+                    self.s3,
+                    input_descriptor.bucket,
+                    source_media_key,
+                    temp_dir,
+                    part_size=self.download_part_size,
+                    max_workers=self.download_workers,
+                )
+            input_path = str(source_path) if source_path else input_url
+
+            upload = None
+            proxy_key = None
             try:
                 # Generate and upload thumbnail
                 self.logger.info("Generating thumbnail")
                 thumbnail_path = Path(temp_dir) / "thumbnail.jpg"
-                extract_thumbnail(input_url, str(thumbnail_path), width=270, height=150)
+                extract_thumbnail(input_path, str(thumbnail_path), width=270, height=150)
 
                 # Create thumbnail key with prefix
                 thumbnail_key = f"{os.path.dirname(target_media_key)}/thumbnail_270_150_{media_id}.jpg"
@@ -443,61 +982,35 @@ class VideoPreprocessor:
                     )
                 self.logger.info("Thumbnail uploaded successfully")
 
-                # First pass with progress monitoring
-                self.logger.info("Starting first pass")
-                progress_r1, progress_w1 = os.pipe()
-                os.set_inheritable(progress_w1, True)
+                video_info = self._get_video_info(input_path)
 
-                # Start progress monitoring thread for first pass
-                progress_thread1 = threading.Thread(
-                    target=self._monitor_progress, args=(progress_r1, progress_queue, 1), daemon=True
-                )
-                progress_thread1.start()
+                # Segments need to seek into the source, only worth it on the local copy
+                if self.encode_segments > 1 and not source_path:
+                    self.logger.warning("Segment encoding needs the downloaded source, encoding in a single run")
 
-                stream_pass1 = (
-                    ffmpeg.input(input_url, protocol_whitelist="https,tls,tcp,file")
-                    .filter("scale", -1, self.target_height)
-                    .filter("fps", fps=30, round="down")
-                    .output("pipe:", **self._get_codec_settings(VideoCodec.H264, pass_number=1))
-                )
+                mode = self._select_encoding_mode(input_descriptor.size)
+                self.logger.info(f"Encoding in {mode} mode")
 
-                process1 = self._run_ffmpeg_pass(stream_pass1, str(passlogfile), progress_w1)
+                # The analysis proxy comes out of the same FFmpeg runs as the playback video
+                proxy_path = Path(temp_dir) / "analysis_proxy.mp4" if self.proxy_height else None
 
-                # Close write end in parent
-                os.close(progress_w1)
-
-                # Wait for first pass to complete
-                stderr_output = process1.stderr.read().decode()
-                return_code = process1.wait()
-                progress_thread1.join()
-
-                if return_code != 0:
-                    raise FFmpegError(f"First pass failed with code {return_code}: {stderr_output}")
-
-                self.logger.info("First pass completed successfully")
-
-                # Second pass with progress monitoring
-                self.logger.info("Starting second pass")
-                progress_r2, progress_w2 = os.pipe()
-                os.set_inheritable(progress_w2, True)
-
-                # Start progress monitoring thread for second pass
-                progress_thread2 = threading.Thread(
-                    target=self._monitor_progress, args=(progress_r2, progress_queue, 2), daemon=True
-                )
-                progress_thread2.start()
-
-                stream_pass2 = (
-                    ffmpeg.input(input_url, protocol_whitelist="https,tls,tcp,file")
-                    .filter("scale", -1, self.target_height)
-                    .filter("fps", fps=30, round="down")
-                    .output("pipe:", **self._get_codec_settings(VideoCodec.H264, pass_number=2))
-                )
-
-                process2 = self._run_ffmpeg_pass(stream_pass2, str(passlogfile), progress_w2)
-
-                # Close write end in parent
-                os.close(progress_w2)
+                progress_threads = []
+                if self.encode_segments > 1 and source_path:
+                    encoder = self._encode_segments(
+                        input_path, Path(temp_dir), mode, progress_queue, video_info, proxy_path
+                    )
+                    encoder_name = "Segments concatenation"
+                else:
+                    encoder, progress_thread = self._start_encoding(
+                        input_path,
+                        "pipe:",
+                        mode,
+                        passlogfile,
+                        progress_queue,
+                        proxy_output=str(proxy_path) if proxy_path else None,
+                    )
+                    progress_threads.append(progress_thread)
+                    encoder_name = "Encoding"
 
                 # Initialize multipart upload
                 self.logger.info(f"Initiating multipart upload to {output_path}")
@@ -505,8 +1018,10 @@ class VideoPreprocessor:
                     Bucket=self.target_bucket, Key=target_media_key, ContentType="video/mp4"
                 )
 
-                # Upload parts
-                parts = list(self._create_upload_parts(process2, upload["UploadId"], target_media_key))
+                # Upload parts, maxrate caps the bitrate so the output can't be larger than this
+                max_bitrate = _parse_bitrate(self._get_codec_settings(VideoCodec.H264)["maxrate"])
+                expected_size = video_info["duration_seconds"] * max_bitrate // 8
+                parts = self._create_upload_parts(encoder.stdout, upload["UploadId"], target_media_key, expected_size)
 
                 # Complete upload
                 self.s3.complete_multipart_upload(
@@ -517,27 +1032,34 @@ class VideoPreprocessor:
                 )
 
                 # Wait for process and thread
-                stderr_output = process2.stderr.read().decode()
-                return_code = process2.wait()
-                progress_thread2.join()
+                stderr_output = encoder.stderr.read().decode()
+                return_code = encoder.wait()
+                for progress_thread in progress_threads:
+                    progress_thread.join()
 
                 if return_code != 0:
-                    raise FFmpegError(f"Second pass failed with code {return_code}: {stderr_output}")
+                    raise FFmpegError(f"{encoder_name} failed with code {return_code}: {stderr_output}")
+
+                if proxy_path:
+                    proxy_key = f"{os.path.splitext(target_media_key)[0]}_analysis_{self.proxy_height}p.mp4"
+                    self.logger.info(f"Uploading analysis proxy to {self.target_bucket}/{proxy_key}")
+                    self.s3.upload_file(
+                        str(proxy_path), self.target_bucket, proxy_key, ExtraArgs={"ContentType": "video/mp4"}
+                    )
 
                 self.logger.info("Video processed successfully!")
 
-            except (FFmpegError, BotoCoreError) as e:
+            except (FFmpegError, BotoCoreError, ClientError) as e:
                 self.logger.error("Error processing video: %s", e)
-                try:
-                    self.s3.abort_multipart_upload(
-                        Bucket=self.target_bucket, Key=input_descriptor.key, UploadId=upload["UploadId"]
-                    )
-                except Exception as abort_error:
-                    self.logger.error("Error aborting multipart upload: %s", abort_error)
+                if upload is not None:
+                    try:
+                        self.s3.abort_multipart_upload(
+                            Bucket=self.target_bucket, Key=target_media_key, UploadId=upload["UploadId"]
+                        )
+                    except Exception as abort_error:
+                        self.logger.error("Error aborting multipart upload: %s", abort_error)
                 raise e
 
-        video_info = self._get_video_info(input_url)
-
         self.logger.info("Updating the media state in the database")
         update_video_status(
             media_id,
@@ -548,4 +1070,4 @@ class VideoPreprocessor:
         )
         self.logger.info(f"Status of media updated: {media_id}")
 
-        return media_id, target_media_key
+        return media_id, target_media_key, proxy_key